@@ -1,3 +1,3 @@
 #!/bin/sh
 
-python src/manage.py populate_db
\ No newline at end of file
+python src/manage.py populate_db --incremental
\ No newline at end of file
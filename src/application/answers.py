@@ -0,0 +1,153 @@
+import re
+
+
+class Answer:
+    """
+    Correct answer to a question and its accepted variants.
+    Variants are normalized texts computed once, when questions are saved,
+    so checking a user's answer normalizes only the user's text, looks it up
+    among variants and falls back to fuzzy comparison with a few short strings.
+    A user's answer is correct if after normalization it:
+    - equals one of variants,
+    - consists of the same words as one of variants in any order,
+    - has the same tokens with digits, e.g. years and amounts, as one of
+    variants, and its other words differ from words of the variant by at most
+    MAX_EDIT_DISTANCE_RATIO of their length of inserted, deleted or replaced
+    characters, so a typo is forgiven in a word, but not in a number.
+    """
+
+    VARIANTS_SEPARATOR = '\n'
+    MAX_EDIT_DISTANCE_RATIO = 0.2
+
+    rx_brackets = re.compile(r'\([^)]*\)|\[[^\]]*\]')
+    rx_alternatives = re.compile(r'\s/\s|;')
+    rx_quotes = re.compile('["\'`«»„“”‘’]')
+    rx_non_word = re.compile(r'[\W_]+')
+    rx_digit = re.compile(r'\d')
+
+    def __init__(self, text, variants=None):
+        self.text = text
+        self.variants = Answer.get_variants(text) if variants is None else variants
+        self._variants_set = set(self.variants)
+        self._variants_tokens = [
+            frozenset(variant.split()) for variant in self.variants
+        ]
+        self._variants_parts = [
+            Answer.split_numbers(variant) for variant in self.variants
+        ]
+
+    def __eq__(self, other):
+        return isinstance(other, Answer) and self.text == other.text
+
+    def __repr__(self):
+        return f'Answer({self.text!r})'
+
+    def is_correct(self, user_answer):
+        """
+        >>> Answer('А. С. Пушкин').is_correct('пушкин')
+        True
+        >>> Answer('Петр 1.').is_correct('петр')
+        False
+        >>> Answer('3 мушкетёра').is_correct('мушкетера')
+        False
+        >>> Answer('1812 год').is_correct('1813 год')
+        False
+        """
+        normalized_answer = Answer.normalize(user_answer)
+        if not normalized_answer:
+            return False
+        if normalized_answer in self._variants_set:
+            return True
+
+        tokens = frozenset(normalized_answer.split())
+        numbers, words = Answer.split_numbers(normalized_answer)
+        for variant_tokens, (variant_numbers, variant_words) in zip(
+            self._variants_tokens, self._variants_parts
+        ):
+            if tokens == variant_tokens:
+                return True
+            if numbers != variant_numbers:
+                continue
+            max_distance = int(len(variant_words) * Answer.MAX_EDIT_DISTANCE_RATIO)
+            if get_edit_distance(words, variant_words, max_distance) <= max_distance:
+                return True
+        return False
+
+    def dump_variants(self):
+        return Answer.VARIANTS_SEPARATOR.join(self.variants)
+
+    @classmethod
+    def load(cls, text, dumped_variants=None):
+        """
+        Variants are computed from text if they were not saved,
+        e.g. for questions saved before variants were introduced.
+        """
+        if dumped_variants is None:
+            return cls(text)
+        return cls(text, dumped_variants.split(Answer.VARIANTS_SEPARATOR))
+
+    @staticmethod
+    def normalize(text):
+        """
+        Lower case, 'ё' replaced with 'е', quotes removed,
+        other punctuation replaced with spaces, spaces collapsed.
+        """
+        text = text.lower().replace('ё', 'е')
+        text = Answer.rx_quotes.sub('', text)
+        return Answer.rx_non_word.sub(' ', text).strip()
+
+    @staticmethod
+    def split_numbers(normalized_text):
+        """
+        :return: tuple of tokens with digits and string of other tokens.
+        """
+        tokens = normalized_text.split()
+        numbers = tuple(token for token in tokens if Answer.rx_digit.search(token))
+        words = ' '.join(token for token in tokens if not Answer.rx_digit.search(token))
+        return numbers, words
+
+    @staticmethod
+    def get_variants(text):
+        """
+        :return: list of normalized accepted variants of the answer text:
+        whole text, every alternative separated by ' / ' or ';',
+        each of them also without notes in brackets and without initials,
+        one-letter tokens without digits, while single digits are kept.
+        """
+        variants = [Answer.normalize(text)]
+        for alternative in [text, *Answer.rx_alternatives.split(text)]:
+            without_notes = Answer.normalize(Answer.rx_brackets.sub(' ', alternative))
+            without_initials = ' '.join(
+                token
+                for token in without_notes.split()
+                if len(token) > 1 or Answer.rx_digit.search(token)
+            )
+            variants.extend(
+                (Answer.normalize(alternative), without_notes, without_initials)
+            )
+        return [variant for variant in dict.fromkeys(variants) if variant]
+
+
+def get_edit_distance(first, second, max_distance):
+    """
+    Levenshtein distance between strings, computed only within
+    max_distance of the diagonal. Any value above max_distance means
+    the distance is greater than max_distance.
+    """
+    if abs(len(first) - len(second)) > max_distance:
+        return max_distance + 1
+
+    previous_row = list(range(len(second) + 1))
+    for i, first_char in enumerate(first, start=1):
+        current_row = [i] + [max_distance + 1] * len(second)
+        start, end = max(1, i - max_distance), min(len(second), i + max_distance)
+        for j in range(start, end + 1):
+            current_row[j] = min(
+                previous_row[j] + 1,
+                current_row[j - 1] + 1,
+                previous_row[j - 1] + (first_char != second[j - 1]),
+            )
+        if min(current_row) > max_distance:
+            return max_distance + 1
+        previous_row = current_row
+    return previous_row[-1]
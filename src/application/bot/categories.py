@@ -0,0 +1,24 @@
+ALL_CATEGORIES = 'Все категории'
+MAX_CATEGORIES = 9
+# VK limits button labels to 40 characters.
+MAX_LABEL_LENGTH = 40
+
+
+def get_category_choices(categories):
+    """
+    :param categories: list of (category, number of questions) pairs,
+    largest categories first.
+    :return: dict of button label: category of the largest categories,
+    empty category stands for all categories.
+    """
+    choices = {ALL_CATEGORIES: ''}
+    for category, _ in categories[:MAX_CATEGORIES]:
+        label = category
+        if len(label) > MAX_LABEL_LENGTH:
+            label = label[: MAX_LABEL_LENGTH - 1] + '…'
+        choices.setdefault(label, category)
+    return choices
+
+
+def format_category(category):
+    return f'Категория: {category or ALL_CATEGORIES.lower()}'
@@ -0,0 +1,142 @@
+import logging
+import threading
+import collections.abc
+
+from application.common.storage import Storage
+from application.models import UserState
+
+logger = logging.getLogger(__name__)
+
+
+class StoredConversations(collections.abc.MutableMapping):
+    """
+    Replaces in-memory conversations of ConversationHandler: state of every chat
+    is kept in storage as UserState, so any process may handle any chat.
+    ConversationHandler keys conversations by (chat id, user id), bots talk
+    in private chats, where they are equal, so state is kept per chat.
+    """
+
+    def __init__(self, platform):
+        self.platform = platform
+
+    def __getitem__(self, key):
+        state = UserState.get_by_user_id(self.platform, key[0]).state
+        if state is None:
+            raise KeyError(key)
+        return state
+
+    def __setitem__(self, key, state):
+        UserState(self.platform, key[0], state).save_to_db()
+
+    def __delitem__(self, key):
+        if not UserState(self.platform, key[0]).delete_from_db():
+            raise KeyError(key)
+
+    def __iter__(self):
+        return ((user_id, user_id) for user_id in UserState.get_user_ids(self.platform))
+
+    def __len__(self):
+        return len(UserState.get_user_ids(self.platform))
+
+
+class WriteBehindConversations(StoredConversations):
+    """
+    StoredConversations which do not write a changed state at once:
+    changed states are kept in memory and written by a background thread
+    in one pipeline every flush_interval seconds or as soon as flush_size
+    chats have changed. Reads see states which are not written yet.
+    Other processes see a change up to flush_interval later, and states
+    changed within flush_interval before the process is killed are lost.
+    """
+
+    def __init__(self, platform, flush_interval=0.1, flush_size=100):
+        super().__init__(platform)
+        self.flush_interval = flush_interval
+        self.flush_size = flush_size
+        # user id: state, None for a deleted state.
+        self._dirty = {}
+        self._flushing = {}
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._flush_requested = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._work, daemon=True)
+        self._thread.start()
+
+    def __getitem__(self, key):
+        with self._lock:
+            changes = [
+                states for states in (self._dirty, self._flushing) if key[0] in states
+            ]
+            state = changes[0][key[0]] if changes else None
+        if not changes:
+            return super().__getitem__(key)
+        if state is None:
+            raise KeyError(key)
+        return state
+
+    def __setitem__(self, key, state):
+        self._change(key[0], state)
+
+    def __delitem__(self, key):
+        # Raises KeyError for a missing state as a mapping should.
+        self[key]
+        self._change(key[0], None)
+
+    def __iter__(self):
+        self.flush()
+        return super().__iter__()
+
+    def __len__(self):
+        self.flush()
+        return super().__len__()
+
+    def flush(self):
+        """
+        Write changed states in one pipeline.
+        """
+        with self._flush_lock:
+            with self._lock:
+                self._flushing, self._dirty = self._dirty, {}
+            if not self._flushing:
+                return None
+            try:
+                with Storage.engine.pipeline(transaction=False):
+                    for user_id, state in self._flushing.items():
+                        user_state = UserState(self.platform, user_id, state)
+                        if state is None:
+                            user_state.delete_from_db()
+                        else:
+                            user_state.save_to_db()
+            except Exception as e:
+                logger.error(
+                    f'Failed to write {len(self._flushing)} conversation states, '
+                    f'error: {str(e)}'
+                )
+                # States changed since the flush started are newer.
+                with self._lock:
+                    self._dirty = {**self._flushing, **self._dirty}
+            finally:
+                with self._lock:
+                    self._flushing = {}
+
+    def stop(self):
+        """
+        Write changed states and stop the background thread.
+        """
+        self._stopped.set()
+        self._flush_requested.set()
+        self._thread.join()
+        self.flush()
+
+    def _change(self, user_id, state):
+        with self._lock:
+            self._dirty[user_id] = state
+            if len(self._dirty) >= self.flush_size:
+                self._flush_requested.set()
+
+    def _work(self):
+        while not self._stopped.is_set():
+            self._flush_requested.wait(self.flush_interval)
+            self._flush_requested.clear()
+            self.flush()
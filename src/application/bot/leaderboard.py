@@ -0,0 +1,43 @@
+import hashlib
+
+from application.models import Leaderboard
+
+PERIOD_NAMES = {
+    Leaderboard.GLOBAL: 'за всё время',
+    Leaderboard.DAILY: 'за сегодня',
+    Leaderboard.WEEKLY: 'за неделю',
+}
+
+
+def get_player_name(user_id, display_names):
+    """
+    :return: display name of the user, or a short hash of user's id,
+    so ids of users are not shown to other users.
+    """
+    if display_names.get(user_id):
+        return display_names[user_id]
+    digest = hashlib.sha256(str(user_id).encode()).hexdigest()
+    return f'Игрок #{digest[:6]}'
+
+
+def format_leaderboard(top, user_ranks, display_names=None):
+    """
+    :param top: list of (user_id, score) pairs from the all-time leaderboard.
+    :param user_ranks: dict of period: (rank, score) of the user.
+    :param display_names: dict of user_id: display name of users in top.
+    """
+    display_names = display_names or {}
+    lines = ['Лучшие игроки:']
+    lines.extend(
+        f'{place}. {get_player_name(user_id, display_names)}: {score}'
+        for place, (user_id, score) in enumerate(top, start=1)
+    )
+    if not top:
+        lines.append('Пока никто не ответил правильно.')
+
+    lines.append('')
+    for period in Leaderboard.PERIODS:
+        rank, score = user_ranks[period]
+        place = f'{rank} место' if rank is not None else 'нет места'
+        lines.append(f'Ваш результат {PERIOD_NAMES[period]}: {score}, {place}')
+    return '\n'.join(lines)
@@ -0,0 +1,12 @@
+from application.common.metrics import Counter, Histogram
+
+HANDLER_LATENCY = Histogram(
+    'quiz_bot_handler_seconds',
+    'Duration of handling a message in a conversation state.',
+    labelnames=('platform', 'state'),
+)
+ANSWERS = Counter(
+    'quiz_bot_answers_total',
+    'Users answers by result: correct, wrong or gave_up.',
+    labelnames=('platform', 'result'),
+)
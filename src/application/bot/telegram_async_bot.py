@@ -0,0 +1,363 @@
+import asyncio
+import logging
+import weakref
+
+import aiohttp
+from aioredis import errors as aioredis_errors
+
+from application.common.database import AsyncRedisStorage
+from application.bot.categories import get_category_choices, format_category
+from application.bot.leaderboard import format_leaderboard
+from application.bot.metrics import ANSWERS, HANDLER_LATENCY
+from application.models import (
+    Leaderboard,
+    QuestionDraw,
+    QuizQuestion,
+    UserCategory,
+    UserQuestion,
+    UserRating,
+)
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncTelegramBot:
+    """
+    Telegram bot running on asyncio: updates are fetched with long polling
+    and processed concurrently, at most concurrency_limit at a time.
+    Updates from the same chat are processed in order.
+    """
+
+    API_URL = 'https://api.telegram.org'
+    POLLING_TIMEOUT = 30
+
+    def __init__(self, token, concurrency_limit=100, api_url=API_URL):
+        self._base_url = f'{api_url}/bot{token}'
+        self._concurrency_limit = concurrency_limit
+        self._session = None
+        self._conversations = dict()
+        self._chat_locks = weakref.WeakValueDictionary()
+
+    def start(self, redis_settings):
+        loop = asyncio.get_event_loop()
+        loop.run_until_complete(AsyncRedisStorage.initialize(**redis_settings))
+        try:
+            loop.run_until_complete(self._poll())
+        finally:
+            loop.run_until_complete(AsyncRedisStorage.close())
+
+    async def reply_text(self, chat_id, text, reply_markup=None):
+        params = {'chat_id': chat_id, 'text': text}
+        if reply_markup is not None:
+            params['reply_markup'] = reply_markup
+        return await self._call('sendMessage', params)
+
+    async def _poll(self):
+        semaphore = asyncio.Semaphore(self._concurrency_limit)
+        timeout = aiohttp.ClientTimeout(total=AsyncTelegramBot.POLLING_TIMEOUT + 10)
+        offset = None
+
+        async with aiohttp.ClientSession(timeout=timeout) as session:
+            self._session = session
+            while True:
+                try:
+                    updates = await self._call(
+                        'getUpdates',
+                        {'offset': offset, 'timeout': AsyncTelegramBot.POLLING_TIMEOUT},
+                    )
+                except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                    logger.error(f'Polling failed with error {str(e)}.')
+                    await asyncio.sleep(1)
+                    continue
+
+                for update in updates:
+                    offset = update['update_id'] + 1
+                    await semaphore.acquire()
+                    task = asyncio.ensure_future(self._process_update(update))
+                    task.add_done_callback(lambda _: semaphore.release())
+
+    async def _call(self, method, params):
+        params = {key: value for key, value in params.items() if value is not None}
+        url = f'{self._base_url}/{method}'
+        async with self._session.post(url, json=params) as http_response:
+            response = await http_response.json()
+        if not response.get('ok'):
+            raise aiohttp.ClientError(
+                'Telegram method {} failed: {}'.format(
+                    method, response.get('description')
+                )
+            )
+        return response['result']
+
+    async def _process_update(self, update):
+        message = update.get('message')
+        if message is None or 'text' not in message:
+            return None
+
+        chat_id = message['chat']['id']
+        chat_lock = self._chat_locks.get(chat_id)
+        if chat_lock is None:
+            chat_lock = self._chat_locks[chat_id] = asyncio.Lock()
+
+        async with chat_lock:
+            try:
+                await self._dispatch(chat_id, message)
+            except Exception as e:
+                logger.error(f'Update {str(update)} caused error {str(e)}.')
+
+    async def _dispatch(self, chat_id, message):
+        handler = self._get_handler(self._conversations.get(chat_id), message['text'])
+        if handler is None:
+            return None
+
+        with HANDLER_LATENCY.time(platform='telegram', state=handler.__name__):
+            new_state = await handler(self, message)
+
+        if new_state == AsyncConversationStates.END:
+            self._conversations.pop(chat_id, None)
+        else:
+            self._conversations[chat_id] = new_state
+
+    def _get_handler(self, state, text):
+        """
+        Same routing as ConversationHandler of TelegramBot.
+        """
+        if state is None:
+            return AsyncConversationStates.start if text == '/start' else None
+
+        if text == '/cancel':
+            return AsyncConversationStates.cancel
+
+        if state == AsyncConversationStates.MENU_CHOOSING:
+            if text == 'Новый вопрос':
+                return AsyncConversationStates.new_question_chosen_state
+            if text == 'Мой счет':
+                return AsyncConversationStates.user_score_state
+            if text == 'Рейтинг':
+                return AsyncConversationStates.leaderboard_state
+            if text == 'Категория':
+                return AsyncConversationStates.category_chosen_state
+            if text == '/topic' or text.startswith('/topic '):
+                return AsyncConversationStates.topic_question_chosen_state
+
+        elif state == AsyncConversationStates.USER_ANSWER_PROCESSING:
+            if text == 'Сдаться':
+                return AsyncConversationStates.give_up_state
+            return AsyncConversationStates.user_answered_state
+
+        elif state == AsyncConversationStates.CATEGORY_CHOOSING:
+            return AsyncConversationStates.category_selected_state
+
+        return None
+
+
+class AsyncConversationStates:
+    MENU_CHOOSING, USER_ANSWER_PROCESSING, CATEGORY_CHOOSING = range(3)
+    END = -1
+    keyboard = [['Новый вопрос', 'Сдаться'], ['Мой счет', 'Рейтинг'], ['Категория']]
+    storage_errors = (aioredis_errors.RedisError,)
+
+    @staticmethod
+    async def start(bot, message):
+        reply_markup = {
+            'keyboard': AsyncConversationStates.keyboard,
+            'one_time_keyboard': True,
+            'resize_keyboard': True,
+        }
+        await bot.reply_text(
+            message['chat']['id'],
+            'Привет! Я бот для викторин!',
+            reply_markup=reply_markup,
+        )
+        return AsyncConversationStates.MENU_CHOOSING
+
+    @staticmethod
+    async def cancel(bot, message):
+        user_first_name = message['from']['first_name']
+        await bot.reply_text(
+            message['chat']['id'],
+            f'До свидания {user_first_name}!.',
+            reply_markup={'remove_keyboard': True},
+        )
+        return AsyncConversationStates.END
+
+    @staticmethod
+    async def new_question_chosen_state(bot, message):
+        chat_id = message['chat']['id']
+
+        try:
+            question_id, question_text = await QuestionDraw.draw_question_async(chat_id)
+        except (*AsyncConversationStates.storage_errors, ValueError) as e:
+            logger.error(
+                'An error occurred during object initialization. '
+                'User_id: {}, error: {}'.format(chat_id, str(e))
+            )
+            await bot.reply_text(chat_id, 'Пожалуйста, попробуйте снова.')
+            return AsyncConversationStates.MENU_CHOOSING
+
+        return await AsyncConversationStates._ask_question(
+            bot, chat_id, question_id, question_text
+        )
+
+    @staticmethod
+    async def topic_question_chosen_state(bot, message):
+        chat_id = message['chat']['id']
+        topic = message['text'].partition(' ')[2].strip()
+        if not topic:
+            await bot.reply_text(chat_id, 'Укажите тему, например: /topic космос')
+            return AsyncConversationStates.MENU_CHOOSING
+
+        try:
+            question_id, question_text = (
+                await QuestionDraw.draw_question_on_topic_async(topic)
+            )
+        except ValueError as e:
+            logger.debug(
+                'Question on topic was not found. '
+                'User_id: {}, error: {}'.format(chat_id, str(e))
+            )
+            await bot.reply_text(chat_id, 'Не нашлось вопросов на эту тему.')
+            return AsyncConversationStates.MENU_CHOOSING
+        except AsyncConversationStates.storage_errors as e:
+            logger.error(
+                'An error occurred during object initialization. '
+                'User_id: {}, error: {}'.format(chat_id, str(e))
+            )
+            await bot.reply_text(chat_id, 'Пожалуйста, попробуйте снова.')
+            return AsyncConversationStates.MENU_CHOOSING
+
+        return await AsyncConversationStates._ask_question(
+            bot, chat_id, question_id, question_text
+        )
+
+    @staticmethod
+    async def _ask_question(bot, chat_id, question_id, question_text):
+        try:
+            user_question = UserQuestion(chat_id, question_id)
+            await user_question.save_to_db_async()
+        except AsyncConversationStates.storage_errors as e:
+            logger.error(
+                'An error occurred during saving data to database.'
+                'User_id: {}, question_id: {}, error: {}'.format(
+                    chat_id, question_id, str(e)
+                )
+            )
+            await bot.reply_text(chat_id, 'Пожалуйста, попробуйте снова.')
+            return AsyncConversationStates.MENU_CHOOSING
+
+        await bot.reply_text(chat_id, question_text)
+        return AsyncConversationStates.USER_ANSWER_PROCESSING
+
+    @staticmethod
+    async def user_answered_state(bot, message):
+        chat_id = message['chat']['id']
+        answer = await UserQuestion.get_answer_by_user_id_async(chat_id)
+
+        if answer is None:
+            await bot.reply_text(chat_id, 'Пожалуйста, попробуйте снова.')
+            return AsyncConversationStates.MENU_CHOOSING
+
+        if answer.is_correct(message['text']):
+            ANSWERS.inc(platform='telegram', result='correct')
+            user_rating = UserRating(chat_id)
+            await user_rating.increase_rating_async(
+                display_name=message.get('from', {}).get('first_name')
+            )
+
+            await bot.reply_text(
+                chat_id,
+                'Правильно! Поздравляю! Для следующего вопроса нажмите «Новый вопрос».',
+            )
+            return AsyncConversationStates.MENU_CHOOSING
+
+        ANSWERS.inc(platform='telegram', result='wrong')
+        await bot.reply_text(chat_id, 'Неправильно... Попробуешь ещё раз?')
+        return AsyncConversationStates.USER_ANSWER_PROCESSING
+
+    @staticmethod
+    async def give_up_state(bot, message):
+        chat_id = message['chat']['id']
+        answer = await UserQuestion.get_answer_by_user_id_async(chat_id)
+
+        if answer is None:
+            await bot.reply_text(chat_id, 'Пожалуйста, попробуйте снова.')
+            return AsyncConversationStates.MENU_CHOOSING
+
+        ANSWERS.inc(platform='telegram', result='gave_up')
+        await bot.reply_text(
+            chat_id,
+            f'Внимание, правильный ответ: {answer.text}'
+            f'Для следующего вопроса нажмите «Новый вопрос».',
+        )
+        return AsyncConversationStates.MENU_CHOOSING
+
+    @staticmethod
+    async def user_score_state(bot, message):
+        chat_id = message['chat']['id']
+        user_rating = UserRating(chat_id)
+        score = await user_rating.get_rating_async()
+        await bot.reply_text(chat_id, f'Ваш  результат: {score}')
+        return AsyncConversationStates.MENU_CHOOSING
+
+    @staticmethod
+    async def leaderboard_state(bot, message):
+        chat_id = message['chat']['id']
+        top, user_ranks = await asyncio.gather(
+            Leaderboard(Leaderboard.GLOBAL).get_top_async(),
+            Leaderboard.get_user_ranks_async(chat_id),
+        )
+        display_names = await Leaderboard.get_display_names_async(
+            [user_id for user_id, _ in top]
+        )
+        await bot.reply_text(
+            chat_id, format_leaderboard(top, user_ranks, display_names)
+        )
+        return AsyncConversationStates.MENU_CHOOSING
+
+    @staticmethod
+    async def category_chosen_state(bot, message):
+        chat_id = message['chat']['id']
+        try:
+            categories = await QuizQuestion.get_categories_async()
+        except AsyncConversationStates.storage_errors as e:
+            logger.error(
+                'An error occurred during fetching categories. '
+                'User_id: {}, error: {}'.format(chat_id, str(e))
+            )
+            await bot.reply_text(chat_id, 'Пожалуйста, попробуйте снова.')
+            return AsyncConversationStates.MENU_CHOOSING
+
+        reply_markup = {
+            'keyboard': [[label] for label in get_category_choices(categories)],
+            'one_time_keyboard': True,
+            'resize_keyboard': True,
+        }
+        await bot.reply_text(
+            chat_id, 'Выберите категорию вопросов:', reply_markup=reply_markup
+        )
+        return AsyncConversationStates.CATEGORY_CHOOSING
+
+    @staticmethod
+    async def category_selected_state(bot, message):
+        """
+        Choices are built again from categories, as they were on the keyboard.
+        """
+        chat_id = message['chat']['id']
+        category_choices = get_category_choices(
+            await QuizQuestion.get_categories_async()
+        )
+        if message['text'] not in category_choices:
+            await bot.reply_text(chat_id, 'Выберите категорию с клавиатуры.')
+            return AsyncConversationStates.CATEGORY_CHOOSING
+
+        category = category_choices[message['text']]
+        await UserCategory(chat_id, category).save_to_db_async()
+        await bot.reply_text(
+            chat_id,
+            format_category(category),
+            reply_markup={
+                'keyboard': AsyncConversationStates.keyboard,
+                'resize_keyboard': True,
+            },
+        )
+        return AsyncConversationStates.MENU_CHOOSING
@@ -1,6 +1,5 @@
 import logging
-import json
-import dataclasses
+import itertools
 
 from telegram.ext import (
     Updater,
@@ -10,30 +9,86 @@ from telegram.ext import (
     CommandHandler,
     RegexHandler,
 )
-from telegram import ReplyKeyboardMarkup, ReplyKeyboardRemove
+from telegram import ReplyKeyboardMarkup, ReplyKeyboardRemove, Update
 from redis import exceptions as redis_exceptions
 
-from application.models import QuizQuestion, UserQuestion, UserRating
+from application.bot.categories import get_category_choices, format_category
+from application.bot.conversations import (
+    StoredConversations,
+    WriteBehindConversations,
+)
+from application.bot.leaderboard import format_leaderboard
+from application.bot.metrics import ANSWERS, HANDLER_LATENCY
+from application.common.metrics import timed
+from application.models import (
+    Leaderboard,
+    QuestionDraw,
+    QuizQuestion,
+    UserCategory,
+    UserQuestion,
+    UserRating,
+)
 
 logger = logging.getLogger(__name__)
 
 
 class TelegramBot:
-    def __init__(self, token):
-        self.updater = Updater(token=token)
+    def __init__(
+        self,
+        token,
+        api_url=None,
+        store_conversations=False,
+        flush_interval=0,
+        flush_size=100,
+    ):
+        """
+        :param api_url: url of telegram bot API, e.g. of a fake one in tests.
+        :param store_conversations: keep conversation states in storage
+        instead of process memory, so they survive restarts and several
+        processes may serve the bot.
+        :param flush_interval: seconds stored states are written behind,
+        every changed state is written at once with 0.
+        :param flush_size: number of changed states which are written
+        without waiting for flush_interval.
+        """
+        self.conversations = None
+        self.updater = Updater(
+            token=token, base_url=api_url and f'{api_url.rstrip("/")}/bot'
+        )
 
         dispatcher = self.updater.dispatcher
         dispatcher.add_error_handler(self._error)
-        self._initialize_conversation_handler()
+        self._initialize_conversation_handler(
+            store_conversations, flush_interval, flush_size
+        )
 
     def start(self):
         self.updater.start_polling()
         self.updater.idle()
+        self.stop()
+
+    def stop(self):
+        """
+        Write conversation states which are not written yet.
+        """
+        if isinstance(self.conversations, WriteBehindConversations):
+            self.conversations.stop()
+
+    def set_webhook(self, url, max_connections=40):
+        return self.updater.bot.set_webhook(url=url, max_connections=max_connections)
+
+    def process_update(self, update):
+        """
+        :param update: decoded JSON of an update, e.g. posted to webhook.
+        """
+        self.updater.dispatcher.process_update(Update.de_json(update, self.updater.bot))
 
     def _error(self, bot, update, error):
         logger.error(f'Update {str(update)} caused error {str(error)}.')
 
-    def _initialize_conversation_handler(self):
+    def _initialize_conversation_handler(
+        self, store_conversations, flush_interval, flush_size
+    ):
         dispatcher = self.updater.dispatcher
 
         conversation_handler = ConversationHandler(
@@ -50,6 +105,22 @@ class TelegramBot:
                         ConversationStates.user_score_state,
                         pass_user_data=True,
                     ),
+                    RegexHandler(
+                        '^(Рейтинг)$',
+                        ConversationStates.leaderboard_state,
+                        pass_user_data=True,
+                    ),
+                    RegexHandler(
+                        '^(Категория)$',
+                        ConversationStates.category_chosen_state,
+                        pass_user_data=True,
+                    ),
+                    CommandHandler(
+                        'topic',
+                        ConversationStates.topic_question_chosen_state,
+                        pass_args=True,
+                        pass_user_data=True,
+                    ),
                 ],
                 ConversationStates.USER_ANSWER_PROCESSING: [
                     RegexHandler(
@@ -63,22 +134,44 @@ class TelegramBot:
                         pass_user_data=True,
                     ),
                 ],
+                ConversationStates.CATEGORY_CHOOSING: [
+                    MessageHandler(
+                        Filters.text,
+                        ConversationStates.category_selected_state,
+                        pass_user_data=True,
+                    )
+                ],
             },
             fallbacks=[CommandHandler('cancel', ConversationStates.cancel)],
         )
+        for handler in itertools.chain(
+            conversation_handler.entry_points,
+            conversation_handler.fallbacks,
+            *conversation_handler.states.values(),
+        ):
+            handler.callback = timed(
+                HANDLER_LATENCY, platform='telegram', state=handler.callback.__name__
+            )(handler.callback)
+        if store_conversations and flush_interval:
+            self.conversations = WriteBehindConversations(
+                'telegram', flush_interval, flush_size
+            )
+        elif store_conversations:
+            self.conversations = StoredConversations('telegram')
+        if self.conversations is not None:
+            conversation_handler.conversations = self.conversations
         dispatcher.add_handler(conversation_handler)
 
 
 class ConversationStates:
-    MENU_CHOOSING, USER_ANSWER_PROCESSING = range(2)
-    keyboard = [['Новый вопрос', 'Сдаться'], ['Мой счет']]
+    MENU_CHOOSING, USER_ANSWER_PROCESSING, CATEGORY_CHOOSING = range(3)
+    keyboard = [['Новый вопрос', 'Сдаться'], ['Мой счет', 'Рейтинг'], ['Категория']]
 
     @staticmethod
     def start(bot, update):
-        keyboard = [['Новый вопрос', 'Сдаться'], ['Мой счет']]
         message = 'Привет! Я бот для викторин!'
         reply_markup = ReplyKeyboardMarkup(
-            keyboard, one_time_keyboard=True, resize_keyboard=True
+            ConversationStates.keyboard, one_time_keyboard=True, resize_keyboard=True
         )
         update.message.reply_text(message, reply_markup=reply_markup)
         return ConversationStates.MENU_CHOOSING
@@ -96,7 +189,9 @@ class ConversationStates:
     def new_question_chosen_state(bot, update, user_data):
 
         try:
-            quiz_question = QuizQuestion.get_random_question_from_storage()
+            question_id, question_text = QuestionDraw.draw_question(
+                update.message.chat_id
+            )
         except (redis_exceptions.DataError, ValueError) as e:
             logger.error(
                 'An error occurred during object initialization. '
@@ -105,41 +200,66 @@ class ConversationStates:
             update.message.reply_text('Пожалуйста, попробуйте снова.')
             return ConversationStates.MENU_CHOOSING
 
+        return ConversationStates._ask_question(update, question_id, question_text)
+
+    @staticmethod
+    def topic_question_chosen_state(bot, update, args, user_data):
+        topic = ' '.join(args)
+        if not topic:
+            update.message.reply_text('Укажите тему, например: /topic космос')
+            return ConversationStates.MENU_CHOOSING
+
         try:
-            user_question = UserQuestion(
-                update.message.chat_id, json.dumps(dataclasses.asdict(quiz_question))
+            question_id, question_text = QuestionDraw.draw_question_on_topic(topic)
+        except ValueError as e:
+            logger.debug(
+                'Question on topic was not found. '
+                'User_id: {}, error: {}'.format(update.message.chat_id, str(e))
+            )
+            update.message.reply_text('Не нашлось вопросов на эту тему.')
+            return ConversationStates.MENU_CHOOSING
+        except redis_exceptions.DataError as e:
+            logger.error(
+                'An error occurred during object initialization. '
+                'User_id: {}, error: {}'.format(update.message.chat_id, str(e))
             )
+            update.message.reply_text('Пожалуйста, попробуйте снова.')
+            return ConversationStates.MENU_CHOOSING
+
+        return ConversationStates._ask_question(update, question_id, question_text)
+
+    @staticmethod
+    def _ask_question(update, question_id, question_text):
+        try:
+            user_question = UserQuestion(update.message.chat_id, question_id)
             user_question.save_to_db()
         except redis_exceptions.DataError as e:
             logger.error(
                 'An error occurred during saving data to database.'
-                'User_id: {}, record: {}, error: {}'.format(
-                    update.message.chat_id, dataclasses.asdict(quiz_question), str(e)
+                'User_id: {}, question_id: {}, error: {}'.format(
+                    update.message.chat_id, question_id, str(e)
                 )
             )
             update.message.reply_text('Пожалуйста, попробуйте снова.')
             return ConversationStates.MENU_CHOOSING
 
-        update.message.reply_text(quiz_question.question)
+        update.message.reply_text(question_text)
         return ConversationStates.USER_ANSWER_PROCESSING
 
     @staticmethod
     def user_answered_state(bot, update, user_data):
-        user_question = UserQuestion.get_by_user_id(update.message.chat_id)
+        answer = UserQuestion.get_answer_by_user_id(update.message.chat_id)
 
-        if user_question.question is None:
+        if answer is None:
             update.message.reply_text('Пожалуйста, попробуйте снова.')
             return ConversationStates.MENU_CHOOSING
 
-        quiz_question_dict = json.loads(user_question.question)
-        quiz_question = QuizQuestion(**quiz_question_dict)
-
-        normalized_answer_from_user = update.message.text.lower().strip()
-        normalized_answer_from_base = quiz_question.answer.lower().strip()
-
-        if normalized_answer_from_base == normalized_answer_from_user:
+        if answer.is_correct(update.message.text):
+            ANSWERS.inc(platform='telegram', result='correct')
             user_rating = UserRating(update.message.chat_id)
-            user_rating.increase_rating()
+            user_rating.increase_rating(
+                display_name=update.message.from_user['first_name']
+            )
 
             update.message.reply_text(
                 'Правильно! Поздравляю! Для следующего вопроса нажмите «Новый вопрос».'
@@ -147,22 +267,21 @@ class ConversationStates:
 
             return ConversationStates.MENU_CHOOSING
 
+        ANSWERS.inc(platform='telegram', result='wrong')
         update.message.reply_text('Неправильно... Попробуешь ещё раз?')
         return ConversationStates.USER_ANSWER_PROCESSING
 
     @staticmethod
     def give_up_state(bot, update, user_data):
-        user_question = UserQuestion.get_by_user_id(update.message.chat_id)
+        answer = UserQuestion.get_answer_by_user_id(update.message.chat_id)
 
-        if user_question.question is None:
+        if answer is None:
             update.message.reply_text('Пожалуйста, попробуйте снова.')
             return ConversationStates.MENU_CHOOSING
 
-        quiz_question_dict = json.loads(user_question.question)
-        quiz_question = QuizQuestion(**quiz_question_dict)
-
+        ANSWERS.inc(platform='telegram', result='gave_up')
         update.message.reply_text(
-            f'Внимание, правильный ответ: {quiz_question.answer}'
+            f'Внимание, правильный ответ: {answer.text}'
             f'Для следующего вопроса нажмите «Новый вопрос».'
         )
         return ConversationStates.MENU_CHOOSING
@@ -173,3 +292,53 @@ class ConversationStates:
         score = user_rating.get_rating()
         update.message.reply_text(f'Ваш  результат: {score}')
         return ConversationStates.MENU_CHOOSING
+
+    @staticmethod
+    def leaderboard_state(bot, update, user_data):
+        top = Leaderboard(Leaderboard.GLOBAL).get_top()
+        user_ranks = Leaderboard.get_user_ranks(update.message.chat_id)
+        display_names = Leaderboard.get_display_names([user_id for user_id, _ in top])
+        update.message.reply_text(format_leaderboard(top, user_ranks, display_names))
+        return ConversationStates.MENU_CHOOSING
+
+    @staticmethod
+    def category_chosen_state(bot, update, user_data):
+        try:
+            categories = QuizQuestion.get_categories()
+        except redis_exceptions.RedisError as e:
+            logger.error(
+                'An error occurred during fetching categories. '
+                'User_id: {}, error: {}'.format(update.message.chat_id, str(e))
+            )
+            update.message.reply_text('Пожалуйста, попробуйте снова.')
+            return ConversationStates.MENU_CHOOSING
+
+        user_data['category_choices'] = get_category_choices(categories)
+        reply_markup = ReplyKeyboardMarkup(
+            [[label] for label in user_data['category_choices']],
+            one_time_keyboard=True,
+            resize_keyboard=True,
+        )
+        update.message.reply_text(
+            'Выберите категорию вопросов:', reply_markup=reply_markup
+        )
+        return ConversationStates.CATEGORY_CHOOSING
+
+    @staticmethod
+    def category_selected_state(bot, update, user_data):
+        # Choices are built again if categories were shown by another process.
+        category_choices = user_data.get('category_choices')
+        if category_choices is None:
+            category_choices = get_category_choices(QuizQuestion.get_categories())
+        if update.message.text not in category_choices:
+            update.message.reply_text('Выберите категорию с клавиатуры.')
+            return ConversationStates.CATEGORY_CHOOSING
+
+        category = category_choices[update.message.text]
+        UserCategory(update.message.chat_id, category).save_to_db()
+        user_data.pop('category_choices', None)
+        reply_markup = ReplyKeyboardMarkup(
+            ConversationStates.keyboard, resize_keyboard=True
+        )
+        update.message.reply_text(format_category(category), reply_markup=reply_markup)
+        return ConversationStates.MENU_CHOOSING
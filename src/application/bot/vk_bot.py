@@ -1,177 +1,296 @@
-import random
 import logging
-import json
-import dataclasses
+import threading
 
 import vk_api
 from vk_api.keyboard import VkKeyboard, VkKeyboardColor
 from vk_api.longpoll import VkLongPoll, VkEventType
 from redis import exceptions as redis_exceptions
 
-from application.models import QuizQuestion, UserQuestion, UserRating
+from application.bot.categories import get_category_choices, format_category
+from application.bot.leaderboard import format_leaderboard
+from application.bot.metrics import ANSWERS, HANDLER_LATENCY
+from application.bot.vk_sender import VkMessageSender
+from application.common.workers import KeyOrderedWorkerPool
+from application.common.storage import Storage
+from application.models import (
+    Leaderboard,
+    QuestionDraw,
+    QuizQuestion,
+    UserCategory,
+    UserQuestion,
+    UserRating,
+    UserState,
+)
 
 logger = logging.getLogger(__name__)
 
 
 class VkBot:
-    GREETINGS, MENU_CHOOSING, USER_ANSWER_PROCESSING = range(3)
-
-    def __init__(self, group_token):
+    GREETINGS, MENU_CHOOSING, USER_ANSWER_PROCESSING, CATEGORY_CHOOSING = range(4)
+    PLATFORM = 'vk'
+    # Group tokens are allowed to make 20 requests per second.
+    RPS_DELAY = 1 / 20
+    # Messages of the event handled by the current worker thread.
+    _outbox = threading.local()
+
+    def __init__(self, group_token, workers=4, api_url=VkMessageSender.API_URL):
         self._vk_session = vk_api.VkApi(token=group_token)
-        self._vk_api = self._vk_session.get_api()
+        self._vk_session.RPS_DELAY = VkBot.RPS_DELAY
         self._longpoll = VkLongPoll(self._vk_session)
-        self._state = VkBot.GREETINGS
+        self._workers = KeyOrderedWorkerPool(self._handle_event, workers)
+        self._sender = VkMessageSender(
+            group_token, api_url, requests_per_second=1 / VkBot.RPS_DELAY
+        )
 
     def start(self):
+        """
+        Events are handled by a pool of workers: events of one user
+        are processed in order, events of different users concurrently.
+        """
+        self._sender.start()
+        self._workers.start()
         for event in self._longpoll.listen():
             if event.type == VkEventType.MESSAGE_NEW and event.to_me:
-                if self._state == VkBot.GREETINGS:
-                    self._greetings_state(event)
-                elif self._state == VkBot.MENU_CHOOSING:
-                    self._menu_choosing_state(event)
-                elif self._state == VkBot.USER_ANSWER_PROCESSING:
-                    self._answer_processing_state(event)
-
-    def _greetings_state(self, event):
-
+                self._workers.submit(event.user_id, event)
+
+    def _handle_event(self, event):
+        """
+        State methods return the new state of the user or None if it has not changed.
+        All writes made during the event are sent to redis in one round trip.
+        Replies are sent after the writes succeed, so a user does not get
+        a question whose state was not saved, on an error the user is asked
+        to try again.
+        """
+        VkBot._outbox.messages = []
+        try:
+            self._handle_state(event)
+        except redis_exceptions.RedisError as e:
+            logger.error(
+                'An error occurred during handling event. '
+                'User_id: {}, error: {}'.format(event.user_id, str(e))
+            )
+            VkBot._outbox.messages = [
+                {'user_id': event.user_id, 'message': 'Пожалуйста, попробуйте снова.'}
+            ]
+        messages, VkBot._outbox.messages = VkBot._outbox.messages, None
+        for message in messages:
+            self._sender.send(**message)
+
+    def _handle_state(self, event):
+        user_state = UserState.get_by_user_id(VkBot.PLATFORM, event.user_id)
+        if user_state.state == VkBot.MENU_CHOOSING:
+            state_handler = self._menu_choosing_state
+        elif user_state.state == VkBot.USER_ANSWER_PROCESSING:
+            state_handler = self._answer_processing_state
+        elif user_state.state == VkBot.CATEGORY_CHOOSING:
+            state_handler = self._category_choosing_state
+        else:
+            state_handler = self._greetings_state
+
+        with HANDLER_LATENCY.time(
+            platform=VkBot.PLATFORM, state=state_handler.__name__.lstrip('_')
+        ), Storage.engine.pipeline():
+            new_state = state_handler(event)
+
+            if new_state is not None and new_state != user_state.state:
+                user_state.state = new_state
+                user_state.save_to_db()
+
+    def _send(self, **message):
+        """
+        Queue a reply until the event is handled.
+        """
+        VkBot._outbox.messages.append(message)
+
+    @staticmethod
+    def _get_menu_keyboard():
         keyboard = VkKeyboard()
         keyboard.add_button('Новый вопрос', color=VkKeyboardColor.DEFAULT)
         keyboard.add_button('Сдаться', color=VkKeyboardColor.DEFAULT)
         keyboard.add_line()
         keyboard.add_button('Мой счет', color=VkKeyboardColor.DEFAULT)
+        keyboard.add_button('Рейтинг', color=VkKeyboardColor.DEFAULT)
+        keyboard.add_line()
+        keyboard.add_button('Категория', color=VkKeyboardColor.DEFAULT)
+        return keyboard.get_keyboard()
 
-        self._vk_api.messages.send(
+    def _greetings_state(self, event):
+        self._send(
             user_id=event.user_id,
             message='Привет! Я бот для викторин!',
-            keyboard=keyboard.get_keyboard(),
-            random_id=random.randint(1, 1000),
+            keyboard=VkBot._get_menu_keyboard(),
         )
-        self._state = VkBot.MENU_CHOOSING
+        return VkBot.MENU_CHOOSING
 
     def _menu_choosing_state(self, event):
         if event.text == 'Новый вопрос':
 
             try:
-                quiz_question = QuizQuestion.get_random_question_from_storage()
+                question_id, question_text = QuestionDraw.draw_question(event.user_id)
             except (redis_exceptions.DataError, ValueError) as e:
                 logger.error(
                     'An error occurred during object initialization. '
-                    'User_id: {}, error: {}'.format(
-                        event.user_id.message.chat_id, str(e)
-                    )
+                    'User_id: {}, error: {}'.format(event.user_id, str(e))
+                )
+                self._send(
+                    user_id=event.user_id, message='Пожалуйста, попробуйте снова.'
                 )
-                self._vk_api.messages.send(
+                return VkBot.MENU_CHOOSING
+
+            return self._ask_question(event.user_id, question_id, question_text)
+
+        elif event.text == '/topic' or event.text.startswith('/topic '):
+
+            topic = event.text.partition(' ')[2].strip()
+            if not topic:
+                self._send(
                     user_id=event.user_id,
-                    message='Пожалуйста, попробуйте снова.',
-                    random_id=random.randint(1, 1000),
+                    message='Укажите тему, например: /topic космос',
                 )
-                self._state = VkBot.MENU_CHOOSING
-                return None
+                return VkBot.MENU_CHOOSING
 
             try:
-                user_question = UserQuestion(
-                    event.user_id, json.dumps(dataclasses.asdict(quiz_question))
+                question_id, question_text = QuestionDraw.draw_question_on_topic(topic)
+            except ValueError as e:
+                logger.debug(
+                    'Question on topic was not found. '
+                    'User_id: {}, error: {}'.format(event.user_id, str(e))
+                )
+                self._send(
+                    user_id=event.user_id, message='Не нашлось вопросов на эту тему.'
                 )
-                user_question.save_to_db()
+                return VkBot.MENU_CHOOSING
             except redis_exceptions.DataError as e:
                 logger.error(
-                    'An error occurred during saving data to database.'
-                    'User_id: {}, record: {}, error: {}'.format(
-                        event.user_id.message.chat_id,
-                        dataclasses.asdict(quiz_question),
-                        str(e),
-                    )
+                    'An error occurred during object initialization. '
+                    'User_id: {}, error: {}'.format(event.user_id, str(e))
                 )
-                self._vk_api.messages.send(
-                    user_id=event.user_id,
-                    message='Пожалуйста, попробуйте снова.',
-                    random_id=random.randint(1, 1000),
+                self._send(
+                    user_id=event.user_id, message='Пожалуйста, попробуйте снова.'
                 )
-                self._state = VkBot.MENU_CHOOSING
-                return None
+                return VkBot.MENU_CHOOSING
 
-            self._vk_api.messages.send(
-                user_id=event.user_id,
-                message=quiz_question.question,
-                random_id=random.randint(1, 1000),
-            )
-            self._state = VkBot.USER_ANSWER_PROCESSING
+            return self._ask_question(event.user_id, question_id, question_text)
 
         elif event.text == 'Мой счет':
 
             user_rating = UserRating(event.user_id)
             score = user_rating.get_rating()
 
-            self._vk_api.messages.send(
-                user_id=event.user_id,
-                message=f'Ваш  результат: {score}',
-                random_id=random.randint(1, 1000),
-            )
+            self._send(user_id=event.user_id, message=f'Ваш  результат: {score}')
 
-            self._state = VkBot.MENU_CHOOSING
-            return None
+            return VkBot.MENU_CHOOSING
 
-    def _answer_processing_state(self, event):
+        elif event.text == 'Рейтинг':
 
-        user_question = UserQuestion.get_by_user_id(event.user_id)
+            top = Leaderboard(Leaderboard.GLOBAL).get_top()
+            user_ranks = Leaderboard.get_user_ranks(event.user_id)
+            display_names = Leaderboard.get_display_names(
+                [user_id for user_id, _ in top]
+            )
 
-        if event.text == 'Сдаться':
+            self._send(
+                user_id=event.user_id,
+                message=format_leaderboard(top, user_ranks, display_names),
+            )
 
-            if user_question.question is None:
-                self._vk_api.messages.send(
-                    user_id=event.user_id,
-                    message='Пожалуйста, попробуйте снова.',
-                    random_id=random.randint(1, 1000),
+            return VkBot.MENU_CHOOSING
+
+        elif event.text == 'Категория':
+
+            try:
+                categories = QuizQuestion.get_categories()
+            except redis_exceptions.RedisError as e:
+                logger.error(
+                    'An error occurred during fetching categories. '
+                    'User_id: {}, error: {}'.format(event.user_id, str(e))
+                )
+                self._send(
+                    user_id=event.user_id, message='Пожалуйста, попробуйте снова.'
                 )
-                self._state = VkBot.MENU_CHOOSING
-                return None
+                return VkBot.MENU_CHOOSING
 
-            quiz_question_dict = json.loads(user_question.question)
-            quiz_question = QuizQuestion(**quiz_question_dict)
+            keyboard = VkKeyboard(one_time=True)
+            for number, label in enumerate(get_category_choices(categories)):
+                if number:
+                    keyboard.add_line()
+                keyboard.add_button(label, color=VkKeyboardColor.DEFAULT)
 
-            self._vk_api.messages.send(
+            self._send(
                 user_id=event.user_id,
-                message=f'Внимание, правильный ответ: {quiz_question.answer}'
-                f'Для следующего вопроса нажмите «Новый вопрос».',
-                random_id=random.randint(1, 1000),
+                message='Выберите категорию вопросов:',
+                keyboard=keyboard.get_keyboard(),
             )
 
-            self._state = VkBot.MENU_CHOOSING
+            return VkBot.CATEGORY_CHOOSING
+
+        return None
+
+    def _category_choosing_state(self, event):
+        """
+        Choices are built again from categories, as they were on the keyboard.
+        """
+        category_choices = get_category_choices(QuizQuestion.get_categories())
+        if event.text not in category_choices:
+            self._send(
+                user_id=event.user_id, message='Выберите категорию с клавиатуры.'
+            )
             return None
 
-        if user_question.question is None:
-            self._vk_api.messages.send(
+        category = category_choices[event.text]
+        UserCategory(event.user_id, category).save_to_db()
+        self._send(
+            user_id=event.user_id,
+            message=format_category(category),
+            keyboard=VkBot._get_menu_keyboard(),
+        )
+        return VkBot.MENU_CHOOSING
+
+    def _ask_question(self, user_id, question_id, question_text):
+        user_question = UserQuestion(user_id, question_id)
+        user_question.save_to_db()
+
+        self._send(user_id=user_id, message=question_text)
+        return VkBot.USER_ANSWER_PROCESSING
+
+    def _answer_processing_state(self, event):
+
+        answer = UserQuestion.get_answer_by_user_id(event.user_id)
+
+        if event.text == 'Сдаться':
+
+            if answer is None:
+                self._send(
+                    user_id=event.user_id, message='Пожалуйста, попробуйте снова.'
+                )
+                return VkBot.MENU_CHOOSING
+
+            ANSWERS.inc(platform=VkBot.PLATFORM, result='gave_up')
+            self._send(
                 user_id=event.user_id,
-                message='Пожалуйста, попробуйте снова.',
-                random_id=random.randint(1, 1000),
+                message=f'Внимание, правильный ответ: {answer.text}'
+                f'Для следующего вопроса нажмите «Новый вопрос».',
             )
-            self._state = VkBot.MENU_CHOOSING
-            return None
 
-        quiz_question_dict = json.loads(user_question.question)
-        quiz_question = QuizQuestion(**quiz_question_dict)
+            return VkBot.MENU_CHOOSING
 
-        normalized_answer_from_user = event.text.lower().strip()
-        normalized_answer_from_base = quiz_question.answer.lower().strip()
+        if answer is None:
+            self._send(user_id=event.user_id, message='Пожалуйста, попробуйте снова.')
+            return VkBot.MENU_CHOOSING
 
-        if normalized_answer_from_base == normalized_answer_from_user:
+        if answer.is_correct(event.text):
+            ANSWERS.inc(platform=VkBot.PLATFORM, result='correct')
             user_rating = UserRating(event.user_id)
             user_rating.increase_rating()
 
-            self._vk_api.messages.send(
+            self._send(
                 user_id=event.user_id,
                 message='Правильно! Поздравляю! '
                 'Для следующего вопроса нажмите «Новый вопрос».',
-                random_id=random.randint(1, 1000),
             )
-            self._state = VkBot.MENU_CHOOSING
-            return None
+            return VkBot.MENU_CHOOSING
 
-        self._vk_api.messages.send(
-            user_id=event.user_id,
-            message='Неправильно... Попробуешь ещё раз?',
-            random_id=random.randint(1, 1000),
-        )
+        ANSWERS.inc(platform=VkBot.PLATFORM, result='wrong')
+        self._send(user_id=event.user_id, message='Неправильно... Попробуешь ещё раз?')
 
-        self._state = VkBot.USER_ANSWER_PROCESSING
-        return None
+        return VkBot.USER_ANSWER_PROCESSING
@@ -0,0 +1,168 @@
+import json
+import time
+import queue
+import random
+import logging
+import threading
+import collections
+
+import requests
+
+logger = logging.getLogger(__name__)
+
+
+class VkApiError(Exception):
+    def __init__(self, code, message):
+        super().__init__(f'VK API error {code}: {message}')
+        self.code = code
+
+
+class VkMessageSender:
+    """
+    Outbound queue for messages.send calls, served by a background thread.
+    Queued messages are coalesced: up to BATCH_SIZE of them are sent
+    with one 'execute' request. Requests are spaced to stay within
+    requests_per_second, transient errors are retried with backoff.
+    """
+
+    API_URL = 'https://api.vk.com'
+    API_VERSION = '5.92'
+    # 'execute' method allows up to 25 API calls in one request.
+    BATCH_SIZE = 25
+    # Too many requests per second, internal server error, unknown error.
+    TRANSIENT_ERROR_CODES = (1, 6, 10)
+    LATENCY_WINDOW = 1000
+    MAX_RANDOM_ID = 2147483647
+
+    def __init__(
+        self,
+        token,
+        api_url=API_URL,
+        requests_per_second=20,
+        max_retries=3,
+        queue_size=10000,
+    ):
+        self._token = token
+        self._api_url = api_url
+        self._request_interval = 1 / requests_per_second
+        self._max_retries = max_retries
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._http = requests.Session()
+        self._last_request_at = 0
+        self._thread = threading.Thread(target=self._work, daemon=True)
+        self._stopped = threading.Event()
+        self._metrics_lock = threading.Lock()
+        self._latencies = collections.deque(maxlen=VkMessageSender.LATENCY_WINDOW)
+        self._counters = {'sent': 0, 'failed': 0, 'retries': 0, 'requests': 0}
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        """
+        Send everything which is already queued and stop the background thread.
+        """
+        self._stopped.set()
+        self._thread.join()
+
+    def send(self, user_id, message, keyboard=None):
+        params = {
+            'user_id': user_id,
+            'message': message,
+            'random_id': random.randint(1, VkMessageSender.MAX_RANDOM_ID),
+        }
+        if keyboard is not None:
+            params['keyboard'] = keyboard
+        self._queue.put((time.monotonic(), params))
+
+    def get_metrics(self):
+        with self._metrics_lock:
+            latencies = sorted(self._latencies)
+            metrics = dict(self._counters)
+        metrics['queue_depth'] = self._queue.qsize()
+        metrics['latency_avg'] = sum(latencies) / len(latencies) if latencies else 0
+        metrics['latency_p95'] = (
+            latencies[int(len(latencies) * 0.95)] if latencies else 0
+        )
+        metrics['latency_max'] = latencies[-1] if latencies else 0
+        return metrics
+
+    def _work(self):
+        while not (self._stopped.is_set() and self._queue.empty()):
+            batch = self._take_batch()
+            if batch:
+                self._send_batch(batch)
+
+    def _take_batch(self):
+        try:
+            batch = [self._queue.get(timeout=0.1)]
+        except queue.Empty:
+            return []
+        while len(batch) < VkMessageSender.BATCH_SIZE:
+            try:
+                batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _send_batch(self, batch):
+        calls = ','.join(
+            'API.messages.send({})'.format(json.dumps(params, ensure_ascii=False))
+            for _, params in batch
+        )
+        code = f'return [{calls}];'
+
+        for attempt in range(self._max_retries + 1):
+            try:
+                response = self._call('execute', {'code': code})
+                break
+            except (requests.RequestException, VkApiError) as e:
+                transient = not isinstance(e, VkApiError) or (
+                    e.code in VkMessageSender.TRANSIENT_ERROR_CODES
+                )
+                if not transient or attempt == self._max_retries:
+                    logger.error(
+                        'Failed to send {} messages, error: {}'.format(
+                            len(batch), str(e)
+                        )
+                    )
+                    self._update_metrics(batch, failed=len(batch))
+                    return None
+                self._update_metrics([], retries=1)
+                time.sleep(self._request_interval * pow(2, attempt))
+
+        execute_errors = response.get('execute_errors', [])
+        for error in execute_errors:
+            logger.error(
+                'Failed to send message, error: {}'.format(error.get('error_msg'))
+            )
+        self._update_metrics(batch, failed=len(execute_errors))
+
+    def _call(self, method, params):
+        delay = self._request_interval - (time.monotonic() - self._last_request_at)
+        if delay > 0:
+            time.sleep(delay)
+        self._last_request_at = time.monotonic()
+
+        with self._metrics_lock:
+            self._counters['requests'] += 1
+
+        data = dict(params, access_token=self._token, v=VkMessageSender.API_VERSION)
+        http_response = self._http.post(
+            f'{self._api_url}/method/{method}', data=data, timeout=10
+        )
+        http_response.raise_for_status()
+        response = http_response.json()
+        if 'error' in response:
+            raise VkApiError(
+                response['error'].get('error_code'), response['error'].get('error_msg')
+            )
+        return response
+
+    def _update_metrics(self, batch, failed=0, retries=0):
+        now = time.monotonic()
+        with self._metrics_lock:
+            self._counters['sent'] += len(batch) - failed
+            self._counters['failed'] += failed
+            self._counters['retries'] += retries
+            self._latencies.extend(now - enqueued_at for enqueued_at, _ in batch)
@@ -0,0 +1,137 @@
+import os
+import json
+import signal
+import socket
+import logging
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+logger = logging.getLogger(__name__)
+
+
+class WebhookRequestHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        if self.path != self.server.url_path:
+            self.send_error(404)
+            return None
+
+        try:
+            content_length = int(self.headers.get('Content-Length', 0))
+            update = json.loads(self.rfile.read(content_length).decode())
+        except ValueError:
+            self.send_error(400)
+            return None
+
+        # Update is acknowledged even if it fails,
+        # otherwise telegram sends it again and again.
+        try:
+            self.server.handler.process_update(update)
+        except Exception as e:
+            logger.error(f'Update {str(update)} caused error {str(e)}.')
+
+        self.send_response(200)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+class PreforkWebhookServer:
+    """
+    HTTP server which passes decoded JSON of updates posted to url_path
+    to the handler of its worker process. Listening socket is bound
+    before workers are forked, so they share the port and the kernel
+    spreads connections across them. A worker handles one update at a time,
+    a worker which exits is replaced by a worker with the same index.
+    """
+
+    def __init__(self, create_handler, url_path, host='0.0.0.0', port=8443, workers=4):
+        """
+        :param create_handler: function(worker_index) called in every worker
+        after fork, so connections are not shared between processes,
+        worker_index is from 0 to workers - 1, returns an object
+        with process_update(update) method, which handles an update,
+        and stop() method, which is called when the worker stops.
+        """
+        if workers < 1:
+            raise ValueError(f'Server needs at least 1 worker, got {workers}.')
+        self.create_handler = create_handler
+        self.url_path = url_path
+        self.host = host
+        self.port = port
+        self.workers = workers
+        self._socket = None
+        self._worker_indexes = {}
+        self._stopping = False
+
+    def serve_forever(self):
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._socket.bind((self.host, self.port))
+        self._socket.listen(128)
+        logger.info(
+            f'Webhook server listens on {self.host}:{self.port}, '
+            f'workers: {self.workers}.'
+        )
+
+        signal.signal(signal.SIGTERM, self._stop)
+        signal.signal(signal.SIGINT, self._stop)
+        for worker_index in range(self.workers):
+            self._start_worker(worker_index)
+
+        while self._worker_indexes:
+            try:
+                pid, status = os.wait()
+            except ChildProcessError:
+                break
+            except InterruptedError:
+                continue
+            worker_index = self._worker_indexes.pop(pid, None)
+            if not self._stopping and worker_index is not None:
+                logger.error(f'Webhook worker {pid} exited with status {status}.')
+                self._start_worker(worker_index)
+        self._socket.close()
+
+    def _stop(self, signal_number, frame):
+        self._stopping = True
+        for pid in self._worker_indexes:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    def _start_worker(self, worker_index):
+        pid = os.fork()
+        if pid:
+            self._worker_indexes[pid] = worker_index
+            return None
+
+        exit_code = 0
+        try:
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+            self._serve_updates(worker_index)
+        except Exception as e:
+            logger.error(f'Webhook worker failed with error {str(e)}.')
+            exit_code = 1
+        finally:
+            os._exit(exit_code)
+
+    def _serve_updates(self, worker_index):
+        server = HTTPServer(
+            (self.host, self.port), WebhookRequestHandler, bind_and_activate=False
+        )
+        server.socket.close()
+        server.socket = self._socket
+        server.url_path = self.url_path
+        server.handler = self.create_handler(worker_index)
+
+        # Update being handled is finished before the worker stops.
+        def stop(signal_number, frame):
+            threading.Thread(target=server.shutdown).start()
+
+        signal.signal(signal.SIGTERM, stop)
+        try:
+            server.serve_forever()
+        finally:
+            server.handler.stop()
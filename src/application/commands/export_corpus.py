@@ -0,0 +1,27 @@
+import time
+import logging
+
+from application.common.corpus import CorpusFile
+from application.models import QuizQuestion
+
+logger = logging.getLogger(__name__)
+
+
+def run_command(corpus_path, batch_size=1000):
+    """
+    Export questions from storage into a memory-mapped corpus file,
+    which bots read questions from instead of storage.
+    """
+    started_at = time.monotonic()
+    questions_count = CorpusFile.write(
+        corpus_path,
+        QuizQuestion.STORED_FIELDS,
+        QuizQuestion.get_all_stored_fields(batch_size),
+        QuizQuestion.get_questions_count(),
+        get_group=lambda fields: fields.get('category'),
+    )
+    logger.info(
+        'Corpus export finished, {} questions were written to {} in {:.1f} s.'.format(
+            questions_count, corpus_path, time.monotonic() - started_at
+        )
+    )
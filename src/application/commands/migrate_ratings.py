@@ -0,0 +1,28 @@
+import logging
+
+from application.common.storage import Storage
+from application.models import Leaderboard, UserRating
+
+logger = logging.getLogger(__name__)
+
+
+def run_command(batch_size=1000):
+    """
+    Copy existing users' ratings into the all-time leaderboard.
+    """
+    prefix = f'{UserRating.TABLE_PREFIX}_'
+    prefix_length = len(prefix)
+    migrated_count = 0
+
+    for keys in Storage.engine.scan_keys(f'{prefix}*', batch_size):
+        ratings = {
+            key[prefix_length:]: int(rating)
+            for key, rating in zip(keys, Storage.engine.get_many(keys))
+            if rating is not None
+        }
+        if ratings:
+            Leaderboard.import_ratings(ratings)
+            migrated_count += len(ratings)
+        logger.debug(f'{migrated_count} ratings were migrated.')
+
+    logger.info(f'Ratings migration finished, {migrated_count} ratings were migrated.')
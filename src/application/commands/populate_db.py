@@ -1,23 +1,47 @@
 import os
 import sys
+import time
+import hashlib
 import itertools
 import logging
+from concurrent import futures
 
 from redis import exceptions as redis_exceptions
 
-from application.models import QuizQuestion
-from application.parser import QuizQuestionsFileParser
+from application.common.metrics import Counter, Histogram
+from application.models import QuizQuestion, QuizQuestionsFile
+from application.parser import QuizQuestionsChunkedFileParser
 
 logger = logging.getLogger(__name__)
+# Logs every converted question, sampled in production.
+records_logger = logging.getLogger(f'{__name__}.records')
 
+FILES_PARSED = Counter('quiz_populate_files_parsed_total', 'Parsed questions files.')
+QUESTIONS_PARSED = Counter(
+    'quiz_populate_questions_parsed_total', 'Questions parsed from files.'
+)
+QUESTIONS_SAVED = Counter(
+    'quiz_populate_questions_saved_total', 'Questions written into database.'
+)
+SAVE_LATENCY = Histogram(
+    'quiz_populate_save_seconds', 'Duration of writing a batch of questions.'
+)
 
-def run_command(quiz_questions_directory, default_encoding, files_limit=None):
+
+def run_command(
+    quiz_questions_directory,
+    default_encoding,
+    files_limit=None,
+    workers=1,
+    batch_size=500,
+    incremental=False,
+    reindex=False,
+):
     """
     Populate redis database with quiz questions from provided files.
+    Reindex parses all files incrementally, ignoring the manifest.
     """
-    logger.debug(
-        'Attempt to read files from directory {}.'.format(quiz_questions_directory)
-    )
+    logger.debug('Attempt to read files from directory %s.', quiz_questions_directory)
     try:
         data_directory = quiz_questions_directory
         files_list = [
@@ -32,8 +56,17 @@ def run_command(quiz_questions_directory, default_encoding, files_limit=None):
         sys.exit(1)
 
     logger.debug('DB population started.')
-    logger.debug(files_list)
-    populate_db_from_files(files_list, default_encoding, files_limit)
+    logger.debug('Files to parse: %s', files_list)
+    if incremental or reindex:
+        populate_db_incrementally(
+            data_directory, files_list, default_encoding, files_limit, workers, reindex
+        )
+    elif workers > 1:
+        populate_db_from_files_in_parallel(
+            files_list, default_encoding, files_limit, workers, batch_size
+        )
+    else:
+        populate_db_from_files(files_list, default_encoding, files_limit)
 
 
 def populate_db_from_files(quiz_questions_filepaths, default_encoding, files_limit):
@@ -47,13 +80,246 @@ def populate_db_from_files(quiz_questions_filepaths, default_encoding, files_lim
         quiz_questions_filepaths, default_encoding
     )
 
+    started_at = time.monotonic()
     for quiz_questions_list in itertools.islice(
         quiz_questions_lists_generator, files_limit
     ):
+        count_parsed_file(quiz_questions_list)
+        save_quiz_questions_batch(quiz_questions_list)
+    log_ingestion_rates(started_at)
+
+
+def populate_db_from_files_in_parallel(
+    quiz_questions_filepaths, default_encoding, files_limit, workers, batch_size
+):
+    """
+    :param quiz_questions_filepaths: list of filepaths to files with questions
+    :param default_encoding: target files encoding
+    :param files_limit: if we want to limit how many files we want to parse
+    :param workers: number of processes which parse files
+    :param batch_size: how many questions are written into database per round trip
+    Parse files in a pool of processes and save questions into database
+    in pipelined batches. At most 2 * workers files are parsed at the same time,
+    so memory usage does not depend on the number of files.
+    """
+    filepaths = iter(itertools.islice(quiz_questions_filepaths, files_limit))
+    started_at = time.monotonic()
+    batch = []
+
+    with futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        pending = {
+            executor.submit(parse_quiz_question_file_safely, filepath, default_encoding)
+            for filepath in itertools.islice(filepaths, 2 * workers)
+        }
+        while pending:
+            done, pending = futures.wait(pending, return_when=futures.FIRST_COMPLETED)
+            for future in done:
+                quiz_questions_list = future.result()
+                count_parsed_file(quiz_questions_list)
+                batch.extend(quiz_questions_list)
+
+                if len(batch) >= batch_size:
+                    save_quiz_questions_batch(batch)
+                    batch = []
+
+                next_filepath = next(filepaths, None)
+                if next_filepath is not None:
+                    pending.add(
+                        executor.submit(
+                            parse_quiz_question_file_safely,
+                            next_filepath,
+                            default_encoding,
+                        )
+                    )
+
+    if batch:
+        save_quiz_questions_batch(batch)
+
+    log_ingestion_rates(started_at)
+
+
+def populate_db_incrementally(
+    data_directory,
+    quiz_questions_filepaths,
+    default_encoding,
+    files_limit,
+    workers,
+    reindex=False,
+):
+    """
+    :param data_directory: directory with files, file names in manifest
+    are relative to it
+    :param quiz_questions_filepaths: list of filepaths to files with questions
+    :param default_encoding: target files encoding
+    :param files_limit: if we want to limit how many files we want to parse,
+    modified files beyond the limit are skipped until the next run
+    :param workers: number of processes which parse files,
+    files are parsed in this process when it is 1 or less
+    :param reindex: parse all files, rewrite stored questions and manifest,
+    so data derived from questions on saving, e.g. answer variants,
+    search index and category buckets, is rebuilt
+    Parse only files which were added or changed since the previous run
+    and remove questions of deleted files. Files with the same size
+    and modification time as in manifest are not read at all.
+    """
+    started_at = time.monotonic()
+    manifest = QuizQuestionsFile.get_manifest()
+    filepaths_by_name = {
+        os.path.relpath(filepath, data_directory): filepath
+        for filepath in quiz_questions_filepaths
+    }
+
+    modified_files = []
+    for name, filepath in filepaths_by_name.items():
         try:
+            quiz_questions_file = get_quiz_questions_file(name, filepath)
+        except OSError as e:
+            logger.error(
+                'An error has occurred during reading file.'
+                'File: {}, error: {}'.format(filepath, str(e))
+            )
+            continue
+
+        stored_file = manifest.get(name)
+        if reindex:
+            quiz_questions_file.digest = get_file_digest(filepath)
+            modified_files.append(quiz_questions_file)
+            continue
+        if not quiz_questions_file.is_modified(stored_file):
+            continue
+
+        quiz_questions_file.digest = get_file_digest(filepath)
+        if stored_file is not None and stored_file.digest == quiz_questions_file.digest:
+            quiz_questions_file.update_manifest()
+            continue
+        modified_files.append(quiz_questions_file)
+
+    skipped_files = modified_files[files_limit:] if files_limit is not None else []
+    modified_files = modified_files[:files_limit]
+    if skipped_files:
+        logger.warning(
+            '{} modified files are skipped because of files limit {}.'.format(
+                len(skipped_files), files_limit
+            )
+        )
+    removed_count = 0
+
+    if workers > 1:
+        with futures.ProcessPoolExecutor(max_workers=workers) as executor:
+            parsed_files = {
+                executor.submit(
+                    parse_quiz_question_file,
+                    filepaths_by_name[quiz_questions_file.name],
+                    default_encoding,
+                ): quiz_questions_file
+                for quiz_questions_file in modified_files
+            }
+            for future in futures.as_completed(parsed_files):
+                removed_count += save_quiz_questions_file(
+                    parsed_files[future], future.result, reindex
+                )
+    else:
+        for quiz_questions_file in modified_files:
+            removed_count += save_quiz_questions_file(
+                quiz_questions_file,
+                lambda: parse_quiz_question_file(
+                    filepaths_by_name[quiz_questions_file.name], default_encoding
+                ),
+                reindex,
+            )
+
+    deleted_files = [
+        stored_file
+        for name, stored_file in manifest.items()
+        if name not in filepaths_by_name
+    ]
+    for stored_file in deleted_files:
+        removed_count += len(stored_file.delete_from_db())
+
+    logger.info(
+        'DB population finished. Files: {} modified, {} skipped, {} deleted, '
+        '{} unchanged, questions saved: {}, removed: {}, elapsed: {:.2f}s.'.format(
+            len(modified_files),
+            len(skipped_files),
+            len(deleted_files),
+            len(filepaths_by_name) - len(modified_files) - len(skipped_files),
+            QUESTIONS_SAVED.get(),
+            removed_count,
+            time.monotonic() - started_at,
+        )
+    )
+
+
+def save_quiz_questions_file(
+    quiz_questions_file, get_quiz_questions_list, rewrite=False
+):
+    """
+    :param quiz_questions_file: QuizQuestionsFile which questions are saved
+    :param get_quiz_questions_list: function, which returns parsed questions
+    of the file or raises an error of parsing
+    :param rewrite: replace stored fields of questions which already exist
+    :return: number of questions of the file removed from storage.
+    """
+    try:
+        quiz_questions_list = get_quiz_questions_list()
+        count_parsed_file(quiz_questions_list)
+        with SAVE_LATENCY.time():
+            question_ids = QuizQuestion.bulk_save_to_db(quiz_questions_list, rewrite)
+        QUESTIONS_SAVED.inc(len(quiz_questions_list))
+        return len(quiz_questions_file.save_to_db(question_ids))
+    except (IOError, redis_exceptions.RedisError) as e:
+        logger.error(
+            'An error has occurred during saving file.'
+            'File: {}, error: {}'.format(quiz_questions_file.name, str(e))
+        )
+        return 0
+
+
+def get_quiz_questions_file(name, filepath):
+    """
+    :return: QuizQuestionsFile without digest, which is computed only
+    for files whose size or modification time changed.
+    """
+    stat = os.stat(filepath)
+    return QuizQuestionsFile(name, stat.st_size, stat.st_mtime_ns, None)
+
+
+def get_file_digest(filepath, chunk_size=1024 * 1024):
+    digest = hashlib.sha1()
+    with open(filepath, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def save_quiz_questions_batch(quiz_questions_list):
+    try:
+        with SAVE_LATENCY.time():
             QuizQuestion.bulk_save_to_db(quiz_questions_list)
-        except redis_exceptions.RedisError as e:
-            logger.error(str(e))
+        QUESTIONS_SAVED.inc(len(quiz_questions_list))
+    except redis_exceptions.RedisError as e:
+        logger.error(str(e))
+
+
+def count_parsed_file(quiz_questions_list):
+    FILES_PARSED.inc()
+    QUESTIONS_PARSED.inc(len(quiz_questions_list))
+
+
+def log_ingestion_rates(started_at):
+    elapsed = max(time.monotonic() - started_at, 1e-9)
+    files_count = FILES_PARSED.get()
+    questions_count = QUESTIONS_SAVED.get()
+    logger.info(
+        'DB population finished. Files: {}, questions: {}, elapsed: {:.2f}s, '
+        '{:.1f} files/s, {:.1f} questions/s.'.format(
+            files_count,
+            questions_count,
+            elapsed,
+            files_count / elapsed,
+            questions_count / elapsed,
+        )
+    )
 
 
 def parse_quiz_questions_files(quiz_questions_filepaths, encoding):
@@ -71,20 +337,40 @@ def parse_quiz_questions_files(quiz_questions_filepaths, encoding):
             continue
 
 
+def parse_quiz_question_file_safely(quiz_question_filepath, encoding):
+    """
+    Same as parse_quiz_question_file, but returns empty list on error.
+    Used by worker processes, so errors are logged where they happened.
+    """
+    try:
+        return parse_quiz_question_file(quiz_question_filepath, encoding)
+    except (IOError, FileNotFoundError) as e:
+        logger.error(
+            'An error has occurred during parsing file.'
+            'File: {}, error: {}'.format(quiz_question_filepath, str(e))
+        )
+        return []
+
+
 def parse_quiz_question_file(quiz_question_filepath, encoding):
     """
     :param quiz_question_filepath: filepath to concrete file with questions
     :param encoding: default encoding of concrete file
-    :return: list of QuizQuestion objects.
+    :return: list of QuizQuestion objects. Questions without
+    a championship header are categorized by the file name.
     """
+    default_category = os.path.splitext(os.path.basename(quiz_question_filepath))[0]
     with open(quiz_question_filepath, 'r', encoding=encoding) as f:
-        quiz_question_file_parser = QuizQuestionsFileParser(f)
+        quiz_question_file_parser = QuizQuestionsChunkedFileParser(f)
 
         question_list = [
             question
             for question in convert_question_dict_to_object(quiz_question_file_parser)
         ]
-        return question_list
+    for question in question_list:
+        if not question.category:
+            question.category = default_category
+    return question_list
 
 
 def convert_question_dict_to_object(quiz_question_file_parser):
@@ -95,11 +381,10 @@ def convert_question_dict_to_object(quiz_question_file_parser):
     for question_dict in quiz_question_file_parser:
         try:
             quiz_question = QuizQuestion(**question_dict)
-            logger.debug(
-                'Question {} from file {} converted into '
-                'model object successfully.'.format(
-                    quiz_question, quiz_question_file_parser.open_file.name
-                )
+            records_logger.debug(
+                'Question %r from file %s converted into model object successfully.',
+                quiz_question,
+                quiz_question_file_parser.open_file.name,
             )
             yield quiz_question
         except ValueError as e:
@@ -0,0 +1,11 @@
+from application.bot.telegram_async_bot import AsyncTelegramBot
+
+
+def run_command(
+    telegram_bot_token,
+    redis_settings,
+    concurrency_limit,
+    api_url=AsyncTelegramBot.API_URL,
+):
+    bot = AsyncTelegramBot(telegram_bot_token, concurrency_limit, api_url)
+    bot.start(redis_settings)
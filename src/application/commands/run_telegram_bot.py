@@ -1,6 +1,63 @@
 from application.bot.telegram_bot import TelegramBot
+from application.bot.webhook import PreforkWebhookServer
+from application.common.metrics import start_metrics_server
+from application.models import UserCategory, UserQuestion
 
 
-def run_command(telegram_bot_token):
-    bot = TelegramBot(telegram_bot_token)
+def run_command(telegram_bot_token, api_url=None, flush_interval=0, flush_size=100):
+    """
+    Conversation states are kept in storage, so they survive restarts.
+    """
+    bot = TelegramBot(
+        telegram_bot_token,
+        api_url,
+        store_conversations=True,
+        flush_interval=flush_interval,
+        flush_size=flush_size,
+    )
     bot.start()
+
+
+def run_webhook_command(
+    telegram_bot_token,
+    webhook_url,
+    host,
+    port,
+    workers,
+    api_url=None,
+    flush_interval=0,
+    flush_size=100,
+    metrics_port=None,
+):
+    """
+    Serve updates which telegram posts to webhook_url in several processes.
+    Every worker serves its own metrics on metrics_port + index of the worker.
+    Conversation states are kept in storage, so any process serves any chat.
+    Path of the webhook is the token, so only telegram knows it.
+    States are written behind and answers and categories are cached
+    with a single worker only: next update of a chat may reach another worker
+    before the state is written, and a worker does not know that another one
+    gave the user a new question or saved the user's category.
+    """
+    if workers > 1:
+        flush_interval = 0
+        UserQuestion.initialize_cache(0, None)
+        UserCategory.initialize_cache(0, None)
+    url_path = f'/{telegram_bot_token}'
+    TelegramBot(telegram_bot_token, api_url).set_webhook(
+        f'{webhook_url.rstrip("/")}{url_path}', max_connections=workers
+    )
+
+    def create_handler(worker_index):
+        if metrics_port:
+            start_metrics_server(metrics_port + worker_index)
+        return TelegramBot(
+            telegram_bot_token,
+            api_url,
+            store_conversations=True,
+            flush_interval=flush_interval,
+            flush_size=flush_size,
+        )
+
+    server = PreforkWebhookServer(create_handler, url_path, host, port, workers)
+    server.serve_forever()
@@ -1,6 +1,6 @@
 from application.bot.vk_bot import VkBot
 
 
-def run_command(vk_group_token):
-    vk_bot = VkBot(vk_group_token)
+def run_command(vk_group_token, workers, vk_api_url):
+    vk_bot = VkBot(vk_group_token, workers, vk_api_url)
     vk_bot.start()
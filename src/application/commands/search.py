@@ -0,0 +1,30 @@
+import sys
+import time
+import logging
+
+from application.models import QuizQuestion
+
+logger = logging.getLogger(__name__)
+
+
+def run_command(query, count=10):
+    """
+    Search questions which contain all words of the query.
+    """
+    started_at = time.perf_counter()
+    try:
+        question_ids = QuizQuestion.search(query, count)
+    except ValueError as e:
+        sys.stdout.write(f'{str(e)}\n')
+        sys.exit(1)
+    logger.debug(
+        'Search for {} took {:.3f} ms.'.format(
+            query, (time.perf_counter() - started_at) * 1000
+        )
+    )
+
+    if not question_ids:
+        sys.stdout.write('Nothing found.\n')
+    for question_id in question_ids:
+        question_text = ' '.join(QuizQuestion.get_question_text(question_id).split())
+        sys.stdout.write(f'{question_id}: {question_text}\n')
@@ -0,0 +1,20 @@
+import time
+import logging
+
+from application.common.storage import Storage
+
+logger = logging.getLogger(__name__)
+
+
+def run_command(batch_size=1000):
+    """
+    Copy replicated keys, e.g. questions, from the primary redis node
+    to other nodes, so a newly added node gets them.
+    """
+    started_at = time.monotonic()
+    copied_count, removed_count = Storage.engine.copy_replicated_keys(batch_size)
+    logger.info(
+        'Replicas sync finished, {} keys were copied, {} removed in {:.1f} s.'.format(
+            copied_count, removed_count, time.monotonic() - started_at
+        )
+    )
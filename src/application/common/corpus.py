@@ -0,0 +1,198 @@
+import os
+import sys
+import json
+import mmap
+import array
+import random
+import shutil
+import tempfile
+
+
+class CorpusFile:
+    """
+    Read-only file of records with text fields, identified by ids from 1,
+    which is memory-mapped, so processes reading the same file share
+    one copy of it in page cache and open it without reading it.
+    Layout: magic, header length, JSON header, then sections: offsets
+    of every field of every record, ids of records, ids of records
+    of every group and UTF-8 payload. A field is sliced by its offsets
+    and a random id is taken from an array, so reads do not parse the file.
+    """
+
+    MAGIC = b'QUIZCRP1'
+    ALIGNMENT = 8
+
+    def __init__(self, path):
+        with open(path, 'rb') as corpus_file:
+            self._mmap = mmap.mmap(corpus_file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic_end = len(CorpusFile.MAGIC)
+        header_start = magic_end + 8
+        if self._mmap[:magic_end] != CorpusFile.MAGIC:
+            self._mmap.close()
+            raise ValueError(f'{path} is not a corpus file.')
+        header_size = int.from_bytes(self._mmap[magic_end:header_start], 'little')
+        header_end = header_start + header_size
+        header = json.loads(self._mmap[header_start:header_end])
+        if header['byteorder'] != sys.byteorder:
+            self._mmap.close()
+            raise ValueError(f'{path} was written on a platform of other byte order.')
+
+        self.path = path
+        self.fields = header['fields']
+        self.records_count = header['records_count']
+        self._field_positions = {name: index for index, name in enumerate(self.fields)}
+        self._data_start = CorpusFile._align(header_end)
+        self._payload_start = self._data_start + header['payload']
+        self._view = memoryview(self._mmap)
+        self._offsets = self._get_array(header['offsets'], 'Q')
+        self._ids = self._get_array(header['ids'], 'I')
+        self._groups = {
+            name: self._get_array(section, 'I')
+            for name, section in header['groups'].items()
+        }
+
+    def __len__(self):
+        """
+        :return: number of records, missing ids are not counted.
+        """
+        return len(self._ids)
+
+    def __contains__(self, record_id):
+        if not 1 <= record_id <= self.records_count:
+            return False
+        position = (record_id - 1) * len(self.fields)
+        return self._offsets[position] != self._offsets[position + len(self.fields)]
+
+    def get_field(self, record_id, field_name):
+        """
+        :return: text of the field, None if there is no such record.
+        """
+        if record_id not in self:
+            return None
+        position = (record_id - 1) * len(self.fields) + self._field_positions[
+            field_name
+        ]
+        start = self._payload_start + self._offsets[position]
+        end = self._payload_start + self._offsets[position + 1]
+        return self._mmap[start:end].decode()
+
+    def get_record(self, record_id):
+        """
+        :return: dict of field name: text, None if there is no such record.
+        """
+        if record_id not in self:
+            return None
+        return {name: self.get_field(record_id, name) for name in self.fields}
+
+    def get_random_id(self, group=None):
+        """
+        :return: id of a random record of the group or of all records,
+        None if there are none.
+        """
+        ids = self._ids if group is None else self._groups.get(group)
+        return ids[random.randrange(len(ids))] if ids else None
+
+    def get_groups_sizes(self):
+        """
+        :return: dict of group name: number of its records.
+        """
+        return {name: len(ids) for name, ids in self._groups.items()}
+
+    def close(self):
+        for view in (self._offsets, self._ids, *self._groups.values(), self._view):
+            view.release()
+        self._mmap.close()
+
+    def _get_array(self, section, typecode):
+        start, count = section
+        start += self._data_start
+        end = start + count * array.array(typecode).itemsize
+        return self._view[start:end].cast(typecode)
+
+    @staticmethod
+    def _align(position):
+        return -(-position // CorpusFile.ALIGNMENT) * CorpusFile.ALIGNMENT
+
+    @staticmethod
+    def write(path, fields, records, records_count, get_group=None):
+        """
+        Write records into the file. File is replaced atomically,
+        processes which have mapped the old file keep reading it.
+        :param records: iterable of (id, dict of field name: text) pairs
+        in ascending order of ids from 1 to records_count,
+        ids which are not there are missing.
+        :param get_group: function(record) which returns name of the group
+        of the record or None.
+        :return: number of written records.
+        """
+        offsets = array.array('Q')
+        ids = array.array('I')
+        groups = {}
+        directory = os.path.dirname(os.path.abspath(path))
+
+        with tempfile.TemporaryFile(dir=directory) as payload:
+            size = 0
+            records = iter(records)
+            next_record = next(records, None)
+            for record_id in range(1, records_count + 1):
+                record = None
+                if next_record is not None and next_record[0] == record_id:
+                    record = next_record[1]
+                    next_record = next(records, None)
+                for name in fields:
+                    offsets.append(size)
+                    if record is not None:
+                        size += payload.write((record.get(name) or '').encode())
+                if record is None:
+                    continue
+                ids.append(record_id)
+                group = get_group(record) if get_group is not None else None
+                if group:
+                    groups.setdefault(group, array.array('I')).append(record_id)
+            offsets.append(size)
+
+            sections = [('offsets', offsets), ('ids', ids)]
+            sections.extend((('groups', name), ids) for name, ids in groups.items())
+            header = {
+                'fields': list(fields),
+                'records_count': records_count,
+                'byteorder': sys.byteorder,
+                'groups': {},
+            }
+            position = 0
+            for name, section in sections:
+                location = [position, len(section)]
+                if isinstance(name, tuple):
+                    header['groups'][name[1]] = location
+                else:
+                    header[name] = location
+                position = CorpusFile._align(position + len(section) * section.itemsize)
+            header['payload'] = position
+            encoded_header = json.dumps(header, ensure_ascii=False).encode()
+
+            with tempfile.NamedTemporaryFile(
+                dir=directory, delete=False
+            ) as corpus_file:
+                try:
+                    corpus_file.write(CorpusFile.MAGIC)
+                    corpus_file.write(len(encoded_header).to_bytes(8, 'little'))
+                    corpus_file.write(encoded_header)
+                    CorpusFile._pad(corpus_file)
+                    for _, section in sections:
+                        section.tofile(corpus_file)
+                        CorpusFile._pad(corpus_file)
+                    payload.seek(0)
+                    shutil.copyfileobj(payload, corpus_file)
+                    corpus_file.flush()
+                    os.fsync(corpus_file.fileno())
+                except BaseException:
+                    os.unlink(corpus_file.name)
+                    raise
+            os.chmod(corpus_file.name, 0o644)
+            os.replace(corpus_file.name, path)
+        return len(ids)
+
+    @staticmethod
+    def _pad(corpus_file):
+        position = corpus_file.tell()
+        corpus_file.write(b'\0' * (CorpusFile._align(position) - position))
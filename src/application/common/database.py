@@ -1,51 +1,848 @@
+import asyncio
 import logging
-from collections import Iterable
+import hashlib
 import json
-import dataclasses
+import threading
+import contextlib
 
 import redis
 
+from application.common.metrics import Histogram, instrument_static_methods
+from application.common.sharding import ShardedRedis
+
 logger = logging.getLogger(__name__)
 
 
 class RedisStorage:
     connection = None
+    # ShardedRedis when several nodes are configured,
+    # connection is the first of them then.
+    shards = None
+    _scripts = dict()
+    _local = threading.local()
+
+    GET_RECORD_IDS_SCRIPT = '''
+        local ids, alive = {}, {}
+        for i, digest in ipairs(ARGV) do
+            local record_id = redis.call('HGET', KEYS[1], digest)
+            ids[i] = record_id
+            alive[i] = record_id and redis.call('SISMEMBER', KEYS[2], record_id) or 0
+        end
+        return {ids, alive}
+    '''
+
+    SET_REFERENCES_SCRIPT = '''
+        local referenced = {}
+        for i = 2, #ARGV do
+            referenced[ARGV[i]] = true
+        end
+
+        local removed = {}
+        for _, record_id in ipairs(redis.call('SMEMBERS', KEYS[1])) do
+            if referenced[record_id] then
+                referenced[record_id] = nil
+            elseif redis.call('HINCRBY', KEYS[2], record_id, -1) <= 0 then
+                redis.call('HDEL', KEYS[2], record_id)
+                redis.call('SREM', KEYS[3], record_id)
+                redis.call('DEL', ARGV[1] .. ':' .. record_id)
+                table.insert(removed, record_id)
+            end
+        end
+        for record_id in pairs(referenced) do
+            redis.call('HINCRBY', KEYS[2], record_id, 1)
+        end
+
+        redis.call('DEL', KEYS[1])
+        for i = 2, #ARGV, 1000 do
+            redis.call('SADD', KEYS[1], unpack(ARGV, i, math.min(i + 999, #ARGV)))
+        end
+        return removed
+    '''
+
+    # Members of the smallest set are checked against the other sets,
+    # the scan stops as soon as ARGV[1] members are found.
+    INTERSECTION_SCRIPT = '''
+        local sets = {}
+        for i, key in ipairs(KEYS) do
+            sets[i] = {key, redis.call('SCARD', key)}
+        end
+        table.sort(sets, function(a, b) return a[2] < b[2] end)
+
+        local count = tonumber(ARGV[1])
+        local members, seen = {}, {}
+        local cursor = '0'
+        repeat
+            local reply = redis.call('SSCAN', sets[1][1], cursor, 'COUNT', 1000)
+            cursor = reply[1]
+            for _, member in ipairs(reply[2]) do
+                local found = not seen[member]
+                seen[member] = true
+                for i = 2, #sets do
+                    if found and redis.call('SISMEMBER', sets[i][1], member) == 0 then
+                        found = false
+                    end
+                end
+                if found then
+                    table.insert(members, member)
+                    if #members == count then
+                        return members
+                    end
+                end
+            end
+        until cursor == '0'
+        return members
+    '''
 
     @staticmethod
-    def initialize(host=None, port=None, url=None):
+    def initialize(
+        host=None,
+        port=None,
+        url=None,
+        max_connections=None,
+        socket_timeout=None,
+        socket_connect_timeout=None,
+        health_check_interval=0,
+        shard_urls=None,
+        replicated_prefixes=(),
+    ):
+        """
+        :param shard_urls: urls of redis nodes to spread keys across,
+        host, port and url are not used if they are given.
+        :param replicated_prefixes: keys with these prefixes are kept
+        on every node of shard_urls, see ShardedRedis.
+        """
         logger.debug(
-            'Redis instance initialization started, host: {}, port: {}, url: {}'.format(
-                host, port, url
-            )
+            'Redis instance initialization started, host: {}, port: {}, url: {}, '
+            'shard urls: {}'.format(host, port, url, shard_urls)
         )
+        pool_settings = {
+            'max_connections': max_connections,
+            'socket_timeout': socket_timeout,
+            'socket_connect_timeout': socket_connect_timeout,
+            'health_check_interval': health_check_interval,
+        }
+        RedisStorage._scripts = dict()
+        if shard_urls:
+            connections = {
+                shard_url: redis.Redis(
+                    connection_pool=redis.ConnectionPool.from_url(
+                        shard_url, **pool_settings
+                    )
+                )
+                for shard_url in shard_urls
+            }
+            RedisStorage.shards = ShardedRedis(connections, replicated_prefixes)
+            RedisStorage.connection = RedisStorage.shards.connections[0]
+            return None
+
         if url:
-            RedisStorage.connection = redis.Redis.from_url(url)
+            connection_pool = redis.ConnectionPool.from_url(url, **pool_settings)
+        else:
+            connection_pool = redis.ConnectionPool(
+                host=host, port=port, **pool_settings
+            )
+        RedisStorage.connection = redis.Redis(connection_pool=connection_pool)
+        RedisStorage.shards = None
+
+    @staticmethod
+    @contextlib.contextmanager
+    def pipeline(transaction=True):
+        """
+        Write commands (set, set_hash, increase_value, ...) issued through RedisStorage
+        inside the block are queued and sent in a single round trip,
+        as MULTI/EXEC transaction by default, when the block exits.
+        They return None inside the block. Read commands are not deferred.
+        Pipeline is bound to the current thread, nested blocks share it.
+        With several nodes every node gets its own pipeline, so a block
+        takes a round trip per node and transactions do not span nodes.
+        """
+        if getattr(RedisStorage._local, 'pipelines', None) is not None:
+            yield None
+            return None
+
+        RedisStorage._local.pipelines = {}
+        RedisStorage._local.transaction = transaction
+        try:
+            yield None
+        finally:
+            pipelines = RedisStorage._local.pipelines
+            RedisStorage._local.pipelines = None
+        for pipeline in pipelines.values():
+            pipeline.execute()
+
+    @staticmethod
+    def _get_writer(connection):
+        """
+        :return: pipeline of the connection inside pipeline block,
+        the connection itself otherwise.
+        """
+        pipelines = getattr(RedisStorage._local, 'pipelines', None)
+        if pipelines is None:
+            return connection
+        pipeline = pipelines.get(id(connection))
+        if pipeline is None:
+            pipeline = pipelines[id(connection)] = connection.pipeline(
+                transaction=RedisStorage._local.transaction
+            )
+        return pipeline
+
+    @staticmethod
+    def _get_reader(key):
+        if RedisStorage.shards is None:
+            return RedisStorage.connection
+        return RedisStorage.shards.get_reader(key)
+
+    @staticmethod
+    def _get_writers(key):
+        """
+        :return: connections of every node which keeps the key.
+        """
+        if RedisStorage.shards is None:
+            return [RedisStorage.connection]
+        return RedisStorage.shards.get_writers(key)
+
+    @staticmethod
+    def _write(command, key, *args, **kwargs):
+        """
+        Run write command on every node which keeps the key,
+        it is queued inside pipeline block.
+        :return: reply of the first node.
+        """
+        replies = [
+            getattr(RedisStorage._get_writer(connection), command)(key, *args, **kwargs)
+            for connection in RedisStorage._get_writers(key)
+        ]
+        return replies[0]
+
+    @staticmethod
+    def _read_many(keys, queue_commands):
+        """
+        Read keys in a pipeline per node, so it takes one round trip
+        with a single node.
+        :param queue_commands: function(pipeline, key) which queues
+        read commands of the key.
+        :return: list of replies of queued commands of every key.
+        """
+        if RedisStorage.shards is None:
+            readers = [RedisStorage.connection] * len(keys)
         else:
-            RedisStorage.connection = redis.Redis(host, port)
+            readers = RedisStorage.shards.get_readers(keys)
+        pipelines, positions = {}, []
+        for key, reader in zip(keys, readers):
+            pipeline = pipelines.get(id(reader))
+            if pipeline is None:
+                pipeline = pipelines[id(reader)] = reader.pipeline(transaction=False)
+            start = len(pipeline.command_stack)
+            queue_commands(pipeline, key)
+            positions.append((id(reader), start, len(pipeline.command_stack)))
+        replies = {
+            reader_id: pipeline.execute() for reader_id, pipeline in pipelines.items()
+        }
+        return [replies[reader_id][start:end] for reader_id, start, end in positions]
+
+    @staticmethod
+    def run_script(source, keys=(), args=(), read_only=False, primary=False):
+        """
+        Run Lua script, so several dependent commands take a single round trip.
+        Script is loaded into redis once and then called by its digest.
+        With several nodes all not replicated keys of the script have to be
+        on the same node, see ShardedRedis.get_script_connections.
+        :param read_only: script only reads keys, so a script with only
+        replicated keys runs on one node instead of every node.
+        :param primary: read only script with only replicated keys runs
+        on the primary node, e.g. when its reply decides what to write.
+        :return: reply of the first node the script runs on.
+        """
+        script = RedisStorage._scripts.get(source)
+        if script is None:
+            script = RedisStorage.connection.register_script(source)
+            RedisStorage._scripts[source] = script
+        if RedisStorage.shards is None:
+            return script(keys=keys, args=args)
+
+        connections = RedisStorage.shards.get_script_connections(
+            keys, read_only, primary
+        )
+        replies = [
+            script(keys=keys, args=args, client=connection)
+            for connection in connections
+        ]
+        return replies[0]
+
+    @staticmethod
+    def add_records_to_index(index_name, records, digests=None, rewrite=False):
+        """
+        Save every record (dict of fields) into its own hash '<index_name>:<id>'
+        and add its id into '<index_name>:ids' set.
+        Ids are integers and stable: a record with the same content
+        keeps the id it got on the first save, even if it was removed
+        from the index in between. Takes three round trips
+        regardless of the number of records, with several nodes
+        existing ids are read and new ids are allocated on the primary node,
+        other nodes increase their last id by the same number, so nodes
+        which are in sync stay in sync, and writes take a round trip per node.
+        :param digests: digests of records' content, computed from records
+        if not provided.
+        :param rewrite: replace hashes of records which already exist,
+        e.g. to store them with another serializer.
+        :return: list of ids of the records.
+        """
+        if digests is None:
+            digests = [RedisStorage.get_record_digest(record) for record in records]
+        records_by_digest = dict(zip(digests, records))
+        if not records_by_digest:
+            return []
+
+        unique_digests = list(records_by_digest.keys())
+        existing_ids, alive_flags = RedisStorage.run_script(
+            RedisStorage.GET_RECORD_IDS_SCRIPT,
+            keys=[f'{index_name}:digests', f'{index_name}:ids'],
+            args=unique_digests,
+            read_only=True,
+            primary=True,
+        )
+        ids_by_digest = {
+            digest: int(record_id)
+            for digest, record_id in zip(unique_digests, existing_ids)
+            if record_id is not None
+        }
+        new_digests = [
+            digest for digest in unique_digests if digest not in ids_by_digest
+        ]
+        removed_digests = [
+            digest
+            for digest, record_id, alive in zip(
+                unique_digests, existing_ids, alive_flags
+            )
+            if record_id is not None and not alive
+        ]
+
+        # With several nodes all keys of the index have to be replicated,
+        # the primary node is the first writer.
+        writers = RedisStorage._get_writers(f'{index_name}:ids')
+        if new_digests:
+            last_id = [
+                connection.incr(f'{index_name}:last-id', len(new_digests))
+                for connection in writers
+            ][0]
+            first_id = last_id - len(new_digests) + 1
+            ids_by_digest.update(
+                zip(new_digests, range(first_id, first_id + len(new_digests)))
+            )
+
+        written_digests = unique_digests if rewrite else new_digests + removed_digests
+        for connection in writers:
+            # Rewritten hashes are replaced in a transaction,
+            # so they are never read half written.
+            pipeline = connection.pipeline(transaction=rewrite)
+            for digest in written_digests:
+                record_id = ids_by_digest[digest]
+                if rewrite:
+                    pipeline.delete(f'{index_name}:{record_id}')
+                pipeline.hset(
+                    f'{index_name}:{record_id}', mapping=records_by_digest[digest]
+                )
+                pipeline.hset(f'{index_name}:digests', digest, record_id)
+                pipeline.sadd(f'{index_name}:ids', record_id)
+            pipeline.execute()
+
+        return [ids_by_digest[digest] for digest in digests]
+
+    @staticmethod
+    def get_diverged_keys(keys):
+        """
+        :return: replicated keys whose values differ between nodes,
+        e.g. after an empty node was added, read in a round trip per node.
+        """
+        if RedisStorage.shards is None:
+            return []
+        values = [
+            connection.mget(keys) for connection in RedisStorage.shards.connections
+        ]
+        return [
+            key
+            for key, key_values in zip(keys, zip(*values))
+            if len(set(key_values)) > 1
+        ]
+
+    @staticmethod
+    def copy_replicated_keys(batch_size=1000):
+        """
+        Copy keys with replicated prefixes from the primary node to other nodes
+        and remove the ones the primary node does not have, e.g. to fill
+        a new node. Nothing should write them meanwhile.
+        :return: number of copied and number of removed keys.
+        """
+        shards = RedisStorage.shards
+        if shards is None:
+            return 0, 0
+        replicas = [
+            connection
+            for connection in shards.connections
+            if connection is not shards.primary
+        ]
+        copied_count = removed_count = 0
+        for prefix in shards.replicated_prefixes:
+            for keys in RedisStorage._scan_connection(
+                shards.primary, f'{prefix}*', batch_size
+            ):
+                pipeline = shards.primary.pipeline(transaction=False)
+                for key in keys:
+                    pipeline.dump(key)
+                    pipeline.pttl(key)
+                replies = pipeline.execute()
+                dumps = [
+                    (key, value, max(ttl, 0))
+                    for key, value, ttl in zip(keys, replies[::2], replies[1::2])
+                    if value is not None
+                ]
+                for replica in replicas:
+                    pipeline = replica.pipeline(transaction=False)
+                    for key, value, ttl in dumps:
+                        pipeline.restore(key, ttl, value, replace=True)
+                    pipeline.execute()
+                copied_count += len(dumps)
+
+            for replica in replicas:
+                for keys in RedisStorage._scan_connection(
+                    replica, f'{prefix}*', batch_size
+                ):
+                    pipeline = shards.primary.pipeline(transaction=False)
+                    for key in keys:
+                        pipeline.exists(key)
+                    missing_keys = [
+                        key
+                        for key, exists in zip(keys, pipeline.execute())
+                        if not exists
+                    ]
+                    if missing_keys:
+                        removed_count += replica.delete(*missing_keys)
+        return copied_count, removed_count
+
+    @staticmethod
+    def set_index_references(index_name, owner, record_ids):
+        """
+        Make owner (e.g. a source file) reference exactly record_ids.
+        Records are reference counted, the ones which are not referenced
+        by any owner anymore are removed from the index.
+        Takes one round trip.
+        :return: list of ids of removed records.
+        """
+        removed_ids = RedisStorage.run_script(
+            RedisStorage.SET_REFERENCES_SCRIPT,
+            keys=[
+                f'{index_name}:owners:{owner}',
+                f'{index_name}:references',
+                f'{index_name}:ids',
+            ],
+            args=[index_name, *record_ids],
+        )
+        return [int(record_id) for record_id in removed_ids]
+
+    @staticmethod
+    def add_members_to_sets(members_by_key):
+        """
+        :param members_by_key: dict of set name: members to add.
+        Takes one round trip per node.
+        """
+        pipelines = {}
+        for key, members in members_by_key.items():
+            for connection in RedisStorage._get_writers(key):
+                pipeline = pipelines.get(id(connection))
+                if pipeline is None:
+                    pipeline = pipelines[id(connection)] = connection.pipeline(
+                        transaction=False
+                    )
+                pipeline.sadd(key, *members)
+        for pipeline in pipelines.values():
+            pipeline.execute()
+
+    @staticmethod
+    def remove_members_from_set(key, members):
+        return RedisStorage._write('srem', key, *members)
+
+    @staticmethod
+    def is_replicated(key):
+        """
+        :return: whether the key is kept on every node, so a script
+        running on one node should not change it.
+        """
+        return RedisStorage.shards is not None and RedisStorage.shards.is_replicated(
+            key
+        )
+
+    @staticmethod
+    def get_set_members(key):
+        return [
+            member.decode() for member in RedisStorage._get_reader(key).smembers(key)
+        ]
+
+    @staticmethod
+    def get_sets_sizes(keys):
+        replies = RedisStorage._read_many(
+            keys, lambda pipeline, key: pipeline.scard(key)
+        )
+        return [size for size, in replies]
+
+    @staticmethod
+    def get_sets_intersection(keys, count=None):
+        """
+        With several nodes the sets have to be on the same node.
+        :param count: stop after count members are found, so only the smallest
+        set is scanned until then instead of building the whole intersection.
+        """
+        if count is not None:
+            members = RedisStorage.run_script(
+                RedisStorage.INTERSECTION_SCRIPT,
+                keys=keys,
+                args=[count],
+                read_only=True,
+            )
+            return [member.decode() for member in members]
+        if RedisStorage.shards is None:
+            reader = RedisStorage.connection
+        else:
+            reader = RedisStorage.shards.get_script_connections(keys, read_only=True)[0]
+        return [member.decode() for member in reader.sinter(keys)]
+
+    @staticmethod
+    def get_record_digest(record):
+        dumped_record = json.dumps(record, sort_keys=True)
+        return hashlib.sha1(dumped_record.encode()).hexdigest()
+
+    @staticmethod
+    def get_random_member(set_name):
+        random_member = RedisStorage._get_reader(set_name).srandmember(set_name)
+        return random_member if random_member is None else random_member.decode()
+
+    @staticmethod
+    def get_random_members(set_name, count):
+        """
+        :return: up to count distinct random members in one round trip.
+        """
+        random_members = RedisStorage._get_reader(set_name).srandmember(set_name, count)
+        return [random_member.decode() for random_member in random_members]
+
+    @staticmethod
+    def get_hash(key, encoding='utf-8'):
+        """
+        :param encoding: values are returned as bytes if it is None.
+        """
+        value = RedisStorage._get_reader(key).hgetall(key)
+        if encoding is None:
+            return value
+        return {
+            field_name.decode(encoding): field_value.decode(encoding)
+            for field_name, field_value in value.items()
+        }
+
+    @staticmethod
+    def get_hashes(keys):
+        """
+        :return: hash of every key with bytes values, read in a pipeline.
+        """
+        replies = RedisStorage._read_many(
+            keys, lambda pipeline, key: pipeline.hgetall(key)
+        )
+        return [value for value, in replies]
+
+    @staticmethod
+    def get_hash_field(key, field_name):
+        value = RedisStorage._get_reader(key).hget(key, field_name)
+        return value if value is None else value.decode()
+
+    @staticmethod
+    def get_hashes_field(keys, field_name):
+        """
+        :return: value of the field of every hash, read in a pipeline.
+        """
+        replies = RedisStorage._read_many(
+            keys, lambda pipeline, key: pipeline.hget(key, field_name)
+        )
+        return [value if value is None else value.decode() for value, in replies]
+
+    @staticmethod
+    def delete_hash_fields(key, field_names):
+        return RedisStorage._write('hdel', key, *field_names)
+
+    @staticmethod
+    def get_hash_fields(key, field_names):
+        return [
+            value if value is None else value.decode()
+            for value in RedisStorage._get_reader(key).hmget(key, field_names)
+        ]
 
     @staticmethod
-    def add_records_to_set(set_name, records):
-        if not isinstance(records, Iterable):
-            records = [records]
-        dumped_records = [json.dumps(dataclasses.asdict(record)) for record in records]
-        return RedisStorage.connection.sadd(set_name, *dumped_records)
+    def set_hash(key, mapping):
+        return RedisStorage._write('hset', key, mapping=mapping)
 
     @staticmethod
-    def get_random_record_from_set(set_name):
-        random_record = RedisStorage.connection.srandmember(set_name)
-        random_record_dict = json.loads(random_record)
-        return random_record_dict
+    def increase_hash_value(key, field_name, value=1):
+        replies = [
+            connection.hincrby(key, field_name, value)
+            for connection in RedisStorage._get_writers(key)
+        ]
+        return replies[0]
 
     @staticmethod
     def set(key, value):
-        return RedisStorage.connection.set(key, value)
+        return RedisStorage._write('set', key, value)
 
     @staticmethod
     def get(key):
-        value = RedisStorage.connection.get(key)
+        value = RedisStorage._get_reader(key).get(key)
         value = value if value is None else value.decode()
         return value
 
     @staticmethod
     def increase_value(key, value=1):
-        return RedisStorage.connection.incr(key, value)
+        return RedisStorage._write('incr', key, value)
+
+    @staticmethod
+    def delete(key):
+        return RedisStorage._write('delete', key)
+
+    @staticmethod
+    def get_many(keys):
+        if RedisStorage.shards is None:
+            values = RedisStorage.connection.mget(keys)
+        else:
+            replies = RedisStorage._read_many(
+                keys, lambda pipeline, key: pipeline.get(key)
+            )
+            values = [value for value, in replies]
+        return [value if value is None else value.decode() for value in values]
+
+    @staticmethod
+    def scan_keys(pattern, batch_size=1000):
+        """
+        Yields lists of keys matching pattern without blocking redis,
+        as SCAN does. Keys may be repeated between batches.
+        With several nodes every node is scanned, so replicated keys
+        are yielded once per node.
+        """
+        if RedisStorage.shards is None:
+            connections = [RedisStorage.connection]
+        else:
+            connections = RedisStorage.shards.connections
+        for connection in connections:
+            yield from RedisStorage._scan_connection(connection, pattern, batch_size)
+
+    @staticmethod
+    def _scan_connection(connection, pattern, batch_size):
+        cursor = None
+        while cursor != 0:
+            cursor, keys = connection.scan(cursor or 0, match=pattern, count=batch_size)
+            if keys:
+                yield [key.decode() for key in keys]
+
+    @staticmethod
+    def set_expiration(key, seconds):
+        return RedisStorage._write('expire', key, seconds)
+
+    @staticmethod
+    def set_sorted_set_values(key, mapping):
+        return RedisStorage._write('zadd', key, mapping)
+
+    @staticmethod
+    def increase_sorted_set_value(key, member, value=1):
+        return RedisStorage._write('zincrby', key, value, member)
+
+    @staticmethod
+    def get_sorted_set_top(key, count):
+        """
+        :return: list of (member, score) pairs with the highest scores.
+        """
+        top = RedisStorage._get_reader(key).zrevrange(
+            key, 0, count - 1, withscores=True
+        )
+        return [(member.decode(), int(score)) for member, score in top]
+
+    @staticmethod
+    def get_sorted_sets_ranks(keys, member):
+        """
+        :return: list of (rank, score) pairs of member in every sorted set,
+        rank is counted from 1 for the highest score, None if member is absent.
+        Takes one round trip per node.
+        """
+
+        def queue_commands(pipeline, key):
+            pipeline.zrevrank(key, member)
+            pipeline.zscore(key, member)
+
+        return [
+            (None, 0) if rank is None else (rank + 1, int(score))
+            for rank, score in RedisStorage._read_many(keys, queue_commands)
+        ]
+
+
+class AsyncRedisStorage:
+    """
+    Same interface as RedisStorage for asyncio runtimes.
+    Connection pool has to be initialized inside the running event loop.
+    """
+
+    connection = None
+
+    @staticmethod
+    async def initialize(
+        host=None,
+        port=None,
+        url=None,
+        max_connections=None,
+        socket_timeout=None,
+        socket_connect_timeout=None,
+        health_check_interval=0,
+        shard_urls=None,
+    ):
+        """
+        Takes the same settings as RedisStorage.initialize,
+        socket_timeout and health_check_interval are not supported by aioredis,
+        neither are several nodes.
+        aioredis is imported here, so only the async bot loads it.
+        """
+        if shard_urls:
+            raise ValueError('Async redis storage does not support several nodes.')
+
+        import aioredis
+
+        logger.debug(
+            'Async redis pool initialization started, host: {}, port: {}, url: {}'.format(
+                host, port, url
+            )
+        )
+        address = url if url else (host, port)
+        AsyncRedisStorage.connection = await aioredis.create_redis_pool(
+            address,
+            maxsize=max_connections or 10,
+            timeout=socket_connect_timeout,
+        )
+
+    @staticmethod
+    async def close():
+        AsyncRedisStorage.connection.close()
+        await AsyncRedisStorage.connection.wait_closed()
+
+    @staticmethod
+    async def run_script(source, keys=(), args=()):
+        """
+        Same as RedisStorage.run_script: script is called by its digest
+        and loaded into redis when it is not there yet.
+        """
+        from aioredis import errors as aioredis_errors
+
+        digest = hashlib.sha1(source.encode()).hexdigest()
+        try:
+            return await AsyncRedisStorage.connection.evalsha(digest, keys, args)
+        except aioredis_errors.ReplyError as e:
+            if not str(e).startswith('NOSCRIPT'):
+                raise
+            return await AsyncRedisStorage.connection.eval(source, keys, args)
+
+    @staticmethod
+    async def get_random_member(set_name):
+        return await AsyncRedisStorage.connection.srandmember(
+            set_name, encoding='utf-8'
+        )
+
+    @staticmethod
+    async def get_hash(key):
+        return await AsyncRedisStorage.connection.hgetall(key, encoding='utf-8')
+
+    @staticmethod
+    async def get_hash_field(key, field_name):
+        return await AsyncRedisStorage.connection.hget(
+            key, field_name, encoding='utf-8'
+        )
+
+    @staticmethod
+    async def get_hash_fields(key, field_names):
+        return await AsyncRedisStorage.connection.hmget(
+            key, *field_names, encoding='utf-8'
+        )
+
+    @staticmethod
+    async def set_hash(key, mapping):
+        return await AsyncRedisStorage.connection.hmset_dict(key, mapping)
+
+    @staticmethod
+    async def increase_hash_value(key, field_name, value=1):
+        return await AsyncRedisStorage.connection.hincrby(key, field_name, value)
+
+    @staticmethod
+    async def set(key, value):
+        return await AsyncRedisStorage.connection.set(key, value)
+
+    @staticmethod
+    async def get(key):
+        return await AsyncRedisStorage.connection.get(key, encoding='utf-8')
+
+    @staticmethod
+    async def increase_value(key, value=1):
+        return await AsyncRedisStorage.connection.incrby(key, value)
+
+    @staticmethod
+    async def delete(key):
+        return await AsyncRedisStorage.connection.delete(key)
+
+    @staticmethod
+    async def get_set_members(key):
+        return await AsyncRedisStorage.connection.smembers(key, encoding='utf-8')
+
+    @staticmethod
+    async def get_sets_sizes(keys):
+        return await asyncio.gather(
+            *(AsyncRedisStorage.connection.scard(key) for key in keys)
+        )
+
+    @staticmethod
+    async def set_expiration(key, seconds):
+        return await AsyncRedisStorage.connection.expire(key, seconds)
+
+    @staticmethod
+    async def increase_sorted_set_value(key, member, value=1):
+        return await AsyncRedisStorage.connection.zincrby(key, value, member)
+
+    @staticmethod
+    async def get_sorted_set_top(key, count):
+        top = await AsyncRedisStorage.connection.zrevrange(
+            key, 0, count - 1, withscores=True, encoding='utf-8'
+        )
+        return [(member, int(score)) for member, score in top]
+
+    @staticmethod
+    async def get_sorted_sets_ranks(keys, member):
+        replies = await asyncio.gather(
+            *(
+                command(key, member)
+                for key in keys
+                for command in (
+                    AsyncRedisStorage.connection.zrevrank,
+                    AsyncRedisStorage.connection.zscore,
+                )
+            )
+        )
+        return [
+            (None, 0) if rank is None else (rank + 1, int(score))
+            for rank, score in zip(replies[::2], replies[1::2])
+        ]
+
+
+REDIS_CALL_LATENCY = Histogram(
+    'quiz_redis_storage_call_seconds',
+    'Duration of storage methods calls, writes inside a pipeline are only queued.',
+    labelnames=('storage', 'method'),
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1),
+)
+instrument_static_methods(
+    RedisStorage,
+    REDIS_CALL_LATENCY,
+    exclude=('initialize', 'pipeline', 'get_record_digest'),
+    storage='sync',
+)
+instrument_static_methods(
+    AsyncRedisStorage,
+    REDIS_CALL_LATENCY,
+    exclude=('initialize', 'close'),
+    storage='async',
+)
@@ -0,0 +1,644 @@
+import os
+import time
+import atexit
+import bisect
+import pickle
+import random
+import fnmatch
+import itertools
+import logging
+import threading
+import contextlib
+
+from application.common.database import REDIS_CALL_LATENCY, RedisStorage
+from application.common.metrics import instrument_static_methods
+
+logger = logging.getLogger(__name__)
+
+
+def encode(value):
+    """
+    Values are kept as bytes the way redis keeps them,
+    so both engines return the same values, e.g. strings for saved numbers.
+    """
+    if isinstance(value, bytes):
+        return value
+    if isinstance(value, float):
+        return repr(value).encode()
+    return str(value).encode()
+
+
+class IndexedSet:
+    """
+    Set which returns a random member in constant time, as SRANDMEMBER does.
+    """
+
+    def __init__(self, members=()):
+        self._members = []
+        self._positions = {}
+        for member in members:
+            self.add(member)
+
+    def __contains__(self, member):
+        return member in self._positions
+
+    def __iter__(self):
+        return iter(self._members)
+
+    def __len__(self):
+        return len(self._members)
+
+    def add(self, member):
+        if member in self._positions:
+            return False
+        self._positions[member] = len(self._members)
+        self._members.append(member)
+        return True
+
+    def discard(self, member):
+        position = self._positions.pop(member, None)
+        if position is None:
+            return False
+        last_member = self._members.pop()
+        if position < len(self._members):
+            self._members[position] = last_member
+            self._positions[last_member] = position
+        return True
+
+    def choice(self):
+        return random.choice(self._members) if self._members else None
+
+    def sample(self, count):
+        """
+        :return: up to count distinct random members, as SRANDMEMBER key count does.
+        """
+        return random.sample(self._members, min(count, len(self._members)))
+
+
+class SortedSet:
+    """
+    Sorted set which finds the rank of a member in logarithmic time,
+    as ZREVRANK does. Members are ordered by score and then by member.
+    """
+
+    def __init__(self, scores=()):
+        self._scores = {}
+        self._ordered = []
+        for member, score in dict(scores).items():
+            self.set(member, score)
+
+    def __len__(self):
+        return len(self._scores)
+
+    def get(self, member):
+        return self._scores.get(member)
+
+    def set(self, member, score):
+        """
+        :return: True if the member was added.
+        """
+        old_score = self._scores.get(member)
+        if old_score is not None:
+            del self._ordered[bisect.bisect_left(self._ordered, (old_score, member))]
+        self._scores[member] = score
+        bisect.insort(self._ordered, (score, member))
+        return old_score is None
+
+    def get_reverse_rank(self, member):
+        """
+        :return: number of members ordered after the member, None if it is absent.
+        """
+        score = self._scores.get(member)
+        if score is None:
+            return None
+        position = bisect.bisect_right(self._ordered, (score, member))
+        return len(self._ordered) - position
+
+    def get_top(self, count):
+        """
+        :return: list of up to count (member, score) pairs, the last ones first.
+        """
+        if count <= 0:
+            return []
+        return [(member, score) for score, member in reversed(self._ordered[-count:])]
+
+
+class MemoryStorage:
+    """
+    Same interface as RedisStorage, data is kept in memory of the process,
+    so commands take no network round trips. It suits deployments
+    of a single bot process and load tests. Data is saved to a snapshot file
+    periodically and on exit, and loaded from it on initialization.
+    Lua scripts are run by their Python versions, see register_script.
+    """
+
+    snapshot_path = None
+    _data = dict()
+    _expires = dict()
+    _scripts = dict()
+    _changes = 0
+    _snapshot_interval = 0
+    _snapshot_thread = None
+    _lock = threading.RLock()
+    _snapshot_lock = threading.Lock()
+
+    @staticmethod
+    def initialize(snapshot_path=None, snapshot_interval=0):
+        """
+        :param snapshot_path: file to load data from and to save it to,
+        data lives only as long as the process if it is None.
+        :param snapshot_interval: seconds between snapshots, data is saved
+        only on exit if it is 0.
+        """
+        logger.debug(
+            'Memory storage initialization started, snapshot: {}'.format(snapshot_path)
+        )
+        with MemoryStorage._lock:
+            MemoryStorage._data, MemoryStorage._expires = dict(), dict()
+            MemoryStorage._changes = 0
+            MemoryStorage.snapshot_path = snapshot_path
+            if snapshot_path and os.path.exists(snapshot_path):
+                with open(snapshot_path, 'rb') as snapshot_file:
+                    MemoryStorage._data, MemoryStorage._expires = pickle.load(
+                        snapshot_file
+                    )
+                logger.info(
+                    f'{len(MemoryStorage._data)} keys were loaded from {snapshot_path}.'
+                )
+                MemoryStorage._convert_sorted_sets()
+
+        atexit.unregister(MemoryStorage.save_snapshot)
+        if not snapshot_path:
+            return None
+        atexit.register(MemoryStorage.save_snapshot)
+        MemoryStorage._snapshot_interval = snapshot_interval
+        if snapshot_interval and MemoryStorage._snapshot_thread is None:
+            MemoryStorage._snapshot_thread = threading.Thread(
+                target=MemoryStorage._save_snapshots, daemon=True
+            )
+            MemoryStorage._snapshot_thread.start()
+
+    @staticmethod
+    def _convert_sorted_sets():
+        """
+        Snapshots saved before SortedSet was introduced keep sorted sets
+        as dicts of member: float score, hashes keep bytes values.
+        """
+        for key, value in MemoryStorage._data.items():
+            if (
+                isinstance(value, dict)
+                and value
+                and all(isinstance(score, float) for score in value.values())
+            ):
+                MemoryStorage._data[key] = SortedSet(value)
+
+    @staticmethod
+    def _save_snapshots():
+        while MemoryStorage._snapshot_interval:
+            time.sleep(MemoryStorage._snapshot_interval)
+            MemoryStorage.save_snapshot()
+
+    @staticmethod
+    def save_snapshot():
+        """
+        Write data to a temporary file, which replaces the snapshot,
+        so a crash never leaves a partially written snapshot.
+        :return: True if data was changed since the last snapshot and saved.
+        """
+        with MemoryStorage._snapshot_lock:
+            with MemoryStorage._lock:
+                if not MemoryStorage.snapshot_path or not MemoryStorage._changes:
+                    return False
+                payload = pickle.dumps(
+                    (MemoryStorage._data, MemoryStorage._expires),
+                    protocol=pickle.HIGHEST_PROTOCOL,
+                )
+                MemoryStorage._changes = 0
+                snapshot_path = MemoryStorage.snapshot_path
+
+            temporary_path = f'{snapshot_path}.tmp'
+            with open(temporary_path, 'wb') as snapshot_file:
+                snapshot_file.write(payload)
+            os.replace(temporary_path, snapshot_path)
+        logger.debug(f'Memory storage snapshot was saved to {snapshot_path}.')
+        return True
+
+    @staticmethod
+    @contextlib.contextmanager
+    def pipeline(transaction=True):
+        """
+        Commands are applied at once, every command is atomic.
+        Blocks are accepted, so models work with both engines.
+        """
+        yield None
+
+    @staticmethod
+    def register_script(source, function):
+        """
+        :param function: Python version of the Lua script,
+        function(call, keys, args), where call runs a redis command
+        and returns its raw reply, as redis.call does.
+        """
+        MemoryStorage._scripts[source] = function
+
+    @staticmethod
+    def run_script(source, keys=(), args=(), read_only=False):
+        function = MemoryStorage._scripts.get(source)
+        if function is None:
+            raise ValueError('Script has no Python version for memory storage.')
+        with MemoryStorage._lock:
+            return function(MemoryStorage._call, list(keys), list(args))
+
+    @staticmethod
+    def _call(command, *args):
+        """
+        Commands used by scripts of models, replies are raw, as with redis.call.
+        """
+        if command == 'GET':
+            return MemoryStorage._get_value(args[0])
+        if command == 'HGET':
+            return (MemoryStorage._get_value(args[0]) or {}).get(encode(args[1]))
+        if command == 'HMGET':
+            value = MemoryStorage._get_value(args[0]) or {}
+            return [value.get(encode(field_name)) for field_name in args[1:]]
+        if command == 'SRANDMEMBER':
+            value = MemoryStorage._get_value(args[0])
+            if len(args) > 1:
+                return [] if value is None else value.sample(int(args[1]))
+            return value if value is None else value.choice()
+        if command == 'SCARD':
+            return len(MemoryStorage._get_value(args[0]) or ())
+        if command == 'SISMEMBER':
+            return int(encode(args[1]) in (MemoryStorage._get_value(args[0]) or ()))
+        if command == 'SREM':
+            value = MemoryStorage._get_value(args[0]) or IndexedSet()
+            removed_count = sum(value.discard(encode(member)) for member in args[1:])
+            MemoryStorage._drop_if_empty(args[0])
+            MemoryStorage._changes += removed_count
+            return removed_count
+        if command == 'SINTER':
+            return MemoryStorage._get_intersection(args)
+        raise ValueError(f'Command {command} is not supported by memory storage.')
+
+    @staticmethod
+    def _get_value(key, factory=None):
+        """
+        Caller holds the lock.
+        :param factory: creates a value of the absent key, e.g. dict for hashes.
+        """
+        deadline = MemoryStorage._expires.get(key)
+        if deadline is not None and deadline <= time.time():
+            del MemoryStorage._expires[key]
+            MemoryStorage._data.pop(key, None)
+        value = MemoryStorage._data.get(key)
+        if value is None and factory is not None:
+            value = MemoryStorage._data[key] = factory()
+        return value
+
+    @staticmethod
+    def _drop_if_empty(key):
+        """
+        Redis removes hashes, sets and sorted sets without members.
+        """
+        if not MemoryStorage._data.get(key, True):
+            del MemoryStorage._data[key]
+            MemoryStorage._expires.pop(key, None)
+
+    @staticmethod
+    def _get_intersection(keys, count=None):
+        """
+        :param count: stop after count members are found.
+        """
+        sets = [MemoryStorage._get_value(key) or IndexedSet() for key in keys]
+        smallest_set = min(sets, key=len)
+        found_members = (
+            member
+            for member in smallest_set
+            if all(member in members for members in sets)
+        )
+        return list(itertools.islice(found_members, count))
+
+    @staticmethod
+    def _increase(key, value):
+        number = int(MemoryStorage._get_value(key) or 0) + value
+        MemoryStorage._data[key] = encode(number)
+        MemoryStorage._changes += 1
+        return number
+
+    @staticmethod
+    def add_records_to_index(index_name, records, digests=None, rewrite=False):
+        """
+        Same as RedisStorage.add_records_to_index.
+        """
+        if digests is None:
+            digests = [RedisStorage.get_record_digest(record) for record in records]
+        with MemoryStorage._lock:
+            ids_by_digest = MemoryStorage._get_value(f'{index_name}:digests', dict)
+            ids = MemoryStorage._get_value(f'{index_name}:ids', IndexedSet)
+            record_ids = []
+            for digest, record in zip(digests, records):
+                record_id = ids_by_digest.get(encode(digest))
+                if record_id is None:
+                    record_id = encode(
+                        MemoryStorage._increase(f'{index_name}:last-id', 1)
+                    )
+                    ids_by_digest[encode(digest)] = record_id
+                if rewrite or record_id not in ids:
+                    MemoryStorage._data[f'{index_name}:{record_id.decode()}'] = {
+                        encode(field_name): encode(field_value)
+                        for field_name, field_value in record.items()
+                    }
+                    ids.add(record_id)
+                    MemoryStorage._changes += 1
+                record_ids.append(int(record_id))
+            MemoryStorage._drop_if_empty(f'{index_name}:digests')
+            MemoryStorage._drop_if_empty(f'{index_name}:ids')
+            return record_ids
+
+    @staticmethod
+    def get_diverged_keys(keys):
+        """
+        Memory storage has a single node.
+        """
+        return []
+
+    @staticmethod
+    def copy_replicated_keys(batch_size=1000):
+        return 0, 0
+
+    @staticmethod
+    def set_index_references(index_name, owner, record_ids):
+        """
+        Same as RedisStorage.set_index_references.
+        """
+        owner_key = f'{index_name}:owners:{owner}'
+        with MemoryStorage._lock:
+            references = MemoryStorage._get_value(f'{index_name}:references', dict)
+            ids = MemoryStorage._get_value(f'{index_name}:ids', IndexedSet)
+            referenced = {encode(record_id) for record_id in record_ids}
+            removed_ids = []
+            for record_id in MemoryStorage._get_value(owner_key) or ():
+                if record_id in referenced:
+                    referenced.discard(record_id)
+                    continue
+                references_count = int(references.get(record_id, 0)) - 1
+                if references_count > 0:
+                    references[record_id] = encode(references_count)
+                    continue
+                references.pop(record_id, None)
+                ids.discard(record_id)
+                MemoryStorage._data.pop(f'{index_name}:{record_id.decode()}', None)
+                removed_ids.append(int(record_id))
+            for record_id in referenced:
+                references[record_id] = encode(int(references.get(record_id, 0)) + 1)
+
+            MemoryStorage._data[owner_key] = IndexedSet(map(encode, record_ids))
+            for key in (owner_key, f'{index_name}:references', f'{index_name}:ids'):
+                MemoryStorage._drop_if_empty(key)
+            MemoryStorage._changes += 1
+            return removed_ids
+
+    @staticmethod
+    def add_members_to_sets(members_by_key):
+        with MemoryStorage._lock:
+            for key, members in members_by_key.items():
+                value = MemoryStorage._get_value(key, IndexedSet)
+                for member in members:
+                    value.add(encode(member))
+            MemoryStorage._changes += 1
+
+    @staticmethod
+    def remove_members_from_set(key, members):
+        with MemoryStorage._lock:
+            return MemoryStorage._call('SREM', key, *members)
+
+    @staticmethod
+    def is_replicated(key):
+        """
+        Memory storage has a single node.
+        """
+        return False
+
+    @staticmethod
+    def get_set_members(key):
+        with MemoryStorage._lock:
+            return [member.decode() for member in MemoryStorage._get_value(key) or ()]
+
+    @staticmethod
+    def get_sets_sizes(keys):
+        with MemoryStorage._lock:
+            return [len(MemoryStorage._get_value(key) or ()) for key in keys]
+
+    @staticmethod
+    def get_sets_intersection(keys, count=None):
+        with MemoryStorage._lock:
+            return [
+                member.decode()
+                for member in MemoryStorage._get_intersection(keys, count)
+            ]
+
+    get_record_digest = staticmethod(RedisStorage.get_record_digest)
+
+    @staticmethod
+    def get_random_member(set_name):
+        with MemoryStorage._lock:
+            random_member = MemoryStorage._call('SRANDMEMBER', set_name)
+        return random_member if random_member is None else random_member.decode()
+
+    @staticmethod
+    def get_random_members(set_name, count):
+        with MemoryStorage._lock:
+            value = MemoryStorage._get_value(set_name)
+            random_members = [] if value is None else value.sample(count)
+        return [random_member.decode() for random_member in random_members]
+
+    @staticmethod
+    def get_hash(key, encoding='utf-8'):
+        """
+        :param encoding: values are returned as bytes if it is None.
+        """
+        with MemoryStorage._lock:
+            value = dict(MemoryStorage._get_value(key) or {})
+        if encoding is None:
+            return value
+        return {
+            field_name.decode(encoding): field_value.decode(encoding)
+            for field_name, field_value in value.items()
+        }
+
+    @staticmethod
+    def get_hashes(keys):
+        with MemoryStorage._lock:
+            return [dict(MemoryStorage._get_value(key) or {}) for key in keys]
+
+    @staticmethod
+    def get_hash_field(key, field_name):
+        with MemoryStorage._lock:
+            value = MemoryStorage._call('HGET', key, field_name)
+        return value if value is None else value.decode()
+
+    @staticmethod
+    def get_hashes_field(keys, field_name):
+        with MemoryStorage._lock:
+            values = [MemoryStorage._call('HGET', key, field_name) for key in keys]
+        return [value if value is None else value.decode() for value in values]
+
+    @staticmethod
+    def delete_hash_fields(key, field_names):
+        with MemoryStorage._lock:
+            value = MemoryStorage._get_value(key) or {}
+            deleted_count = sum(
+                value.pop(encode(field_name), None) is not None
+                for field_name in field_names
+            )
+            MemoryStorage._drop_if_empty(key)
+            MemoryStorage._changes += deleted_count
+            return deleted_count
+
+    @staticmethod
+    def get_hash_fields(key, field_names):
+        with MemoryStorage._lock:
+            values = MemoryStorage._call('HMGET', key, *field_names)
+        return [value if value is None else value.decode() for value in values]
+
+    @staticmethod
+    def set_hash(key, mapping):
+        with MemoryStorage._lock:
+            value = MemoryStorage._get_value(key, dict)
+            added_count = 0
+            for field_name, field_value in mapping.items():
+                added_count += encode(field_name) not in value
+                value[encode(field_name)] = encode(field_value)
+            MemoryStorage._changes += 1
+            return added_count
+
+    @staticmethod
+    def increase_hash_value(key, field_name, value=1):
+        with MemoryStorage._lock:
+            hash_value = MemoryStorage._get_value(key, dict)
+            number = int(hash_value.get(encode(field_name), 0)) + value
+            hash_value[encode(field_name)] = encode(number)
+            MemoryStorage._changes += 1
+            return number
+
+    @staticmethod
+    def set(key, value):
+        with MemoryStorage._lock:
+            MemoryStorage._data[key] = encode(value)
+            MemoryStorage._expires.pop(key, None)
+            MemoryStorage._changes += 1
+            return True
+
+    @staticmethod
+    def get(key):
+        with MemoryStorage._lock:
+            value = MemoryStorage._get_value(key)
+        return value if value is None else value.decode()
+
+    @staticmethod
+    def increase_value(key, value=1):
+        with MemoryStorage._lock:
+            return MemoryStorage._increase(key, value)
+
+    @staticmethod
+    def delete(key):
+        with MemoryStorage._lock:
+            deleted = MemoryStorage._get_value(key) is not None
+            MemoryStorage._data.pop(key, None)
+            MemoryStorage._expires.pop(key, None)
+            MemoryStorage._changes += deleted
+            return int(deleted)
+
+    @staticmethod
+    def get_many(keys):
+        with MemoryStorage._lock:
+            values = [MemoryStorage._get_value(key) for key in keys]
+        return [value if value is None else value.decode() for value in values]
+
+    @staticmethod
+    def scan_keys(pattern, batch_size=1000):
+        """
+        Yields lists of keys matching pattern, which existed
+        when scanning started.
+        """
+        with MemoryStorage._lock:
+            keys = [
+                key
+                for key in list(MemoryStorage._data)
+                if fnmatch.fnmatchcase(key, pattern)
+                and MemoryStorage._get_value(key) is not None
+            ]
+        for start in range(0, len(keys), batch_size):
+            end = start + batch_size
+            yield keys[start:end]
+
+    @staticmethod
+    def set_expiration(key, seconds):
+        with MemoryStorage._lock:
+            if MemoryStorage._get_value(key) is None:
+                return False
+            MemoryStorage._expires[key] = time.time() + seconds
+            MemoryStorage._changes += 1
+            return True
+
+    @staticmethod
+    def set_sorted_set_values(key, mapping):
+        with MemoryStorage._lock:
+            value = MemoryStorage._get_value(key, SortedSet)
+            added_count = sum(
+                value.set(encode(member), float(score))
+                for member, score in mapping.items()
+            )
+            MemoryStorage._changes += 1
+            return added_count
+
+    @staticmethod
+    def increase_sorted_set_value(key, member, value=1):
+        with MemoryStorage._lock:
+            scores = MemoryStorage._get_value(key, SortedSet)
+            score = (scores.get(encode(member)) or 0.0) + value
+            scores.set(encode(member), score)
+            MemoryStorage._changes += 1
+            return score
+
+    @staticmethod
+    def get_sorted_set_top(key, count):
+        """
+        :return: list of (member, score) pairs with the highest scores,
+        members with equal scores are ordered as by ZREVRANGE.
+        """
+        with MemoryStorage._lock:
+            top = (MemoryStorage._get_value(key) or SortedSet()).get_top(count)
+        return [(member.decode(), int(score)) for member, score in top]
+
+    @staticmethod
+    def get_sorted_sets_ranks(keys, member):
+        """
+        :return: list of (rank, score) pairs of member in every sorted set,
+        rank is counted from 1 for the highest score, None if member is absent.
+        """
+        member = encode(member)
+        ranks = []
+        with MemoryStorage._lock:
+            for key in keys:
+                scores = MemoryStorage._get_value(key) or SortedSet()
+                rank = scores.get_reverse_rank(member)
+                if rank is None:
+                    ranks.append((None, 0))
+                    continue
+                ranks.append((rank + 1, int(scores.get(member))))
+        return ranks
+
+
+instrument_static_methods(
+    MemoryStorage,
+    REDIS_CALL_LATENCY,
+    exclude=(
+        'initialize',
+        'pipeline',
+        'register_script',
+        'get_record_digest',
+        'save_snapshot',
+    ),
+    storage='memory',
+)
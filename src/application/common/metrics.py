@@ -0,0 +1,243 @@
+import time
+import bisect
+import asyncio
+import inspect
+import logging
+import functools
+import threading
+import contextlib
+
+logger = logging.getLogger(__name__)
+
+
+class Registry:
+    """
+    Collection of metrics rendered in Prometheus text exposition format.
+    """
+
+    def __init__(self):
+        self._metrics = []
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            if any(registered.name == metric.name for registered in self._metrics):
+                raise ValueError(f'Metric {metric.name} is already registered.')
+            self._metrics.append(metric)
+
+    def render(self):
+        with self._lock:
+            metrics = list(self._metrics)
+        return ''.join(metric.render() for metric in metrics)
+
+
+REGISTRY = Registry()
+
+
+class Metric:
+    """
+    Base class of metrics with labels. Values are kept per combination
+    of label values, which are passed as keyword arguments.
+    """
+
+    TYPE = None
+
+    def __init__(self, name, documentation, labelnames=(), registry=REGISTRY):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        registry.register(self)
+
+    def render(self):
+        lines = [
+            f'# HELP {self.name} {self.documentation}',
+            f'# TYPE {self.name} {self.TYPE}',
+        ]
+        with self._lock:
+            values = sorted(self._values.items())
+        for label_values, value in values:
+            lines.extend(self._render_samples(label_values, value))
+        return '\n'.join(lines) + '\n'
+
+    def _get_label_values(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(
+                'Metric {} expects labels {}, got {}.'.format(
+                    self.name, ', '.join(self.labelnames), ', '.join(labels)
+                )
+            )
+        return tuple(str(labels[labelname]) for labelname in self.labelnames)
+
+    def _format_labels(self, label_values, **extra_labels):
+        labels = list(zip(self.labelnames, label_values)) + list(extra_labels.items())
+        if not labels:
+            return ''
+        return '{{{}}}'.format(
+            ','.join(f'{name}="{escape_label_value(value)}"' for name, value in labels)
+        )
+
+    def _render_samples(self, label_values, value):
+        raise NotImplementedError
+
+
+class Counter(Metric):
+    TYPE = 'counter'
+
+    def inc(self, amount=1, **labels):
+        label_values = self._get_label_values(labels)
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def get(self, **labels):
+        with self._lock:
+            return self._values.get(self._get_label_values(labels), 0)
+
+    def _render_samples(self, label_values, value):
+        return [f'{self.name}{self._format_labels(label_values)} {value}']
+
+
+class Histogram(Metric):
+    """
+    Counts observed values in cumulative buckets, keeps their sum and count.
+    """
+
+    TYPE = 'histogram'
+    DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    def __init__(
+        self,
+        name,
+        documentation,
+        labelnames=(),
+        buckets=DEFAULT_BUCKETS,
+        registry=REGISTRY,
+    ):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, documentation, labelnames, registry)
+
+    def observe(self, value, **labels):
+        label_values = self._get_label_values(labels)
+        bucket_index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            observations = self._values.get(label_values)
+            if observations is None:
+                observations = self._values[label_values] = {
+                    'buckets': [0] * (len(self.buckets) + 1),
+                    'sum': 0,
+                    'count': 0,
+                }
+            observations['buckets'][bucket_index] += 1
+            observations['sum'] += value
+            observations['count'] += 1
+
+    @contextlib.contextmanager
+    def time(self, **labels):
+        """
+        Observe seconds spent in the block, also when it raises.
+        """
+        started_at = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started_at, **labels)
+
+    def get_count(self, **labels):
+        with self._lock:
+            observations = self._values.get(self._get_label_values(labels))
+            return observations['count'] if observations else 0
+
+    def _render_samples(self, label_values, value):
+        samples = []
+        cumulative_count = 0
+        for upper_bound, bucket_count in zip((*self.buckets, '+Inf'), value['buckets']):
+            cumulative_count += bucket_count
+            labels = self._format_labels(label_values, le=upper_bound)
+            samples.append(f'{self.name}_bucket{labels} {cumulative_count}')
+        labels = self._format_labels(label_values)
+        samples.append(f'{self.name}_sum{labels} {value["sum"]}')
+        samples.append(f'{self.name}_count{labels} {value["count"]}')
+        return samples
+
+
+def escape_label_value(value):
+    return str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+
+def timed(histogram, **labels):
+    """
+    Decorator which observes duration of calls of a function
+    or a coroutine function in the histogram.
+    """
+
+    def decorator(function):
+        if asyncio.iscoroutinefunction(function):
+
+            @functools.wraps(function)
+            async def async_wrapper(*args, **kwargs):
+                with histogram.time(**labels):
+                    return await function(*args, **kwargs)
+
+            return async_wrapper
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with histogram.time(**labels):
+                return function(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def instrument_static_methods(cls, histogram, labelname='method', exclude=(), **labels):
+    """
+    Observe duration of every public static method of the class in the histogram,
+    labelled by method name and the given labels. Generator functions
+    are not instrumented, as they return before doing any work.
+    """
+    for name, attribute in list(vars(cls).items()):
+        if (
+            name.startswith('_')
+            or name in exclude
+            or not isinstance(attribute, staticmethod)
+            or inspect.isgeneratorfunction(attribute.__func__)
+        ):
+            continue
+        instrumented = timed(histogram, **labels, **{labelname: name})(
+            attribute.__func__
+        )
+        setattr(cls, name, staticmethod(instrumented))
+    return cls
+
+
+def start_metrics_server(port, host='0.0.0.0', registry=REGISTRY):
+    """
+    Serve metrics of the registry on http://host:port/metrics
+    from a daemon thread. http.server is imported here,
+    so processes without metrics do not load it.
+    """
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class MetricsRequestHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] != '/metrics':
+                self.send_error(404)
+                return None
+
+            payload = registry.render().encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), MetricsRequestHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    logger.info(f'Metrics are served on http://{host}:{port}/metrics.')
+    return server
@@ -0,0 +1,43 @@
+import hashlib
+
+
+class SeededPermutation:
+    """
+    Pseudorandom permutation of range(size) defined by a seed.
+    Element at any position is computed in O(1) without materializing
+    the permutation: a Feistel network permutes the smallest power of four
+    covering size and values outside of range(size) are skipped by cycle walking.
+    """
+
+    ROUNDS = 4
+
+    def __init__(self, size, seed):
+        if size <= 0:
+            raise ValueError('Permutation size should be positive.')
+        self.size = size
+        self.seed = seed
+        self._half_bits = max(1, ((size - 1).bit_length() + 1) // 2)
+        self._half_mask = (1 << self._half_bits) - 1
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, index):
+        if not 0 <= index < self.size:
+            raise IndexError('Permutation index out of range.')
+        value = self._encrypt(index)
+        while value >= self.size:
+            value = self._encrypt(value)
+        return value
+
+    def _encrypt(self, value):
+        left, right = value >> self._half_bits, value & self._half_mask
+        for round_number in range(SeededPermutation.ROUNDS):
+            left, right = right, left ^ self._round_function(right, round_number)
+        return (left << self._half_bits) | right
+
+    def _round_function(self, value, round_number):
+        digest = hashlib.blake2b(
+            f'{self.seed}:{round_number}:{value}'.encode(), digest_size=8
+        ).digest()
+        return int.from_bytes(digest, 'big') & self._half_mask
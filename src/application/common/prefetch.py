@@ -0,0 +1,103 @@
+import os
+import time
+import logging
+import threading
+import collections
+
+from application.common.metrics import Counter, Histogram
+
+logger = logging.getLogger(__name__)
+
+PREFETCH_REFILL_LATENCY = Histogram(
+    'quiz_prefetch_refill_seconds',
+    'Duration of fetching a batch of items into a prefetch buffer.',
+    labelnames=('name',),
+)
+PREFETCH_ITEMS = Counter(
+    'quiz_prefetch_items_total',
+    'Items fetched into a prefetch buffer.',
+    labelnames=('name',),
+)
+PREFETCH_UNDERFLOWS = Counter(
+    'quiz_prefetch_underflows_total',
+    'Items requested from an empty prefetch buffer.',
+    labelnames=('name',),
+)
+
+
+class Prefetcher:
+    """
+    Ring buffer of items fetched ahead in batches by a background thread,
+    so taking an item is a local pop. Buffer is refilled when it is
+    half empty. Thread is started on the first take in every process,
+    so a prefetcher created before fork serves forked workers too.
+    """
+
+    REFILL_RETRY_INTERVAL = 1
+
+    def __init__(self, fetch, size=1000, batch_size=100, name='items'):
+        """
+        :param fetch: function(count) which returns a list of up to count items.
+        :param name: label value of metrics of the buffer.
+        """
+        self.fetch = fetch
+        self.size = size
+        self.batch_size = batch_size
+        self.name = name
+        self._buffer = collections.deque(maxlen=size)
+        self._refill_requested = threading.Event()
+        self._start_lock = threading.Lock()
+        self._pid = None
+
+    def __len__(self):
+        return len(self._buffer)
+
+    def take(self):
+        """
+        :return: next item, None if the buffer is empty.
+        """
+        if self._pid != os.getpid():
+            with self._start_lock:
+                if self._pid != os.getpid():
+                    self._start()
+        try:
+            item = self._buffer.popleft()
+        except IndexError:
+            PREFETCH_UNDERFLOWS.inc(name=self.name)
+            self._refill_requested.set()
+            return None
+        if len(self._buffer) < self.size // 2:
+            self._refill_requested.set()
+        return item
+
+    def refill(self):
+        """
+        Fetch items until the buffer is full.
+        :return: number of fetched items.
+        """
+        fetched_count = 0
+        while len(self._buffer) < self.size:
+            with PREFETCH_REFILL_LATENCY.time(name=self.name):
+                items = self.fetch(min(self.batch_size, self.size - len(self._buffer)))
+            if not items:
+                break
+            self._buffer.extend(items)
+            PREFETCH_ITEMS.inc(len(items), name=self.name)
+            fetched_count += len(items)
+        return fetched_count
+
+    def _start(self):
+        self._pid = os.getpid()
+        self._refill_requested = threading.Event()
+        self._refill_requested.set()
+        threading.Thread(target=self._work, daemon=True).start()
+
+    def _work(self):
+        while True:
+            self._refill_requested.wait()
+            self._refill_requested.clear()
+            try:
+                self.refill()
+            except Exception as e:
+                logger.error(f'Failed to refill {self.name} buffer, error: {str(e)}')
+                time.sleep(Prefetcher.REFILL_RETRY_INTERVAL)
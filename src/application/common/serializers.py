@@ -0,0 +1,142 @@
+import zlib
+
+
+class HashSerializer:
+    """
+    Every field of a record is stored as a hash field under its own name.
+    """
+
+    def __init__(self, fields):
+        self.fields = fields
+
+    def get_field_name(self, field_name):
+        return field_name
+
+    def dumps(self, record):
+        """
+        :param record: dict of field name: text.
+        :return: mapping which is stored in redis hash.
+        """
+        return dict(record)
+
+    def loads(self, stored_fields):
+        """
+        :param stored_fields: dict of stored field name: bytes.
+        :return: dict of field name: text.
+        """
+        return {
+            field_name.decode(): value.decode()
+            for field_name, value in stored_fields.items()
+        }
+
+
+class CompactHashSerializer:
+    """
+    Fields which are read separately are stored under one letter names.
+    The rest are packed in declared order into a single hash field,
+    which is compressed with zlib when it is longer than compress_threshold
+    bytes. SEPARATOR and ESCAPE characters in packed values are escaped.
+    Optional zdict is a preset zlib dictionary, it has to be the same
+    for writing and reading records.
+    """
+
+    PACKED_FIELD_NAME = 'x'
+    SEPARATOR = '\x1f'
+    ESCAPE = '\x1b'
+    ESCAPES = ((ESCAPE, ESCAPE + '0'), (SEPARATOR, ESCAPE + '1'))
+    PLAIN, COMPRESSED = b'p', b'z'
+
+    def __init__(self, fields, packed_fields, compress_threshold=128, zdict=None):
+        self.fields = fields
+        self.packed_fields = packed_fields
+        self.compress_threshold = compress_threshold
+        self.zdict = zdict
+        self._short_names = {
+            field_name: field_name[0]
+            for field_name in fields
+            if field_name not in packed_fields
+        }
+        self._full_names = {
+            short_name: field_name
+            for field_name, short_name in self._short_names.items()
+        }
+        if len(self._full_names) != len(self._short_names):
+            raise ValueError(
+                'Separately stored fields should start with distinct letters.'
+            )
+
+    def get_field_name(self, field_name):
+        return self._short_names[field_name]
+
+    def dumps(self, record):
+        stored_fields = {
+            short_name: record[field_name]
+            for field_name, short_name in self._short_names.items()
+        }
+        packed = CompactHashSerializer.SEPARATOR.join(
+            CompactHashSerializer.escape(record[field_name])
+            for field_name in self.packed_fields
+        ).encode()
+        if len(packed) > self.compress_threshold:
+            compressed = self._compress(packed)
+            if len(compressed) < len(packed):
+                stored_fields[CompactHashSerializer.PACKED_FIELD_NAME] = (
+                    CompactHashSerializer.COMPRESSED + compressed
+                )
+                return stored_fields
+        stored_fields[CompactHashSerializer.PACKED_FIELD_NAME] = (
+            CompactHashSerializer.PLAIN + packed
+        )
+        return stored_fields
+
+    def loads(self, stored_fields):
+        record = {
+            self._full_names[short_name.decode()]: value.decode()
+            for short_name, value in stored_fields.items()
+            if short_name.decode() != CompactHashSerializer.PACKED_FIELD_NAME
+        }
+        packed = stored_fields[CompactHashSerializer.PACKED_FIELD_NAME.encode()]
+        if packed[:1] == CompactHashSerializer.COMPRESSED:
+            packed = self._decompress(packed[1:])
+        else:
+            packed = packed[1:]
+        packed_values = packed.decode().split(CompactHashSerializer.SEPARATOR)
+        if len(packed_values) != len(self.packed_fields):
+            raise ValueError(
+                f'Packed field has {len(packed_values)} values, '
+                f'expected {len(self.packed_fields)}.'
+            )
+        record.update(
+            zip(self.packed_fields, map(CompactHashSerializer.unescape, packed_values))
+        )
+        return record
+
+    @staticmethod
+    def escape(value):
+        for character, escaped in CompactHashSerializer.ESCAPES:
+            value = value.replace(character, escaped)
+        return value
+
+    @staticmethod
+    def unescape(value):
+        """
+        Every ESCAPE character of an escaped value starts an escape sequence,
+        so sequences are replaced in reverse order of escaping.
+        """
+        for character, escaped in reversed(CompactHashSerializer.ESCAPES):
+            value = value.replace(escaped, character)
+        return value
+
+    def _compress(self, data):
+        if self.zdict is None:
+            compressor = zlib.compressobj(9)
+        else:
+            compressor = zlib.compressobj(9, zdict=self.zdict)
+        return compressor.compress(data) + compressor.flush()
+
+    def _decompress(self, data):
+        if self.zdict is None:
+            decompressor = zlib.decompressobj()
+        else:
+            decompressor = zlib.decompressobj(zdict=self.zdict)
+        return decompressor.decompress(data) + decompressor.flush()
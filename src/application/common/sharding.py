@@ -0,0 +1,108 @@
+import re
+import bisect
+import random
+import hashlib
+
+
+def get_ring_position(value):
+    """
+    Stable across processes, unlike hash() of strings.
+    """
+    return int.from_bytes(hashlib.md5(value.encode()).digest()[:8], 'big')
+
+
+class ConsistentHashRing:
+    """
+    Maps keys to nodes. Every node owns many points of the ring,
+    a key belongs to the node of the first point after the key position,
+    so adding or removing one of N nodes moves only about 1/N of keys.
+    """
+
+    def __init__(self, nodes, points_per_node=100):
+        """
+        :param nodes: dict of node name: node.
+        """
+        points = sorted(
+            (get_ring_position(f'{name}#{point}'), node_index)
+            for node_index, name in enumerate(nodes)
+            for point in range(points_per_node)
+        )
+        self._nodes = list(nodes.values())
+        self._positions = [position for position, _ in points]
+        self._point_nodes = [node_index for _, node_index in points]
+
+    def get_node(self, key):
+        index = bisect.bisect(self._positions, get_ring_position(key))
+        return self._nodes[self._point_nodes[index % len(self._positions)]]
+
+
+class ShardedRedis:
+    """
+    Routes keys to several redis nodes:
+    - keys with one of replicated prefixes (read-mostly data, e.g. questions)
+    are written to every node and read from any of them, reads which decide
+    what to write, e.g. allocation of ids, go to the primary, the first node,
+    - other keys are kept on one node chosen by consistent hashing.
+    Keys ending with '_<number>' are routed by the number, so all keys
+    of a user are on the same node, e.g. users_questions_1 and users_ratings_1.
+    """
+
+    rx_user_id = re.compile(r'_(\d+)$')
+
+    def __init__(self, connections, replicated_prefixes=()):
+        """
+        :param connections: dict of node name, e.g. url: redis client.
+        """
+        self.connections = list(connections.values())
+        self.primary = self.connections[0]
+        self.replicated_prefixes = tuple(replicated_prefixes)
+        self._ring = ConsistentHashRing(connections)
+
+    def is_replicated(self, key):
+        return key.startswith(self.replicated_prefixes)
+
+    def get_node(self, key):
+        match = ShardedRedis.rx_user_id.search(key)
+        return self._ring.get_node(match.group(1) if match else key)
+
+    def get_reader(self, key):
+        if self.is_replicated(key):
+            return random.choice(self.connections)
+        return self.get_node(key)
+
+    def get_readers(self, keys):
+        """
+        :return: list of connections to read keys from, replicated keys
+        are read from the same node, so keys take as few round trips as possible.
+        """
+        replica = random.choice(self.connections)
+        return [
+            replica if self.is_replicated(key) else self.get_node(key) for key in keys
+        ]
+
+    def get_writers(self, key):
+        if self.is_replicated(key):
+            return self.connections
+        return [self.get_node(key)]
+
+    def get_script_connections(self, keys, read_only=False, primary=False):
+        """
+        Script runs on the node of its not replicated keys,
+        which have to be on the same node. Script with only replicated keys
+        runs on any node if it is read only and on every node otherwise.
+        :param primary: read only script with only replicated keys
+        runs on the primary node.
+        """
+        nodes = {
+            id(node): node
+            for node in (
+                self.get_node(key) for key in keys if not self.is_replicated(key)
+            )
+        }
+        if len(nodes) > 1:
+            raise ValueError(f'Keys {", ".join(keys)} are kept on different nodes.')
+        if nodes:
+            return list(nodes.values())
+        if read_only:
+            return [self.primary if primary else random.choice(self.connections)]
+        return self.connections
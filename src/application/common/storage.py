@@ -0,0 +1,22 @@
+from application.common.database import RedisStorage
+from application.common.memory_storage import MemoryStorage
+
+
+class Storage:
+    """
+    Storage engine of models and commands, they call Storage.engine,
+    which is one of ENGINES sharing the interface of RedisStorage:
+    redis - RedisStorage,
+    memory - MemoryStorage, data in memory of the process with snapshots.
+    """
+
+    ENGINES = {'redis': RedisStorage, 'memory': MemoryStorage}
+    engine = RedisStorage
+
+    @staticmethod
+    def initialize(engine_name, **settings):
+        """
+        :param settings: settings of the engine initialize method.
+        """
+        Storage.engine = Storage.ENGINES[engine_name]
+        Storage.engine.initialize(**settings)
@@ -0,0 +1,49 @@
+import logging
+import queue
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+class KeyOrderedWorkerPool:
+    """
+    Pool of worker threads. Items submitted with the same key are handled
+    by the same worker, so they are processed in submission order, while
+    items with different keys are processed concurrently.
+    Every worker has a bounded queue, submit blocks when it is full.
+    """
+
+    _STOP = object()
+
+    def __init__(self, handler, workers=4, queue_size=1000):
+        if workers < 1:
+            raise ValueError(f'Pool needs at least 1 worker, got {workers}.')
+        self._handler = handler
+        self._queues = [queue.Queue(maxsize=queue_size) for _ in range(workers)]
+        self._threads = [
+            threading.Thread(target=self._work, args=(work_queue,), daemon=True)
+            for work_queue in self._queues
+        ]
+
+    def start(self):
+        for thread in self._threads:
+            thread.start()
+
+    def stop(self):
+        for work_queue in self._queues:
+            work_queue.put(KeyOrderedWorkerPool._STOP)
+        for thread in self._threads:
+            thread.join()
+
+    def submit(self, key, item):
+        self._queues[hash(key) % len(self._queues)].put(item)
+
+    def _work(self, work_queue):
+        while True:
+            item = work_queue.get()
+            if item is KeyOrderedWorkerPool._STOP:
+                return None
+            try:
+                self._handler(item)
+            except Exception as e:
+                logger.exception(f'Item {str(item)} caused error {str(e)}.')
@@ -1,8 +1,22 @@
+import json
+import asyncio
+import collections
 import logging
+import random
+import datetime
 import reprlib
-from dataclasses import dataclass, field
+from dataclasses import dataclass, field, asdict
 
-from application.common.database import RedisStorage
+from application.common.database import AsyncRedisStorage
+from application.common.memory_storage import MemoryStorage
+from application.common.storage import Storage
+from application.common.permutation import SeededPermutation
+from application.common.cache import LRUCache
+from application.common.corpus import CorpusFile
+from application.common.prefetch import Prefetcher
+from application.common.serializers import HashSerializer, CompactHashSerializer
+from application.answers import Answer
+from application.search import tokenize
 
 logger = logging.getLogger(__name__)
 
@@ -14,48 +28,926 @@ class QuizQuestion:
     comment: str = field(repr=False)
     source: str = field(repr=False)
     author: str = field(repr=False)
+    category: str = field(default='', repr=False)
+    id: int = field(default=None)
     COLLECTION: str = field(default='quiz-questions', repr=False)
 
+    # Category buckets may keep ids of removed questions,
+    # they are removed from the bucket when drawn. Writes after SRANDMEMBER
+    # need effects replication, which is the default since redis 5.
+    # Replicated buckets are not changed by the script, which runs on one node,
+    # its reply lists the bucket and removed ids after the question instead,
+    # so the caller removes them on every node.
+    RANDOM_QUESTION_SCRIPT = '''
+        if redis.replicate_commands then
+            redis.replicate_commands()
+        end
+        local bucket = KEYS[1]
+        local category = KEYS[2] and redis.call('GET', KEYS[2])
+        if category then
+            bucket = ARGV[1] .. ':categories:' .. category
+        end
+        local reply = {false, false, bucket}
+        for _ = 1, 10 do
+            local question_id = redis.call('SRANDMEMBER', bucket)
+            if not question_id then
+                break
+            end
+            if bucket == KEYS[1]
+                    or redis.call('SISMEMBER', KEYS[1], question_id) == 1 then
+                local question_key = ARGV[1] .. ':' .. question_id
+                reply[1] = question_id
+                reply[2] = redis.call('HGET', question_key, ARGV[2])
+                break
+            end
+            if ARGV[3] == '1' then
+                redis.call('SREM', bucket, question_id)
+            else
+                table.insert(reply, question_id)
+            end
+        end
+        if not reply[1] and #reply == 3 then
+            return nil
+        end
+        return reply
+    '''
+
+    # A random sample of the smallest set, e.g. of the only word of the topic,
+    # is checked against the other sets, so the whole intersection is built
+    # only if the smallest set is not larger than the sample
+    # or no sampled question matches.
+    TOPIC_QUESTION_SCRIPT = '''
+        local sets = {}
+        for i, key in ipairs(KEYS) do
+            sets[i] = {key, redis.call('SCARD', key)}
+        end
+        table.sort(sets, function(a, b) return a[2] < b[2] end)
+
+        local sample = {}
+        if sets[1][2] > tonumber(ARGV[4]) then
+            sample = redis.call('SRANDMEMBER', sets[1][1], ARGV[4])
+        end
+        local question_ids = {}
+        for _, question_id in ipairs(sample) do
+            local found = true
+            for i = 2, #sets do
+                if redis.call('SISMEMBER', sets[i][1], question_id) == 0 then
+                    found = false
+                    break
+                end
+            end
+            if found then
+                table.insert(question_ids, question_id)
+            end
+        end
+        if #question_ids == 0 then
+            question_ids = redis.call('SINTER', unpack(KEYS))
+        end
+        if #question_ids == 0 then
+            return nil
+        end
+
+        local question_id = question_ids[math.floor(ARGV[3] * #question_ids) + 1]
+        local question = redis.call('HGET', ARGV[1] .. ':' .. question_id, ARGV[2])
+        return {question_id, question}
+    '''
+    TOPIC_SAMPLE_SIZE = 100
+
+    # Fields which are searched by words.
+    INDEXED_FIELDS = ('question', 'answer', 'comment', 'author')
+
+    # Fields which identify a question, category is not one of them,
+    # so a question from several tournaments is saved once.
+    CONTENT_FIELDS = ('question', 'answer', 'comment', 'source', 'author')
+
+    STORED_FIELDS = (*CONTENT_FIELDS, 'category', 'variants')
+    # Comment, source, author and category are only read with the whole question,
+    # compact serializer packs and compresses them into one field.
+    SERIALIZERS = {
+        'plain': HashSerializer(STORED_FIELDS),
+        'compact': CompactHashSerializer(
+            STORED_FIELDS, packed_fields=('comment', 'source', 'author', 'category')
+        ),
+    }
+    serializer = SERIALIZERS['plain']
+    # Memory-mapped export of stored questions, which is read instead
+    # of storage if it is set. Questions added after the export
+    # are read from storage.
+    corpus = None
+
     def __post_init__(self):
         if not self.question:
             raise ValueError('Question text is not presented.')
         if not self.answer:
             raise ValueError('Answer text is not presented.')
 
+    @staticmethod
+    def initialize_serializer(name):
+        QuizQuestion.serializer = QuizQuestion.SERIALIZERS[name]
+
+    @staticmethod
+    def initialize_corpus(path):
+        QuizQuestion.corpus = CorpusFile(path) if path else None
+
+    @staticmethod
+    def get_field_name(field_name):
+        return QuizQuestion.serializer.get_field_name(field_name)
+
+    def get_stored_fields(self):
+        question_dict = asdict(self)
+        del question_dict['id']
+        del question_dict['COLLECTION']
+        return question_dict
+
     def save_to_db(self):
-        return RedisStorage.add_records_to_set(QuizQuestion.COLLECTION, self)
+        return QuizQuestion.bulk_save_to_db([self])
 
     @staticmethod
-    def bulk_save_to_db(quiz_questions_list):
-        return RedisStorage.add_records_to_set(
-            QuizQuestion.COLLECTION, quiz_questions_list
+    def bulk_save_to_db(quiz_questions_list, rewrite=False):
+        """
+        Questions are identified by digest of their content fields,
+        so it does not depend on the serializer.
+        :param rewrite: replace stored fields of questions which already exist.
+        :return: list of ids of saved questions.
+        """
+        stored_fields = [
+            quiz_question.get_stored_fields() for quiz_question in quiz_questions_list
+        ]
+        question_ids = Storage.engine.add_records_to_index(
+            QuizQuestion.COLLECTION,
+            [
+                QuizQuestion.serializer.dumps(
+                    dict(fields, variants=Answer(fields['answer']).dump_variants())
+                )
+                for fields in stored_fields
+            ],
+            [
+                Storage.engine.get_record_digest(
+                    {
+                        field_name: fields[field_name]
+                        for field_name in QuizQuestion.CONTENT_FIELDS
+                    }
+                )
+                for fields in stored_fields
+            ],
+            rewrite,
         )
+        QuizQuestion.add_to_indexes(stored_fields, question_ids)
+        return question_ids
+
+    @staticmethod
+    def add_to_indexes(stored_fields, question_ids):
+        """
+        Inverted index: every stem of indexed fields has a set of ids
+        of questions where it occurs. Category buckets: every category
+        has a set of ids of its questions. Ids of removed questions are left
+        in the sets, lookups intersect them with the set of existing ids.
+        """
+        ids_by_key = collections.defaultdict(set)
+        for fields, question_id in zip(stored_fields, question_ids):
+            for field_name in QuizQuestion.INDEXED_FIELDS:
+                for token in tokenize(fields[field_name]):
+                    ids_by_key[QuizQuestion.get_token_key(token)].add(question_id)
+            if fields['category']:
+                category_key = QuizQuestion.get_category_key(fields['category'])
+                ids_by_key[category_key].add(question_id)
+                ids_by_key[f'{QuizQuestion.COLLECTION}:categories'].add(
+                    fields['category']
+                )
+        Storage.engine.add_members_to_sets(ids_by_key)
+
+    @staticmethod
+    def get_category_key(category):
+        return f'{QuizQuestion.COLLECTION}:categories:{category}'
+
+    @staticmethod
+    def get_categories():
+        """
+        :return: list of (category, number of questions) pairs,
+        largest categories first.
+        """
+        if QuizQuestion.corpus is not None:
+            return sorted(
+                QuizQuestion.corpus.get_groups_sizes().items(),
+                key=lambda category: (-category[1], category[0]),
+            )
+        categories = Storage.engine.get_set_members(
+            f'{QuizQuestion.COLLECTION}:categories'
+        )
+        sizes = Storage.engine.get_sets_sizes(
+            [QuizQuestion.get_category_key(category) for category in categories]
+        )
+        return sorted(
+            zip(categories, sizes), key=lambda category: (-category[1], category[0])
+        )
+
+    @staticmethod
+    async def get_categories_async():
+        categories = await AsyncRedisStorage.get_set_members(
+            f'{QuizQuestion.COLLECTION}:categories'
+        )
+        sizes = await AsyncRedisStorage.get_sets_sizes(
+            [QuizQuestion.get_category_key(category) for category in categories]
+        )
+        return sorted(
+            zip(categories, sizes), key=lambda category: (-category[1], category[0])
+        )
+
+    @staticmethod
+    def get_token_key(token):
+        return f'{QuizQuestion.COLLECTION}:tokens:{token}'
+
+    @staticmethod
+    def get_search_keys(query):
+        tokens = tokenize(query)
+        if not tokens:
+            raise ValueError(f'Query {query} has no words to search for.')
+        return [
+            *(QuizQuestion.get_token_key(token) for token in sorted(tokens)),
+            f'{QuizQuestion.COLLECTION}:ids',
+        ]
+
+    @staticmethod
+    def search(query, count=None):
+        """
+        :param count: search stops after count questions are found,
+        so they are not necessarily the ones with the lowest ids.
+        :return: sorted ids of questions which contain all words of the query.
+        """
+        question_ids = Storage.engine.get_sets_intersection(
+            QuizQuestion.get_search_keys(query), count
+        )
+        return sorted(map(int, question_ids))
+
+    @staticmethod
+    def get_random_question_text_on_topic(topic):
+        """
+        :return: id and text of a random question which contains all words
+        of the topic, found in one round trip.
+        """
+        topic_question = Storage.engine.run_script(
+            QuizQuestion.TOPIC_QUESTION_SCRIPT,
+            keys=QuizQuestion.get_search_keys(topic),
+            args=[
+                QuizQuestion.COLLECTION,
+                QuizQuestion.get_field_name('question'),
+                random.random(),
+                QuizQuestion.TOPIC_SAMPLE_SIZE,
+            ],
+            read_only=True,
+        )
+        if topic_question is None or topic_question[1] is None:
+            raise ValueError(f'There are no questions on topic {topic}.')
+        question_id, question_text = topic_question
+        return int(question_id), question_text.decode()
+
+    @staticmethod
+    async def get_random_question_text_on_topic_async(topic):
+        topic_question = await AsyncRedisStorage.run_script(
+            QuizQuestion.TOPIC_QUESTION_SCRIPT,
+            keys=QuizQuestion.get_search_keys(topic),
+            args=[
+                QuizQuestion.COLLECTION,
+                QuizQuestion.get_field_name('question'),
+                random.random(),
+                QuizQuestion.TOPIC_SAMPLE_SIZE,
+            ],
+        )
+        if topic_question is None or topic_question[1] is None:
+            raise ValueError(f'There are no questions on topic {topic}.')
+        question_id, question_text = topic_question
+        return int(question_id), question_text.decode()
+
+    @staticmethod
+    def get_key(question_id):
+        return f'{QuizQuestion.COLLECTION}:{question_id}'
+
+    @staticmethod
+    def get_random_question_id():
+        question_id = Storage.engine.get_random_member(f'{QuizQuestion.COLLECTION}:ids')
+        if question_id is None:
+            raise ValueError('There are no questions in storage.')
+        return int(question_id)
+
+    @staticmethod
+    async def get_random_question_id_async():
+        question_id = await AsyncRedisStorage.get_random_member(
+            f'{QuizQuestion.COLLECTION}:ids'
+        )
+        if question_id is None:
+            raise ValueError('There are no questions in storage.')
+        return int(question_id)
+
+    @staticmethod
+    def get_random_question_text(category_key=None):
+        """
+        :param category_key: key which holds the name of a category
+        to draw from, e.g. user's chosen category. If it is empty,
+        question is drawn from all questions.
+        :return: id and text of a random question, fetched in one round trip.
+        """
+        if QuizQuestion.corpus is not None:
+            category = category_key and Storage.engine.get(category_key)
+            question_id = QuizQuestion.corpus.get_random_id(category or None)
+            if question_id is not None:
+                return question_id, QuizQuestion.corpus.get_field(
+                    question_id, 'question'
+                )
+        random_question = Storage.engine.run_script(
+            QuizQuestion.RANDOM_QUESTION_SCRIPT,
+            keys=QuizQuestion._get_random_question_keys(category_key),
+            args=[
+                QuizQuestion.COLLECTION,
+                QuizQuestion.get_field_name('question'),
+                int(
+                    not Storage.engine.is_replicated(QuizQuestion.get_category_key(''))
+                ),
+            ],
+        )
+        if random_question is not None and len(random_question) > 3:
+            bucket, *removed_ids = random_question[2:]
+            Storage.engine.remove_members_from_set(bucket.decode(), removed_ids)
+        if random_question is None or random_question[1] is None:
+            raise ValueError('There are no questions in storage.')
+        question_id, question_text = random_question[:2]
+        return int(question_id), question_text.decode()
+
+    @staticmethod
+    def get_random_question_texts(count):
+        """
+        :return: list of id and text of up to count distinct random questions
+        drawn from all questions in two round trips.
+        """
+        if QuizQuestion.corpus is not None:
+            question_ids = {QuizQuestion.corpus.get_random_id() for _ in range(count)}
+            return [
+                (question_id, QuizQuestion.corpus.get_field(question_id, 'question'))
+                for question_id in question_ids
+                if question_id is not None
+            ]
+        question_ids = Storage.engine.get_random_members(
+            f'{QuizQuestion.COLLECTION}:ids', count
+        )
+        question_texts = Storage.engine.get_hashes_field(
+            [QuizQuestion.get_key(question_id) for question_id in question_ids],
+            QuizQuestion.get_field_name('question'),
+        )
+        return [
+            (int(question_id), question_text)
+            for question_id, question_text in zip(question_ids, question_texts)
+            if question_text is not None
+        ]
+
+    @staticmethod
+    async def get_random_question_text_async(category_key=None):
+        # Async storage has a single node, so the script removes ids itself.
+        random_question = await AsyncRedisStorage.run_script(
+            QuizQuestion.RANDOM_QUESTION_SCRIPT,
+            keys=QuizQuestion._get_random_question_keys(category_key),
+            args=[QuizQuestion.COLLECTION, QuizQuestion.get_field_name('question'), 1],
+        )
+        if random_question is None or random_question[1] is None:
+            raise ValueError('There are no questions in storage.')
+        question_id, question_text = random_question[:2]
+        return int(question_id), question_text.decode()
+
+    @staticmethod
+    def _get_random_question_keys(category_key):
+        keys = [f'{QuizQuestion.COLLECTION}:ids']
+        if category_key is not None:
+            keys.append(category_key)
+        return keys
+
+    @staticmethod
+    def get_questions_count():
+        """
+        Ids are allocated sequentially, so the last allocated id
+        is the size of the id space.
+        """
+        if QuizQuestion.corpus is not None:
+            return QuizQuestion.corpus.records_count
+        last_id = Storage.engine.get(f'{QuizQuestion.COLLECTION}:last-id')
+        return 0 if last_id is None else int(last_id)
+
+    @staticmethod
+    async def get_questions_count_async():
+        last_id = await AsyncRedisStorage.get(f'{QuizQuestion.COLLECTION}:last-id')
+        return 0 if last_id is None else int(last_id)
+
+    @staticmethod
+    def get_question_text(question_id):
+        if QuizQuestion.corpus is not None and question_id in QuizQuestion.corpus:
+            return QuizQuestion.corpus.get_field(question_id, 'question')
+        question_text = Storage.engine.get_hash_field(
+            QuizQuestion.get_key(question_id), QuizQuestion.get_field_name('question')
+        )
+        if question_text is None:
+            raise ValueError(f'Question {question_id} does not exist.')
+        return question_text
+
+    @staticmethod
+    async def get_question_text_async(question_id):
+        question_text = await AsyncRedisStorage.get_hash_field(
+            QuizQuestion.get_key(question_id), QuizQuestion.get_field_name('question')
+        )
+        if question_text is None:
+            raise ValueError(f'Question {question_id} does not exist.')
+        return question_text
+
+    @staticmethod
+    def get_answer(question_id):
+        """
+        :return: Answer with variants precomputed on saving or None.
+        """
+        if QuizQuestion.corpus is not None and question_id in QuizQuestion.corpus:
+            return Answer.load(
+                QuizQuestion.corpus.get_field(question_id, 'answer'),
+                QuizQuestion.corpus.get_field(question_id, 'variants'),
+            )
+        answer, variants = Storage.engine.get_hash_fields(
+            QuizQuestion.get_key(question_id), QuizQuestion.get_answer_field_names()
+        )
+        return answer if answer is None else Answer.load(answer, variants)
+
+    @staticmethod
+    async def get_answer_async(question_id):
+        answer, variants = await AsyncRedisStorage.get_hash_fields(
+            QuizQuestion.get_key(question_id), QuizQuestion.get_answer_field_names()
+        )
+        return answer if answer is None else Answer.load(answer, variants)
+
+    @staticmethod
+    def get_answer_field_names():
+        return [
+            QuizQuestion.get_field_name('answer'),
+            QuizQuestion.get_field_name('variants'),
+        ]
+
+    @classmethod
+    def get_by_id(cls, question_id):
+        if QuizQuestion.corpus is not None and question_id in QuizQuestion.corpus:
+            question_dict = QuizQuestion.corpus.get_record(question_id)
+        else:
+            stored_fields = Storage.engine.get_hash(
+                QuizQuestion.get_key(question_id), encoding=None
+            )
+            if not stored_fields:
+                raise ValueError(f'Question {question_id} does not exist.')
+            question_dict = QuizQuestion.serializer.loads(stored_fields)
+        question_dict.pop('variants', None)
+        return cls(**question_dict, id=question_id)
 
     @classmethod
     def get_random_question_from_storage(cls):
-        random_question_dict = RedisStorage.get_random_record_from_set(
-            QuizQuestion.COLLECTION
+        return cls.get_by_id(cls.get_random_question_id())
+
+    @staticmethod
+    def get_all_stored_fields(batch_size=1000):
+        """
+        Yields (id, dict of stored field name: text) pairs of all questions
+        in storage in ascending order of ids, read in batches.
+        Variants are computed for questions saved without them.
+        """
+        question_ids = set(
+            map(int, Storage.engine.get_set_members(f'{QuizQuestion.COLLECTION}:ids'))
+        )
+        last_id = int(Storage.engine.get(f'{QuizQuestion.COLLECTION}:last-id') or 0)
+        for start in range(1, last_id + 1, batch_size):
+            batch = [
+                question_id
+                for question_id in range(start, min(start + batch_size, last_id + 1))
+                if question_id in question_ids
+            ]
+            hashes = Storage.engine.get_hashes(
+                [QuizQuestion.get_key(question_id) for question_id in batch]
+            )
+            for question_id, stored_fields in zip(batch, hashes):
+                if not stored_fields:
+                    continue
+                fields = QuizQuestion.serializer.loads(stored_fields)
+                if fields.get('variants') is None:
+                    fields['variants'] = Answer(fields['answer']).dump_variants()
+                yield question_id, fields
+
+
+class QuizQuestionsFile:
+    """
+    Source file of questions. Manifest keeps size, modification time
+    and content digest of every saved file, so unchanged files
+    are not parsed again, and ids of questions taken from the file,
+    so questions are removed when the file is changed or deleted.
+    """
+
+    MANIFEST_KEY = f'{QuizQuestion.COLLECTION}:files'
+
+    def __init__(self, name, size, mtime, digest):
+        self.name = name
+        self.size = size
+        self.mtime = mtime
+        self.digest = digest
+
+    def is_modified(self, stored_file):
+        return stored_file is None or (self.size, self.mtime) != (
+            stored_file.size,
+            stored_file.mtime,
+        )
+
+    def save_to_db(self, question_ids):
+        """
+        :return: list of ids of questions, which were removed from storage.
+        """
+        removed_ids = Storage.engine.set_index_references(
+            QuizQuestion.COLLECTION, self.name, question_ids
+        )
+        self.update_manifest()
+        return removed_ids
+
+    def update_manifest(self):
+        return Storage.engine.set_hash(
+            QuizQuestionsFile.MANIFEST_KEY,
+            {self.name: json.dumps([self.size, self.mtime, self.digest])},
         )
-        quiz_question = cls(**random_question_dict)
-        return quiz_question
+
+    def delete_from_db(self):
+        removed_ids = Storage.engine.set_index_references(
+            QuizQuestion.COLLECTION, self.name, []
+        )
+        Storage.engine.delete_hash_fields(QuizQuestionsFile.MANIFEST_KEY, [self.name])
+        return removed_ids
+
+    @classmethod
+    def get_manifest(cls):
+        """
+        :return: dict of file name: QuizQuestionsFile of saved files.
+        """
+        manifest = Storage.engine.get_hash(QuizQuestionsFile.MANIFEST_KEY)
+        return {name: cls(name, *json.loads(info)) for name, info in manifest.items()}
 
 
 class UserQuestion:
     TABLE_PREFIX = 'users_questions'
 
-    def __init__(self, user_id, question):
+    ANSWER_SCRIPT = '''
+        local question_id = redis.call('GET', KEYS[1])
+        if not question_id then
+            return nil
+        end
+        return redis.call('HMGET', ARGV[1] .. ':' .. question_id, ARGV[2], ARGV[3])
+    '''
+
+    # Answers to users' current questions, so repeated guesses of a user
+    # do not hit redis. Entry is invalidated when the user gets a new question
+    # in this process, ttl bounds staleness if it happens in another one.
+    answers_cache = LRUCache()
+
+    def __init__(self, user_id, question_id):
         self.user_id = user_id
-        self.question = question
+        self.question_id = question_id
+
+    @staticmethod
+    def initialize_cache(max_size, ttl):
+        UserQuestion.answers_cache = LRUCache(max_size, ttl)
 
     def save_to_db(self):
         key = f'{UserQuestion.TABLE_PREFIX}_{self.user_id}'
-        return RedisStorage.set(key, self.question)
+        UserQuestion.answers_cache.invalidate(self.user_id)
+        return Storage.engine.set(key, self.question_id)
+
+    async def save_to_db_async(self):
+        key = f'{UserQuestion.TABLE_PREFIX}_{self.user_id}'
+        UserQuestion.answers_cache.invalidate(self.user_id)
+        return await AsyncRedisStorage.set(key, self.question_id)
+
+    def get_answer(self):
+        if self.question_id is None:
+            return None
+        return QuizQuestion.get_answer(self.question_id)
+
+    async def get_answer_async(self):
+        if self.question_id is None:
+            return None
+        return await QuizQuestion.get_answer_async(self.question_id)
+
+    @staticmethod
+    def get_answer_by_user_id(user_id):
+        """
+        :return: Answer to the user's current question or None,
+        fetched in one round trip or taken from cache.
+        """
+        answer = UserQuestion.answers_cache.get(user_id)
+        if answer is not None:
+            return answer
+
+        if QuizQuestion.corpus is not None:
+            answer = UserQuestion.get_by_user_id(user_id).get_answer()
+            if answer is not None:
+                UserQuestion.answers_cache.set(user_id, answer)
+            return answer
+
+        answer_fields = Storage.engine.run_script(
+            UserQuestion.ANSWER_SCRIPT,
+            keys=[f'{UserQuestion.TABLE_PREFIX}_{user_id}'],
+            args=[QuizQuestion.COLLECTION, *QuizQuestion.get_answer_field_names()],
+        )
+        if answer_fields is None or answer_fields[0] is None:
+            return None
+        answer, variants = answer_fields
+        answer = Answer.load(answer.decode(), variants and variants.decode())
+        UserQuestion.answers_cache.set(user_id, answer)
+        return answer
+
+    @staticmethod
+    async def get_answer_by_user_id_async(user_id):
+        answer = UserQuestion.answers_cache.get(user_id)
+        if answer is not None:
+            return answer
+
+        user_question = await UserQuestion.get_by_user_id_async(user_id)
+        answer = await user_question.get_answer_async()
+        if answer is not None:
+            UserQuestion.answers_cache.set(user_id, answer)
+        return answer
 
     @classmethod
     def get_by_user_id(cls, user_id):
         key = f'{UserQuestion.TABLE_PREFIX}_{user_id}'
-        question_text = RedisStorage.get(key)
-        return cls(user_id, question_text)
+        question_id = Storage.engine.get(key)
+        return cls(user_id, cls._parse_question_id(user_id, question_id))
+
+    @classmethod
+    async def get_by_user_id_async(cls, user_id):
+        key = f'{UserQuestion.TABLE_PREFIX}_{user_id}'
+        question_id = await AsyncRedisStorage.get(key)
+        return cls(user_id, cls._parse_question_id(user_id, question_id))
+
+    @staticmethod
+    def _parse_question_id(user_id, question_id):
+        try:
+            return question_id if question_id is None else int(question_id)
+        except ValueError:
+            logger.warning(
+                'User {} has question stored in outdated format.'.format(user_id)
+            )
+            return None
+
+
+class UserCategory:
+    """
+    Category of questions chosen by a user, empty category means any.
+    """
+
+    TABLE_PREFIX = 'users_categories'
+
+    # Categories of users, empty for users without one, so drawing
+    # a question does not read the category from storage every time.
+    # Entry is updated when the user chooses a category in this process,
+    # ttl bounds staleness if it happens in another one.
+    categories_cache = LRUCache()
+
+    def __init__(self, user_id, category=''):
+        self.user_id = user_id
+        self.category = category
+
+    @staticmethod
+    def initialize_cache(max_size, ttl):
+        UserCategory.categories_cache = LRUCache(max_size, ttl)
+
+    @staticmethod
+    def get_key(user_id):
+        return f'{UserCategory.TABLE_PREFIX}_{user_id}'
+
+    def save_to_db(self):
+        key = UserCategory.get_key(self.user_id)
+        UserCategory.categories_cache.set(self.user_id, self.category)
+        if not self.category:
+            return Storage.engine.delete(key)
+        return Storage.engine.set(key, self.category)
+
+    async def save_to_db_async(self):
+        key = UserCategory.get_key(self.user_id)
+        UserCategory.categories_cache.set(self.user_id, self.category)
+        if not self.category:
+            return await AsyncRedisStorage.delete(key)
+        return await AsyncRedisStorage.set(key, self.category)
+
+    @classmethod
+    def get_by_user_id(cls, user_id):
+        category = UserCategory.categories_cache.get(user_id)
+        if category is None:
+            category = Storage.engine.get(UserCategory.get_key(user_id)) or ''
+            UserCategory.categories_cache.set(user_id, category)
+        return cls(user_id, category)
+
+    @classmethod
+    async def get_by_user_id_async(cls, user_id):
+        category = UserCategory.categories_cache.get(user_id)
+        if category is None:
+            category = await AsyncRedisStorage.get(UserCategory.get_key(user_id)) or ''
+            UserCategory.categories_cache.set(user_id, category)
+        return cls(user_id, category)
+
+
+class UserState:
+    """
+    Conversation state of a user on a platform.
+    """
+
+    TABLE_PREFIX = 'users_states'
+
+    def __init__(self, platform, user_id, state=None):
+        self.platform = platform
+        self.user_id = user_id
+        self.state = state
+
+    @staticmethod
+    def get_key(platform, user_id):
+        return f'{UserState.TABLE_PREFIX}_{platform}_{user_id}'
+
+    def save_to_db(self):
+        return Storage.engine.set(
+            UserState.get_key(self.platform, self.user_id), self.state
+        )
+
+    def delete_from_db(self):
+        return Storage.engine.delete(UserState.get_key(self.platform, self.user_id))
+
+    @classmethod
+    def get_by_user_id(cls, platform, user_id):
+        state = Storage.engine.get(UserState.get_key(platform, user_id))
+        return cls(platform, user_id, state if state is None else int(state))
+
+    @staticmethod
+    def get_user_ids(platform):
+        """
+        :return: set of ids of users who have a state on the platform.
+        """
+        prefix = UserState.get_key(platform, '')
+        prefix_length = len(prefix)
+        return {
+            int(key[prefix_length:])
+            for keys in Storage.engine.scan_keys(f'{prefix}*')
+            for key in keys
+        }
+
+
+class UserDeck:
+    """
+    Non-repeating sequence of questions for a user.
+    Only a seed of the shuffled permutation of question ids and a cursor
+    are stored, so memory per user does not depend on the number of questions.
+    Deck is reshuffled when it is exhausted or the number of questions changes.
+    Ids of questions removed from storage are skipped.
+    """
+
+    TABLE_PREFIX = 'users_decks'
+    MAX_SKIPPED_QUESTIONS = 100
+
+    def __init__(self, user_id):
+        self.user_id = user_id
+
+    def draw_question(self):
+        """
+        :return: id and text of the next question in the deck.
+        """
+        for _ in range(UserDeck.MAX_SKIPPED_QUESTIONS):
+            question_id = self._draw_question_id()
+            try:
+                return question_id, QuizQuestion.get_question_text(question_id)
+            except ValueError:
+                logger.debug('Question %s was removed, skipping it.', question_id)
+        raise ValueError('There are no questions in storage.')
+
+    async def draw_question_async(self):
+        for _ in range(UserDeck.MAX_SKIPPED_QUESTIONS):
+            question_id = await self._draw_question_id_async()
+            try:
+                question_text = await QuizQuestion.get_question_text_async(question_id)
+                return question_id, question_text
+            except ValueError:
+                logger.debug('Question %s was removed, skipping it.', question_id)
+        raise ValueError('There are no questions in storage.')
+
+    def _draw_question_id(self):
+        key = f'{UserDeck.TABLE_PREFIX}_{self.user_id}'
+        questions_count = QuizQuestion.get_questions_count()
+        if not questions_count:
+            raise ValueError('There are no questions in storage.')
+
+        deck = Storage.engine.get_hash(key)
+        position = None
+
+        if UserDeck._is_deck_valid(deck, questions_count):
+            position = Storage.engine.increase_hash_value(key, 'cursor') - 1
+
+        if position is None or position >= questions_count:
+            deck = UserDeck._shuffle_deck(questions_count)
+            position = 0
+            Storage.engine.set_hash(key, deck)
+
+        return UserDeck._get_question_id(deck, position)
+
+    async def _draw_question_id_async(self):
+        key = f'{UserDeck.TABLE_PREFIX}_{self.user_id}'
+        questions_count = await QuizQuestion.get_questions_count_async()
+        if not questions_count:
+            raise ValueError('There are no questions in storage.')
+
+        deck = await AsyncRedisStorage.get_hash(key)
+        position = None
+
+        if UserDeck._is_deck_valid(deck, questions_count):
+            position = await AsyncRedisStorage.increase_hash_value(key, 'cursor') - 1
+
+        if position is None or position >= questions_count:
+            deck = UserDeck._shuffle_deck(questions_count)
+            position = 0
+            await AsyncRedisStorage.set_hash(key, deck)
+
+        return UserDeck._get_question_id(deck, position)
+
+    @staticmethod
+    def _is_deck_valid(deck, questions_count):
+        return bool(deck) and int(deck['size']) == questions_count
+
+    @staticmethod
+    def _shuffle_deck(questions_count):
+        return {'seed': random.getrandbits(64), 'size': questions_count, 'cursor': 1}
+
+    @staticmethod
+    def _get_question_id(deck, position):
+        permutation = SeededPermutation(int(deck['size']), int(deck['seed']))
+        return permutation[position] + 1
+
+
+class QuestionDraw:
+    """
+    Chooses how the next question for a user is drawn:
+    random - sample with replacement from all questions,
+    deck - next question from the user's non-repeating deck.
+    """
+
+    RANDOM, DECK = 'random', 'deck'
+    mode = RANDOM
+    prefetcher = None
+
+    @staticmethod
+    def initialize(mode, prefetch_size=0, prefetch_batch_size=100):
+        """
+        :param prefetch_size: number of random questions prefetched
+        in random mode for users without a category, 0 disables prefetching.
+        Questions are not prefetched from corpus, which is read locally.
+        """
+        QuestionDraw.mode = mode
+        QuestionDraw.prefetcher = None
+        prefetch = prefetch_size > 0 and QuizQuestion.corpus is None
+        if mode == QuestionDraw.RANDOM and prefetch:
+            QuestionDraw.prefetcher = Prefetcher(
+                QuizQuestion.get_random_question_texts,
+                prefetch_size,
+                prefetch_batch_size,
+                name='questions',
+            )
+
+    @staticmethod
+    def draw_question(user_id):
+        """
+        :return: id and text of the next question for the user.
+        If the user has chosen a category, question is drawn at random
+        from the category in any mode. Prefetched question is drawn
+        if there is one, users' categories are cached, so it takes
+        no round trip then.
+        """
+        category_key = UserCategory.get_key(user_id)
+        prefetcher = QuestionDraw.prefetcher
+        if QuestionDraw.mode == QuestionDraw.DECK or prefetcher is not None:
+            if not UserCategory.get_by_user_id(user_id).category:
+                if QuestionDraw.mode == QuestionDraw.DECK:
+                    return UserDeck(user_id).draw_question()
+                question = prefetcher.take()
+                if question is not None:
+                    return question
+        return QuizQuestion.get_random_question_text(category_key)
+
+    @staticmethod
+    def draw_question_on_topic(topic):
+        """
+        :return: id and text of a random question on the topic,
+        which may repeat in any mode.
+        """
+        return QuizQuestion.get_random_question_text_on_topic(topic)
+
+    @staticmethod
+    async def draw_question_on_topic_async(topic):
+        return await QuizQuestion.get_random_question_text_on_topic_async(topic)
+
+    @staticmethod
+    async def draw_question_async(user_id):
+        category_key = UserCategory.get_key(user_id)
+        if QuestionDraw.mode == QuestionDraw.DECK:
+            user_category = await UserCategory.get_by_user_id_async(user_id)
+            if not user_category.category:
+                return await UserDeck(user_id).draw_question_async()
+        return await QuizQuestion.get_random_question_text_async(category_key)
 
 
 class UserRating:
@@ -65,13 +957,214 @@ class UserRating:
         self.user_id = user_id
 
     def get_rating(self):
-        rating = RedisStorage.get(f'{UserRating.TABLE_PREFIX}_{self.user_id}')
+        rating = Storage.engine.get(f'{UserRating.TABLE_PREFIX}_{self.user_id}')
+        return 0 if rating is None else rating
+
+    async def get_rating_async(self):
+        rating = await AsyncRedisStorage.get(
+            f'{UserRating.TABLE_PREFIX}_{self.user_id}'
+        )
         return 0 if rating is None else rating
 
     def set_rating(self, value):
-        return RedisStorage.set(f'{UserRating.TABLE_PREFIX}_{self.user_id}', value)
+        return Storage.engine.set(f'{UserRating.TABLE_PREFIX}_{self.user_id}', value)
+
+    def increase_rating(self, increment=1, display_name=None):
+        """
+        Increase user's rating and scores on leaderboards in one round trip.
+        :param display_name: name shown on leaderboards instead of user's id.
+        """
+        with Storage.engine.pipeline():
+            Storage.engine.increase_value(
+                f'{UserRating.TABLE_PREFIX}_{self.user_id}', increment
+            )
+            Leaderboard.add_score(self.user_id, increment, display_name)
+
+    async def increase_rating_async(self, increment=1, display_name=None):
+        await asyncio.gather(
+            AsyncRedisStorage.increase_value(
+                f'{UserRating.TABLE_PREFIX}_{self.user_id}', increment
+            ),
+            Leaderboard.add_score_async(self.user_id, increment, display_name),
+        )
+
+
+class Leaderboard:
+    """
+    Users' scores in redis sorted sets: all-time board and daily and weekly
+    boards, which expire some time after their period is over.
+    """
+
+    TABLE_PREFIX = 'leaderboard'
+    NAMES_KEY = f'{TABLE_PREFIX}:names'
+    GLOBAL, DAILY, WEEKLY = 'global', 'daily', 'weekly'
+    PERIODS = (GLOBAL, DAILY, WEEKLY)
+    EXPIRATION = {DAILY: 2 * 24 * 60 * 60, WEEKLY: 14 * 24 * 60 * 60}
+
+    def __init__(self, period=GLOBAL, moment=None):
+        self.period = period
+        self.key = Leaderboard.get_key(period, moment or datetime.datetime.utcnow())
+
+    @staticmethod
+    def get_key(period, moment):
+        if period == Leaderboard.DAILY:
+            return f'{Leaderboard.TABLE_PREFIX}:daily:{moment:%Y-%m-%d}'
+        if period == Leaderboard.WEEKLY:
+            year, week, _ = moment.isocalendar()
+            return f'{Leaderboard.TABLE_PREFIX}:weekly:{year}-W{week:02d}'
+        return f'{Leaderboard.TABLE_PREFIX}:global'
+
+    @staticmethod
+    def get_all(moment=None):
+        return [Leaderboard(period, moment) for period in Leaderboard.PERIODS]
+
+    @staticmethod
+    def add_score(user_id, increment=1, display_name=None):
+        with Storage.engine.pipeline():
+            if display_name:
+                Storage.engine.set_hash(Leaderboard.NAMES_KEY, {user_id: display_name})
+            for leaderboard in Leaderboard.get_all():
+                Storage.engine.increase_sorted_set_value(
+                    leaderboard.key, user_id, increment
+                )
+                if leaderboard.period in Leaderboard.EXPIRATION:
+                    Storage.engine.set_expiration(
+                        leaderboard.key, Leaderboard.EXPIRATION[leaderboard.period]
+                    )
+
+    @staticmethod
+    async def add_score_async(user_id, increment=1, display_name=None):
+        if display_name:
+            await AsyncRedisStorage.set_hash(
+                Leaderboard.NAMES_KEY, {user_id: display_name}
+            )
+        for leaderboard in Leaderboard.get_all():
+            await AsyncRedisStorage.increase_sorted_set_value(
+                leaderboard.key, user_id, increment
+            )
+            if leaderboard.period in Leaderboard.EXPIRATION:
+                await AsyncRedisStorage.set_expiration(
+                    leaderboard.key, Leaderboard.EXPIRATION[leaderboard.period]
+                )
+
+    def get_top(self, count=10):
+        return Storage.engine.get_sorted_set_top(self.key, count)
+
+    async def get_top_async(self, count=10):
+        return await AsyncRedisStorage.get_sorted_set_top(self.key, count)
+
+    @staticmethod
+    def get_display_names(user_ids):
+        """
+        :return: dict of user_id: display name of users who have one.
+        """
+        if not user_ids:
+            return {}
+        names = Storage.engine.get_hash_fields(Leaderboard.NAMES_KEY, user_ids)
+        return {user_id: name for user_id, name in zip(user_ids, names) if name}
+
+    @staticmethod
+    async def get_display_names_async(user_ids):
+        if not user_ids:
+            return {}
+        names = await AsyncRedisStorage.get_hash_fields(Leaderboard.NAMES_KEY, user_ids)
+        return {user_id: name for user_id, name in zip(user_ids, names) if name}
+
+    @staticmethod
+    def get_user_ranks(user_id):
+        """
+        :return: dict of period: (rank, score) of the user on every leaderboard.
+        """
+        leaderboards = Leaderboard.get_all()
+        ranks = Storage.engine.get_sorted_sets_ranks(
+            [leaderboard.key for leaderboard in leaderboards], user_id
+        )
+        return {
+            leaderboard.period: rank for leaderboard, rank in zip(leaderboards, ranks)
+        }
 
-    def increase_rating(self, increment=1):
-        return RedisStorage.increase_value(
-            f'{UserRating.TABLE_PREFIX}_{self.user_id}', increment
+    @staticmethod
+    async def get_user_ranks_async(user_id):
+        leaderboards = Leaderboard.get_all()
+        ranks = await AsyncRedisStorage.get_sorted_sets_ranks(
+            [leaderboard.key for leaderboard in leaderboards], user_id
         )
+        return {
+            leaderboard.period: rank for leaderboard, rank in zip(leaderboards, ranks)
+        }
+
+    @staticmethod
+    def import_ratings(ratings):
+        """
+        :param ratings: dict of user_id: rating, which replace scores
+        of these users on the all-time leaderboard.
+        """
+        return Storage.engine.set_sorted_set_values(
+            Leaderboard(Leaderboard.GLOBAL).key, ratings
+        )
+
+
+def run_random_question_script(call, keys, args):
+    """
+    Python version of QuizQuestion.RANDOM_QUESTION_SCRIPT for MemoryStorage.
+    """
+    bucket = keys[0]
+    category = call('GET', keys[1]) if len(keys) > 1 else None
+    if category:
+        bucket = f'{args[0]}:categories:{category.decode()}'
+    reply = [None, None, bucket.encode()]
+    for _ in range(10):
+        question_id = call('SRANDMEMBER', bucket)
+        if question_id is None:
+            break
+        if bucket == keys[0] or call('SISMEMBER', keys[0], question_id):
+            question_key = f'{args[0]}:{question_id.decode()}'
+            reply[:2] = question_id, call('HGET', question_key, args[1])
+            break
+        if args[2] == 1:
+            call('SREM', bucket, question_id)
+        else:
+            reply.append(question_id)
+    if reply[0] is None and len(reply) == 3:
+        return None
+    return reply
+
+
+def run_topic_question_script(call, keys, args):
+    """
+    Python version of QuizQuestion.TOPIC_QUESTION_SCRIPT for MemoryStorage.
+    """
+    sets = sorted(((key, call('SCARD', key)) for key in keys), key=lambda set_: set_[1])
+    sample = []
+    if sets[0][1] > args[3]:
+        sample = call('SRANDMEMBER', sets[0][0], args[3])
+    question_ids = [
+        question_id
+        for question_id in sample
+        if all(call('SISMEMBER', key, question_id) for key, _ in sets[1:])
+    ]
+    if not question_ids:
+        question_ids = call('SINTER', *keys)
+    if not question_ids:
+        return None
+    question_id = question_ids[int(args[2] * len(question_ids))]
+    return [question_id, call('HGET', f'{args[0]}:{question_id.decode()}', args[1])]
+
+
+def run_answer_script(call, keys, args):
+    """
+    Python version of UserQuestion.ANSWER_SCRIPT for MemoryStorage.
+    """
+    question_id = call('GET', keys[0])
+    if question_id is None:
+        return None
+    return call('HMGET', f'{args[0]}:{question_id.decode()}', args[1], args[2])
+
+
+MemoryStorage.register_script(
+    QuizQuestion.RANDOM_QUESTION_SCRIPT, run_random_question_script
+)
+MemoryStorage.register_script(
+    QuizQuestion.TOPIC_QUESTION_SCRIPT, run_topic_question_script
+)
+MemoryStorage.register_script(UserQuestion.ANSWER_SCRIPT, run_answer_script)
@@ -2,6 +2,8 @@ import re
 import logging
 
 logger = logging.getLogger(__name__)
+# Logs every extracted question, sampled in production.
+records_logger = logging.getLogger(f'{__name__}.records')
 
 
 class QuizQuestionsFileParser:
@@ -12,6 +14,7 @@ class QuizQuestionsFileParser:
     - comment
     - source
     - author
+    - category: tournament from the file header, empty if there is no header
     """
 
     rx_dict = {
@@ -20,11 +23,13 @@ class QuizQuestionsFileParser:
         'comment': re.compile(r'(?P<answer>Комментарий:)\n'),
         'source': re.compile(r'(?P<answer>Источник:)\n'),
         'author': re.compile(r'(?P<answer>Автор:)\n'),
+        'category': re.compile(r'(?P<category>Чемпионат:)\n'),
     }
 
     def __init__(self, open_file):
         self.open_file = open_file
         self.list_of_parsed_questions = list()
+        self.category = ''
 
     def __iter__(self):
         line = self.open_file.readline()
@@ -39,22 +44,24 @@ class QuizQuestionsFileParser:
             if key == 'question':
 
                 if current_question_dict['question']:
-                    logger.debug(
-                        'New question extracted from file: {}'.format(
-                            current_question_dict
-                        )
+                    records_logger.debug(
+                        'New question extracted from file: %s', current_question_dict
                     )
                     yield current_question_dict
 
                 current_question_dict = self.initialize_step_question_dict()
 
-            current_question_dict[key] = self._extract_entity_from_text()
+            if key == 'category':
+                self.category = self._extract_entity_from_text().strip()
+                current_question_dict[key] = self.category
+            else:
+                current_question_dict[key] = self._extract_entity_from_text()
 
             line = self.open_file.readline()
 
         if current_question_dict['question']:
-            logger.debug(
-                'New question extracted from file: {}'.format(current_question_dict)
+            records_logger.debug(
+                'New question extracted from file: %s', current_question_dict
             )
             yield current_question_dict
 
@@ -62,6 +69,7 @@ class QuizQuestionsFileParser:
         current_question_dict = {
             key: '' for key in QuizQuestionsFileParser.rx_dict.keys()
         }
+        current_question_dict['category'] = self.category
         return current_question_dict
 
     def _parse_line(self, text_line):
@@ -79,3 +87,98 @@ class QuizQuestionsFileParser:
             question_text.append(line)
             line = self.open_file.readline()
         return ''.join(question_text)
+
+
+class QuizQuestionsChunkedFileParser:
+    """
+    Parse the same file format as QuizQuestionsFileParser and yield the same dicts.
+    File is read in large chunks, section headers are located with a single
+    pattern anchored at line starts and entities are sliced out of the chunk.
+    """
+
+    CHUNK_SIZE = 1024 * 1024
+
+    # Both patterns start with a newline, so regex engine can quickly skip
+    # to candidate positions instead of trying to match at every character.
+    rx_header = re.compile(
+        r'\n(?:(?P<question>Вопрос \d+:)|(?P<answer>Ответ:)|(?P<comment>Комментарий:)'
+        r'|(?P<source>Источник:)|(?P<author>Автор:)|(?P<category>Чемпионат:))\n'
+    )
+    rx_blank_line = re.compile(r'\n[^\S\n]*(?:\n|\Z)')
+
+    def __init__(self, open_file, chunk_size=CHUNK_SIZE):
+        self.open_file = open_file
+        self.chunk_size = chunk_size
+        self.category = ''
+
+    def __iter__(self):
+        current_question_dict = self.initialize_step_question_dict()
+
+        for block in self._read_blocks():
+            text = '\n' + block
+            position = 0
+            match = self.rx_header.search(text, position)
+
+            while match:
+                key = match.lastgroup
+                value_start = match.end()
+                entity_end = self._find_entity_end(text, value_start)
+
+                if key == 'question':
+
+                    if current_question_dict['question']:
+                        records_logger.debug(
+                            'New question extracted from file: %s',
+                            current_question_dict,
+                        )
+                        yield current_question_dict
+
+                    current_question_dict = self.initialize_step_question_dict()
+
+                if key == 'category':
+                    self.category = text[value_start:entity_end].strip()
+                    current_question_dict[key] = self.category
+                else:
+                    current_question_dict[key] = text[value_start:entity_end]
+
+                position = entity_end - 1
+                match = self.rx_header.search(text, position)
+
+        if current_question_dict['question']:
+            records_logger.debug(
+                'New question extracted from file: %s', current_question_dict
+            )
+            yield current_question_dict
+
+    def initialize_step_question_dict(self):
+        current_question_dict = {
+            key: '' for key in QuizQuestionsFileParser.rx_dict.keys()
+        }
+        current_question_dict['category'] = self.category
+        return current_question_dict
+
+    def _read_blocks(self):
+        """
+        Yield pieces of the file which end right after a blank line,
+        so no entity is split between two pieces.
+        """
+        tail = ''
+        chunk = self.open_file.read(self.chunk_size)
+
+        while chunk:
+            text = tail + chunk
+            block_end = text.rfind('\n\n')
+            if block_end == -1:
+                tail = text
+            else:
+                tail_start = block_end + 2
+                tail = text[tail_start:]
+                yield text[:tail_start]
+            chunk = self.open_file.read(self.chunk_size)
+
+        if tail:
+            yield tail
+
+    def _find_entity_end(self, text, entity_start):
+        blank_line = self.rx_blank_line.search(text, entity_start - 1)
+        return len(text) if blank_line is None else blank_line.start() + 1
@@ -0,0 +1,52 @@
+import re
+
+from application.answers import Answer
+
+# Most frequent russian function words, they match almost every question.
+STOP_WORDS = frozenset('''
+    а без более бы был была были было быть в вам вас ведь во вот все всего всех
+    вы где да даже для до его ее ей ему если есть еще же за зачем здесь и из или
+    им их к как какая какой когда кто ли либо между мне много может мы на над
+    надо нас не него нее нет ни них но ну о об один он она они оно от очень по
+    под после при про раз с сам свою себе себя со так такой там тем то того тоже
+    только том тот тут ты у уже хоть чем через что чтобы эта эти это этого этой
+    этом этот эту я
+    '''.split())
+
+# Inflectional endings of russian nouns and adjectives, longest first.
+ENDINGS = sorted(
+    '''
+    иями ями ами иях иям ией ого его ому ему ыми ими ие ые ое ее ий ый ой ей ая
+    яя ую юю ом ем ам ям ах ях ов ев ию ия ья ье ьи ью а я о е ы и у ю ь й
+    '''.split(),
+    key=len,
+    reverse=True,
+)
+MIN_STEM_LENGTH = 3
+
+rx_cyrillic = re.compile('[а-я]')
+
+
+def stem(token):
+    """
+    Light stemmer: strips the longest inflectional ending of a russian word,
+    so different cases of the same noun or adjective share a stem.
+    """
+    if not rx_cyrillic.search(token):
+        return token
+    for ending in ENDINGS:
+        if token.endswith(ending) and len(token) - len(ending) >= MIN_STEM_LENGTH:
+            return token[: -len(ending)]
+    return token
+
+
+def tokenize(text):
+    """
+    :return: set of stems of significant words of the text,
+    normalized the same way as answers.
+    """
+    return {
+        stem(token)
+        for token in Answer.normalize(text).split()
+        if len(token) > 1 and token not in STOP_WORDS
+    }
@@ -0,0 +1,136 @@
+"""
+Measure cost of checking users' answers against answers
+from the bundled questions archive, when variants are precomputed
+and when they are computed on every check. Answers with a changed digit
+should not be accepted, as well as wrong answers in NUMBER_CASES.
+
+Usage (from src directory):
+    python -m benchmarks.answer_matching_benchmark
+"""
+
+import os
+import time
+import argparse
+
+from application.answers import Answer
+from application.commands import populate_db
+
+DATA_DIRECTORY = os.path.join(
+    os.path.dirname(__file__), '..', '..', 'data', 'quiz-questions'
+)
+
+# (answer, user's answer, whether it is correct)
+NUMBER_CASES = [
+    ('1812 год', '1813 год', False),
+    ('42000', '42001', False),
+    ('1812 год', 'год 1812', True),
+    ('Аполлон-11', 'Аполлон 12', False),
+    ('Наполеон', 'Напалеон', True),
+    ('Пункт 3.', 'пункт', False),
+    ('Петр 1.', 'петр', False),
+    ('3 мушкетёра', 'мушкетера', False),
+    ('А. С. Пушкин', 'пушкин', True),
+]
+
+
+def load_answers(directory, encoding):
+    answers = []
+    for filename in sorted(os.listdir(directory)):
+        answers.extend(
+            question.answer
+            for question in populate_db.parse_quiz_question_file(
+                os.path.join(directory, filename), encoding
+            )
+        )
+    return answers
+
+
+def make_typo(text):
+    middle = len(text) // 2
+    after_middle = middle + 1
+    return text[:middle] + text[after_middle:]
+
+
+def make_number_typo(text):
+    """
+    :return: text with its last digit changed, None if it has no digits.
+    """
+    for position in range(len(text) - 1, -1, -1):
+        if text[position].isdigit():
+            digit = str((int(text[position]) + 1) % 10)
+            after_position = position + 1
+            return text[:position] + digit + text[after_position:]
+    return None
+
+
+def measure(function, arguments, repeat):
+    timings = []
+    for _ in range(repeat):
+        started_at = time.perf_counter()
+        for argument in arguments:
+            function(*argument)
+        timings.append(time.perf_counter() - started_at)
+    return min(timings) / len(arguments)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--directory', default=DATA_DIRECTORY)
+    parser.add_argument('--encoding', default='KOI8-R')
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    texts = load_answers(args.directory, args.encoding)
+    answers = [Answer(text) for text in texts]
+    number_typos = [make_number_typo(answer.variants[-1]) for answer in answers]
+    user_answers = {
+        'exact': list(zip(texts, answers, [answer.variants[-1] for answer in answers])),
+        'typo': list(
+            zip(texts, answers, [make_typo(answer.variants[-1]) for answer in answers])
+        ),
+        'wrong': list(zip(texts, answers, ['неправильный ответ'] * len(answers))),
+        'number': [
+            (text, answer, guess)
+            for text, answer, guess in zip(texts, answers, number_typos)
+            if guess is not None
+        ],
+    }
+
+    print(f'Answers: {len(answers)}')
+    precompute_timing = measure(Answer, [(text,) for text in texts], args.repeat)
+    print(f'Variants precomputation: {precompute_timing * 1e6:.1f} us/answer')
+    for name, checks in user_answers.items():
+        correct_share = sum(
+            answer.is_correct(guess) for _, answer, guess in checks
+        ) / len(checks)
+        precomputed_timing = measure(
+            Answer.is_correct,
+            [(answer, guess) for _, answer, guess in checks],
+            args.repeat,
+        )
+        computed_timing = measure(
+            lambda text, guess: Answer(text).is_correct(guess),
+            [(text, guess) for text, _, guess in checks],
+            args.repeat,
+        )
+        print(
+            f'{name:<6} accepted: {correct_share:6.1%}, '
+            f'precomputed: {precomputed_timing * 1e6:6.1f} us/check, '
+            f'computed on check: {computed_timing * 1e6:6.1f} us/check'
+        )
+
+    failed_cases = [
+        (text, guess, expected)
+        for text, guess, expected in NUMBER_CASES
+        if Answer(text).is_correct(guess) != expected
+    ]
+    for text, guess, expected in failed_cases:
+        print(f'{guess!r} for {text!r} should be accepted: {expected}')
+    passed_count = len(NUMBER_CASES) - len(failed_cases)
+    print(f'Number cases: {passed_count}/{len(NUMBER_CASES)} passed')
+    if failed_cases:
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,80 @@
+"""
+Compare conversation states kept in storage written at once
+and written behind in batches.
+
+Usage (from src directory):
+    python -m benchmarks.conversations_benchmark [--users 200] [--updates 10000]
+        [--flush-ms 100] [--flush-size 100] [--redis-url redis://host:port/db]
+
+Every update reads the state of a chat and changes it,
+as ConversationHandler does, users send updates in turn.
+Latency and redis round trips are measured in the thread
+which handles updates, background writes are not counted.
+Without --redis-url an in-memory fakeredis server is used.
+"""
+
+import time
+import argparse
+
+from application.bot.conversations import StoredConversations, WriteBehindConversations
+from application.common.database import RedisStorage
+from application.common.storage import Storage
+from benchmarks.load_benchmark import PERCENTILES, get_percentile
+from benchmarks.redis_round_trips_benchmark import RoundTripCounter, create_connection
+
+
+def measure(conversations, users, updates):
+    """
+    :return: sorted seconds taken by every update.
+    """
+    timings = []
+    for update in range(updates):
+        key = (update % users + 1, update % users + 1)
+        started_at = time.perf_counter()
+        state = conversations.get(key, 0)
+        conversations[key] = (state + 1) % 3
+        timings.append(time.perf_counter() - started_at)
+    return sorted(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--updates', type=int, default=10000)
+    parser.add_argument('--flush-ms', type=int, default=100)
+    parser.add_argument('--flush-size', type=int, default=100)
+    parser.add_argument('--redis-url')
+    args = parser.parse_args()
+
+    RedisStorage.connection = create_connection(args.redis_url)
+    Storage.engine = RedisStorage
+    counter = RoundTripCounter(RedisStorage.connection)
+
+    header = '{:<14} '.format('conversations')
+    header += ' '.join(f'{f"p{percentile}, us":>9}' for percentile in PERCENTILES)
+    header += ' {:>12}'.format('round trips')
+    print(f'Users: {args.users}, updates: {args.updates}')
+    print(header)
+    for name in ('stored', 'write-behind'):
+        if name == 'stored':
+            conversations = StoredConversations('telegram')
+        else:
+            conversations = WriteBehindConversations(
+                'telegram', args.flush_ms / 1000, args.flush_size
+            )
+        round_trips = counter.round_trips
+        timings = measure(conversations, args.users, args.updates)
+        round_trips = counter.round_trips - round_trips
+        if name == 'write-behind':
+            conversations.stop()
+        line = f'{name:<14} '
+        line += ' '.join(
+            f'{get_percentile(timings, percentile) * 1e6:>9.1f}'
+            for percentile in PERCENTILES
+        )
+        line += ' {:>12.2f}'.format(round_trips / args.updates)
+        print(line)
+
+
+if __name__ == '__main__':
+    main()
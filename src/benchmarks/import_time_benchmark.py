@@ -0,0 +1,97 @@
+"""
+Measure import time of every manage.py command with python -X importtime.
+
+Usage (from src directory):
+    python -m benchmarks.import_time_benchmark [--repeat 5] [--max-ms 300]
+
+Every command is imported in a fresh interpreter the way manage.py does it:
+manage module first, then the module of the command. The report shows
+the total import time, including imports of the interpreter startup,
+which are shown separately as 'python', and the heaviest top-level imports.
+With --max-ms the benchmark fails if a command imports longer,
+so it can guard cold start of processes in CI.
+"""
+
+import os
+import sys
+import argparse
+import subprocess
+
+SRC_DIRECTORY = os.path.join(os.path.dirname(__file__), '..')
+COMMANDS = {
+    'python': [],
+    'populate_db': ['manage', 'application.commands.populate_db'],
+    'migrate_ratings': ['manage', 'application.commands.migrate_ratings'],
+    'search': ['manage', 'application.commands.search'],
+    'sync_replicas': ['manage', 'application.commands.sync_replicas'],
+    'run --platform=telegram': ['manage', 'application.commands.run_telegram_bot'],
+    'run --platform=telegram --async': [
+        'manage',
+        'application.commands.run_telegram_async_bot',
+    ],
+    'run --platform=vk': ['manage', 'application.commands.run_vk_bot'],
+}
+
+
+def measure_imports(modules):
+    """
+    :return: dict of top-level imported module: cumulative import time in us.
+    """
+    code = '; '.join(f'import {module}' for module in modules) or 'pass'
+    process = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', code],
+        cwd=SRC_DIRECTORY,
+        stderr=subprocess.PIPE,
+        universal_newlines=True,
+    )
+    if process.returncode:
+        raise ImportError(process.stderr.strip().splitlines()[-1])
+    imports = {}
+    for line in process.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line.split('|')
+        # Nested imports are indented by two spaces for every level.
+        if not name[1:].startswith(' '):
+            imports[name.strip()] = int(cumulative)
+    return imports
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--top', type=int, default=3)
+    parser.add_argument('--max-ms', type=float)
+    args = parser.parse_args()
+
+    failed = []
+    for command, modules in COMMANDS.items():
+        try:
+            runs = [measure_imports(modules) for _ in range(args.repeat)]
+        except ImportError as e:
+            print(f'{command:<32} failed: {str(e)}')
+            failed.append(command)
+            continue
+        imports = min(runs, key=lambda run: sum(run.values()))
+        total_ms = sum(imports.values()) / 1000
+        heaviest = sorted(imports.items(), key=lambda item: -item[1])[: args.top]
+        print(
+            '{:<32} {:8.1f} ms   {}'.format(
+                command,
+                total_ms,
+                ', '.join(f'{name} {time / 1000:.1f} ms' for name, time in heaviest),
+            )
+        )
+        if args.max_ms is not None and modules and total_ms > args.max_ms:
+            failed.append(command)
+
+    if failed:
+        raise SystemExit(
+            'Commands failed or imported longer than {} ms: {}'.format(
+                args.max_ms, ', '.join(failed)
+            )
+        )
+
+
+if __name__ == '__main__':
+    main()
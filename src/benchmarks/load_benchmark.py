@@ -0,0 +1,241 @@
+"""
+Drive bot handlers with synthetic users and report handler latency,
+throughput and redis commands per interaction.
+
+Usage (from src directory):
+    python -m benchmarks.load_benchmark [--platform telegram|vk] [--users 200]
+        [--rounds 5] [--workers 4] [--redis-url redis://host:port/db]
+        [--shards 1] [--storage redis|memory] [--prefetch 0] [--corpus path]
+
+Every user plays rounds of: new question, wrong answer, then correct answer
+or give up, score and sometimes the leaderboard. Users are processed
+by a pool of worker threads, interactions of one user are made in order,
+as the bots do. Without --redis-url an in-memory fakeredis server is used,
+otherwise the given database is populated, so use a spare one.
+With --shards user keys are spread across several fakeredis servers
+and questions are kept on each of them, as with REDIS_SHARD_URLS.
+With --storage memory data is kept in memory of the process,
+as with STORAGE_ENGINE=memory, so no round trips are reported.
+With --prefetch random questions are drawn from a buffer of that size
+refilled by a background thread, as with QUIZ_QUESTIONS_PREFETCH_SIZE,
+its round trips are not reported. With --corpus questions are exported
+into a corpus file at the path and read from it, as with
+QUIZ_QUESTIONS_CORPUS_PATH.
+Latency of fakeredis is not latency of redis over network, compare runs
+with the same storage only.
+"""
+
+import time
+import random
+import argparse
+import collections
+from concurrent import futures
+
+from application.common.database import RedisStorage
+from application.common.prefetch import PREFETCH_UNDERFLOWS
+from application.common.sharding import ShardedRedis
+from application.common.storage import Storage
+from application.commands import export_corpus, populate_db
+from application.models import QuestionDraw, QuizQuestion
+from benchmarks.redis_round_trips_benchmark import (
+    DATA_DIRECTORY,
+    RoundTripCounter,
+    create_connection,
+    create_vk_bot,
+    get_user_answer,
+    telegram_update,
+    vk_event,
+)
+
+PERCENTILES = (50, 95, 99)
+
+
+def get_percentile(sorted_values, percentile):
+    """
+    Nearest-rank percentile of sorted values.
+    """
+    rank = max(1, -(-len(sorted_values) * percentile // 100))
+    return sorted_values[rank - 1]
+
+
+def get_scenario(rng, rounds, correct_rate, leaderboard_rate):
+    """
+    :return: list of (interaction name, user text) pairs,
+    None text stands for the correct answer to the current question.
+    """
+    scenario = []
+    for _ in range(rounds):
+        scenario.append(('new question', 'Новый вопрос'))
+        scenario.append(('answer (wrong)', 'Неверный ответ'))
+        if rng.random() < correct_rate:
+            scenario.append(('answer (correct)', None))
+        else:
+            scenario.append(('give up', 'Сдаться'))
+        scenario.append(('score', 'Мой счет'))
+        if rng.random() < leaderboard_rate:
+            scenario.append(('leaderboard', 'Рейтинг'))
+    return scenario
+
+
+def create_telegram_player():
+    from application.bot.telegram_bot import ConversationStates
+
+    handlers = {
+        'new question': ConversationStates.new_question_chosen_state,
+        'answer (wrong)': ConversationStates.user_answered_state,
+        'answer (correct)': ConversationStates.user_answered_state,
+        'give up': ConversationStates.give_up_state,
+        'score': ConversationStates.user_score_state,
+        'leaderboard': ConversationStates.leaderboard_state,
+    }
+
+    def play(counter, user_id, name, text):
+        update = telegram_update(user_id, text)
+        return counter.measure_interaction(handlers[name], None, update, {})
+
+    return play
+
+
+def create_vk_player():
+    vk_bot = create_vk_bot()
+
+    def play(counter, user_id, name, text):
+        return counter.measure_interaction(
+            vk_bot._handle_event, vk_event(user_id, text)
+        )
+
+    return play
+
+
+def run_session(counter, play, user_id, scenario):
+    """
+    :return: list of (interaction name, seconds, round trips, commands).
+    """
+    measurements = []
+    for name, text in scenario:
+        text = get_user_answer(user_id) if text is None else text
+        measurements.append((name, *play(counter, user_id, name, text)))
+    return measurements
+
+
+def print_report(measurements, elapsed):
+    by_name = collections.defaultdict(list)
+    for name, *measurement in measurements:
+        by_name[name].append(measurement)
+    by_name['all'] = [measurement for _, *measurement in measurements]
+
+    header = '{:<18} {:>7} '.format('interaction', 'count')
+    header += ' '.join(f'{f"p{percentile}, ms":>9}' for percentile in PERCENTILES)
+    header += ' {:>11} {:>9}'.format('round trips', 'commands')
+    print(header)
+    for name, name_measurements in by_name.items():
+        timings = sorted(seconds for seconds, _, _ in name_measurements)
+        round_trips = sum(trips for _, trips, _ in name_measurements)
+        commands = sum(commands for _, _, commands in name_measurements)
+        line = f'{name:<18} {len(timings):>7} '
+        line += ' '.join(
+            f'{get_percentile(timings, percentile) * 1000:>9.3f}'
+            for percentile in PERCENTILES
+        )
+        line += ' {:>11.2f} {:>9.2f}'.format(
+            round_trips / len(timings), commands / len(timings)
+        )
+        print(line)
+    print(
+        'Interactions: {}, elapsed: {:.2f} s, throughput: {:.0f} interactions/s'.format(
+            len(measurements), elapsed, len(measurements) / elapsed
+        )
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--platform', choices=('telegram', 'vk'), default='telegram')
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--rounds', type=int, default=5)
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--correct-rate', type=float, default=0.5)
+    parser.add_argument('--leaderboard-rate', type=float, default=0.2)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--redis-url')
+    parser.add_argument('--shards', type=int, default=1)
+    parser.add_argument('--storage', choices=('redis', 'memory'), default='redis')
+    parser.add_argument('--prefetch', type=int, default=0)
+    parser.add_argument('--corpus')
+    args = parser.parse_args()
+    if args.shards > 1 and args.redis_url:
+        parser.error('--shards is supported with fakeredis only.')
+    if args.storage == 'memory' and (args.shards > 1 or args.redis_url):
+        parser.error('--storage memory takes neither --shards nor --redis-url.')
+
+    if args.storage == 'memory':
+        Storage.initialize('memory')
+        counter = RoundTripCounter()
+    elif args.shards > 1:
+        import fakeredis
+
+        RedisStorage.shards = ShardedRedis(
+            {
+                f'fakeredis-{index}': fakeredis.FakeRedis(server=fakeredis.FakeServer())
+                for index in range(args.shards)
+            },
+            replicated_prefixes=(f'{QuizQuestion.COLLECTION}:',),
+        )
+        RedisStorage.connection = RedisStorage.shards.connections[0]
+        counter = RoundTripCounter(*RedisStorage.shards.connections)
+    else:
+        RedisStorage.connection = create_connection(args.redis_url)
+        counter = RoundTripCounter(RedisStorage.connection)
+    populate_db.run_command(DATA_DIRECTORY, 'KOI8-R')
+    if args.corpus:
+        export_corpus.run_command(args.corpus)
+        QuizQuestion.initialize_corpus(args.corpus)
+    QuestionDraw.initialize(QuestionDraw.RANDOM, args.prefetch)
+    if QuestionDraw.prefetcher is not None:
+        QuestionDraw.prefetcher.refill()
+    if args.platform == 'telegram':
+        play, greetings = create_telegram_player(), []
+    else:
+        # The first message of a VK user only greets them.
+        play, greetings = create_vk_player(), [('greetings', 'Привет')]
+
+    rng = random.Random(args.seed)
+    scenarios = {
+        user_id: greetings
+        + get_scenario(rng, args.rounds, args.correct_rate, args.leaderboard_rate)
+        for user_id in range(1, args.users + 1)
+    }
+
+    # Lua scripts are loaded into redis by the first session,
+    # so it is not reported.
+    run_session(counter, play, 0, greetings + get_scenario(rng, 1, 1, 1))
+
+    started_at = time.perf_counter()
+    with futures.ThreadPoolExecutor(max_workers=args.workers) as executor:
+        sessions = [
+            executor.submit(run_session, counter, play, user_id, scenario)
+            for user_id, scenario in scenarios.items()
+        ]
+        measurements = [
+            measurement for session in sessions for measurement in session.result()
+        ]
+    elapsed = time.perf_counter() - started_at
+
+    print(
+        f'Platform: {args.platform}, users: {args.users}, '
+        f'workers: {args.workers}, '
+        f'storage: {args.storage} ({args.redis_url or "fakeredis"}), '
+        f'shards: {args.shards}, prefetch: {args.prefetch}, '
+        f'corpus: {args.corpus or "none"}'
+    )
+    print_report(measurements, elapsed)
+    if QuestionDraw.prefetcher is not None:
+        print(
+            'Prefetch underflows: {:.0f}'.format(
+                PREFETCH_UNDERFLOWS.get(name=QuestionDraw.prefetcher.name)
+            )
+        )
+
+
+if __name__ == '__main__':
+    main()
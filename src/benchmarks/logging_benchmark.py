@@ -0,0 +1,89 @@
+"""
+Measure parsing speed of the bundled questions archive
+with different logging setups.
+
+Usage (from src directory):
+    python -m benchmarks.logging_benchmark [--repeat 5]
+
+Log lines are written to os.devnull, so the report shows the cost
+of creating and formatting records, not of the output itself.
+With the queue handler records are written by a listener thread,
+which is drained after every measurement and is not timed.
+"""
+
+import os
+import time
+import logging
+import argparse
+
+from application.commands import populate_db
+from config import LOG_FORMAT, setup_logging, stop_logging
+
+DATA_DIRECTORY = os.path.join(
+    os.path.dirname(__file__), '..', '..', 'data', 'quiz-questions'
+)
+
+
+def setup_direct_logging(stream):
+    """
+    Logging as it was set up before: every record of every level
+    is formatted and written by the logging thread.
+    """
+    stop_logging()
+    handler = logging.StreamHandler(stream)
+    handler.setFormatter(logging.Formatter(LOG_FORMAT))
+    root_logger = logging.getLogger()
+    root_logger.handlers = [handler]
+    root_logger.setLevel(logging.DEBUG)
+
+
+def parse_files(filepaths, encoding):
+    questions_count = 0
+    for filepath in filepaths:
+        questions_count += len(populate_db.parse_quiz_question_file(filepath, encoding))
+    return questions_count
+
+
+def measure(setup, filepaths, encoding, repeat):
+    timings = []
+    for _ in range(repeat):
+        setup()
+        started_at = time.perf_counter()
+        questions_count = parse_files(filepaths, encoding)
+        timings.append(time.perf_counter() - started_at)
+        stop_logging()
+    return questions_count, min(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--directory', default=DATA_DIRECTORY)
+    parser.add_argument('--encoding', default='KOI8-R')
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    filepaths = sorted(
+        os.path.join(args.directory, filename)
+        for filename in os.listdir(args.directory)
+    )
+    with open(os.devnull, 'w') as devnull:
+        setups = {
+            'DEBUG, direct handler': lambda: setup_direct_logging(devnull),
+            'DEBUG, queue handler': lambda: setup_logging('DEBUG', 1, devnull),
+            'DEBUG, queue handler, 1% of records': lambda: setup_logging(
+                'DEBUG', 0.01, devnull
+            ),
+            'INFO, queue handler': lambda: setup_logging('INFO', 1, devnull),
+        }
+        for name, setup in setups.items():
+            questions_count, timing = measure(
+                setup, filepaths, args.encoding, args.repeat
+            )
+            print(
+                f'{name:<36} {timing * 1000:8.2f} ms, '
+                f'{questions_count / timing:8.0f} questions/s'
+            )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,70 @@
+"""
+Compare QuizQuestionsFileParser and QuizQuestionsChunkedFileParser
+on the bundled questions archive.
+
+Usage (from src directory):
+    python -m benchmarks.parser_benchmark [--directory ../data/quiz-questions]
+"""
+
+import os
+import time
+import argparse
+
+from application.parser import QuizQuestionsFileParser, QuizQuestionsChunkedFileParser
+
+DEFAULT_DIRECTORY = os.path.join(
+    os.path.dirname(__file__), '..', '..', 'data', 'quiz-questions'
+)
+
+
+def parse_files(parser_class, filepaths, encoding):
+    questions = []
+    for filepath in filepaths:
+        with open(filepath, 'r', encoding=encoding) as f:
+            questions.extend(parser_class(f))
+    return questions
+
+
+def measure(parser_class, filepaths, encoding, repeat):
+    timings = []
+    for _ in range(repeat):
+        started_at = time.perf_counter()
+        parse_files(parser_class, filepaths, encoding)
+        timings.append(time.perf_counter() - started_at)
+    return min(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--directory', default=DEFAULT_DIRECTORY)
+    parser.add_argument('--encoding', default='KOI8-R')
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+
+    filepaths = sorted(
+        os.path.join(args.directory, filename)
+        for filename in os.listdir(args.directory)
+    )
+
+    line_questions = parse_files(QuizQuestionsFileParser, filepaths, args.encoding)
+    chunked_questions = parse_files(
+        QuizQuestionsChunkedFileParser, filepaths, args.encoding
+    )
+    if line_questions != chunked_questions:
+        raise SystemExit('Parsers produced different results.')
+
+    line_timing = measure(
+        QuizQuestionsFileParser, filepaths, args.encoding, args.repeat
+    )
+    chunked_timing = measure(
+        QuizQuestionsChunkedFileParser, filepaths, args.encoding, args.repeat
+    )
+
+    print(f'Files: {len(filepaths)}, questions: {len(line_questions)}')
+    print(f'QuizQuestionsFileParser:        {line_timing * 1000:.2f} ms')
+    print(f'QuizQuestionsChunkedFileParser: {chunked_timing * 1000:.2f} ms')
+    print(f'Speedup: {line_timing / chunked_timing:.2f}x')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,209 @@
+"""
+Count redis round trips made by every bot handler.
+
+Usage (from src directory):
+    python -m benchmarks.redis_round_trips_benchmark [--redis-url redis://host:port/db]
+
+Without --redis-url an in-memory fakeredis server is used,
+otherwise the given database is populated, so use a spare one.
+Database is populated with the bundled questions archive.
+"""
+
+import os
+import time
+import argparse
+import threading
+from types import SimpleNamespace
+
+import redis
+
+from application.common.database import RedisStorage
+from application.commands import populate_db
+
+DATA_DIRECTORY = os.path.join(
+    os.path.dirname(__file__), '..', '..', 'data', 'quiz-questions'
+)
+
+
+class RoundTripCounter:
+    """
+    Counts commands sent to redis: every command sent directly is a round trip,
+    a pipeline is a single round trip regardless of the number of its commands.
+    Counts are kept per thread, so handlers may be measured concurrently,
+    and summed over all given connections, e.g. nodes of sharded storage.
+    """
+
+    def __init__(self, *connections):
+        self._local = threading.local()
+        for connection in connections:
+            connection.execute_command = self._count_command(connection.execute_command)
+            connection.pipeline = self._count_pipeline(connection.pipeline)
+
+    @property
+    def round_trips(self):
+        return getattr(self._local, 'round_trips', 0)
+
+    @property
+    def commands(self):
+        return getattr(self._local, 'commands', 0)
+
+    def _add(self, round_trips, commands):
+        self._local.round_trips = self.round_trips + round_trips
+        self._local.commands = self.commands + commands
+
+    def _count_command(self, execute_command):
+        def count_command(*args, **kwargs):
+            self._add(1, 1)
+            return execute_command(*args, **kwargs)
+
+        return count_command
+
+    def _count_pipeline(self, create_pipeline):
+        def count_pipeline(*args, **kwargs):
+            pipeline = create_pipeline(*args, **kwargs)
+            execute = pipeline.execute
+
+            def count_execute(*execute_args, **execute_kwargs):
+                if pipeline.command_stack:
+                    self._add(1, len(pipeline.command_stack))
+                return execute(*execute_args, **execute_kwargs)
+
+            pipeline.execute = count_execute
+            return pipeline
+
+        return count_pipeline
+
+    def measure(self, function, *args):
+        return self.measure_interaction(function, *args)[1]
+
+    def measure_interaction(self, function, *args):
+        """
+        :return: seconds taken by the call, round trips and commands it made.
+        """
+        round_trips_before, commands_before = self.round_trips, self.commands
+        started_at = time.perf_counter()
+        function(*args)
+        elapsed = time.perf_counter() - started_at
+        return (
+            elapsed,
+            self.round_trips - round_trips_before,
+            self.commands - commands_before,
+        )
+
+
+def create_connection(redis_url):
+    if redis_url:
+        return redis.Redis.from_url(redis_url)
+    import fakeredis
+
+    return fakeredis.FakeRedis()
+
+
+def telegram_update(chat_id, text):
+    message = SimpleNamespace(
+        chat_id=chat_id,
+        text=text,
+        from_user={'first_name': 'User'},
+        reply_text=lambda *args, **kwargs: None,
+    )
+    return SimpleNamespace(message=message)
+
+
+def vk_event(user_id, text):
+    return SimpleNamespace(user_id=user_id, text=text)
+
+
+def create_vk_bot():
+    from application.bot.vk_bot import VkBot
+
+    # Long poll server is not needed to call state methods directly,
+    # so the bot is created without connecting to VK.
+    vk_bot = VkBot.__new__(VkBot)
+    vk_bot._sender = SimpleNamespace(send=lambda *args, **kwargs: None)
+    return vk_bot
+
+
+def get_user_answer(user_id):
+    from application.models import UserQuestion
+
+    return UserQuestion.get_by_user_id(user_id).get_answer().text
+
+
+def measure_telegram_handlers(counter, user_id):
+    from application.bot.telegram_bot import ConversationStates
+
+    scenario = [
+        (
+            'new_question_chosen_state',
+            ConversationStates.new_question_chosen_state,
+            'Новый вопрос',
+        ),
+        (
+            'user_answered_state (wrong)',
+            ConversationStates.user_answered_state,
+            'Неверный ответ',
+        ),
+        ('user_answered_state (correct)', ConversationStates.user_answered_state, None),
+        ('give_up_state', ConversationStates.give_up_state, 'Сдаться'),
+        ('user_score_state', ConversationStates.user_score_state, 'Мой счет'),
+    ]
+    results = []
+    for name, handler, text in scenario:
+        text = get_user_answer(user_id) if text is None else text
+        update = telegram_update(user_id, text)
+        results.append((name, counter.measure(handler, None, update, {})))
+    return results
+
+
+def measure_vk_handlers(counter, user_id):
+    vk_bot = create_vk_bot()
+    scenario = [
+        ('greetings', 'Привет'),
+        ('new question', 'Новый вопрос'),
+        ('answer (wrong)', 'Неверный ответ'),
+        ('answer (correct)', None),
+        ('score', 'Мой счет'),
+        ('new question', 'Новый вопрос'),
+        ('give up', 'Сдаться'),
+    ]
+    results = []
+    for name, text in scenario:
+        text = get_user_answer(user_id) if text is None else text
+        results.append(
+            (name, counter.measure(vk_bot._handle_event, vk_event(user_id, text)))
+        )
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--redis-url')
+    parser.add_argument('--platform', choices=('telegram', 'vk', 'all'), default='all')
+    args = parser.parse_args()
+
+    RedisStorage.connection = create_connection(args.redis_url)
+    populate_db.run_command(DATA_DIRECTORY, 'KOI8-R')
+    counter = RoundTripCounter(RedisStorage.connection)
+
+    # The first run of every scenario loads lua scripts into redis,
+    # only the second one is reported.
+    measurements = []
+    if args.platform in ('telegram', 'all'):
+        measure_telegram_handlers(counter, 1)
+        measurements.append(('Telegram', measure_telegram_handlers(counter, 2)))
+    if args.platform in ('vk', 'all'):
+        measure_vk_handlers(counter, 3)
+        measurements.append(('VK', measure_vk_handlers(counter, 4)))
+
+    for platform, results in measurements:
+        print(f'{platform} handlers, round trips:')
+        for name, round_trips in results:
+            print(f'    {name}: {round_trips}')
+
+    from application.models import UserQuestion
+
+    print('Answers cache: {}'.format(UserQuestion.answers_cache.get_metrics()))
+
+
+if __name__ == '__main__':
+    main()
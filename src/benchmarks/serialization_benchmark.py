@@ -0,0 +1,145 @@
+"""
+Compare storage size of questions from the bundled archive
+with plain and compact serializers.
+
+Usage (from src directory):
+    python -m benchmarks.serialization_benchmark [--redis-url redis://host:port/db]
+
+Payload is the total length of hash field names and values of a question.
+Redis keeps a small hash in a compact listpack only while every value
+is at most hash-max-listpack-value (64 by default) bytes long, otherwise
+every field becomes a separate hash table entry with tens of bytes
+of overhead, so the number of fields matters as well.
+With --redis-url questions are written into the given database,
+which should be a spare one, and measured with MEMORY USAGE.
+"""
+
+import os
+import argparse
+import collections
+
+import redis
+
+from application.common.serializers import HashSerializer, CompactHashSerializer
+from application.answers import Answer
+from application.commands import populate_db
+from application.models import QuizQuestion
+
+DATA_DIRECTORY = os.path.join(
+    os.path.dirname(__file__), '..', '..', 'data', 'quiz-questions'
+)
+LISTPACK_MAX_VALUE = 64
+PACKED_FIELDS = ('comment', 'source', 'author')
+
+
+def load_questions(directory, encoding):
+    questions = []
+    for filename in sorted(os.listdir(directory)):
+        questions.extend(
+            populate_db.parse_quiz_question_file(
+                os.path.join(directory, filename), encoding
+            )
+        )
+    stored_fields = [question.get_stored_fields() for question in questions]
+    return [
+        dict(fields, variants=Answer(fields['answer']).dump_variants())
+        for fields in stored_fields
+    ]
+
+
+def build_zdict(records, size=4096):
+    """
+    Preset dictionary of the most common words of packed fields.
+    zlib looks for matches from the end, so the most common words go last.
+    """
+    words = collections.Counter(
+        word
+        for record in records
+        for field_name in PACKED_FIELDS
+        for word in record[field_name].split()
+        if len(word) > 3
+    )
+    zdict = b''
+    for word, _ in words.most_common():
+        encoded_word = word.encode() + b' '
+        if len(zdict) + len(encoded_word) > size:
+            break
+        zdict = encoded_word + zdict
+    return zdict
+
+
+def get_payload_size(stored_fields):
+    return sum(
+        len(str(field_name).encode())
+        + len(value if isinstance(value, bytes) else str(value).encode())
+        for field_name, value in stored_fields.items()
+    )
+
+
+def is_listpack_encoded(stored_fields):
+    return all(
+        len(value if isinstance(value, bytes) else str(value).encode())
+        <= LISTPACK_MAX_VALUE
+        for value in stored_fields.values()
+    )
+
+
+def measure_redis_memory(connection, stored_records):
+    total = 0
+    pipeline = connection.pipeline(transaction=False)
+    for number, stored_fields in enumerate(stored_records):
+        pipeline.hset(f'serialization-benchmark:{number}', mapping=stored_fields)
+    pipeline.execute()
+    for number in range(len(stored_records)):
+        total += connection.memory_usage(f'serialization-benchmark:{number}')
+    connection.delete(
+        *(f'serialization-benchmark:{number}' for number in range(len(stored_records)))
+    )
+    return total
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--directory', default=DATA_DIRECTORY)
+    parser.add_argument('--encoding', default='KOI8-R')
+    parser.add_argument('--redis-url')
+    args = parser.parse_args()
+
+    records = load_questions(args.directory, args.encoding)
+    serializers = {
+        'plain': HashSerializer(QuizQuestion.STORED_FIELDS),
+        'compact': CompactHashSerializer(QuizQuestion.STORED_FIELDS, PACKED_FIELDS),
+        'compact, zdict': CompactHashSerializer(
+            QuizQuestion.STORED_FIELDS, PACKED_FIELDS, zdict=build_zdict(records)
+        ),
+    }
+    connection = redis.Redis.from_url(args.redis_url) if args.redis_url else None
+
+    print(f'Questions: {len(records)}')
+    for name, serializer in serializers.items():
+        stored_records = [serializer.dumps(record) for record in records]
+        for record, stored_fields in zip(records, stored_records):
+            encoded_fields = {
+                str(field_name).encode(): (
+                    value if isinstance(value, bytes) else str(value).encode()
+                )
+                for field_name, value in stored_fields.items()
+            }
+            if serializer.loads(encoded_fields) != record:
+                raise SystemExit(f'Serializer {name} does not restore records.')
+
+        payload = sum(map(get_payload_size, stored_records)) / len(records)
+        fields = sum(map(len, stored_records)) / len(records)
+        listpack_share = sum(map(is_listpack_encoded, stored_records)) / len(records)
+        report = (
+            f'{name:<15} payload: {payload:7.1f} bytes/question, '
+            f'fields: {fields:.1f}, listpack encoded: {listpack_share:6.1%}'
+        )
+        if connection is not None:
+            memory = measure_redis_memory(connection, stored_records) / len(records)
+            report += f', redis memory: {memory:7.1f} bytes/question'
+        print(report)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,119 @@
+"""
+Compare latency of storage operations of models on every storage engine.
+
+Usage (from src directory):
+    python -m benchmarks.storage_benchmark [--iterations 2000]
+        [--redis-url redis://host:port/db]
+
+Every engine is populated with the bundled questions archive, then every
+operation is called the way bots call it, for users in turn.
+Without --redis-url redis engine uses an in-memory fakeredis server,
+which is slower than redis on localhost, otherwise the given database
+is populated, so use a spare one.
+"""
+
+import time
+import argparse
+
+from application.common.database import RedisStorage
+from application.common.storage import Storage
+from application.commands import populate_db
+from application.models import (
+    Leaderboard,
+    QuestionDraw,
+    QuizQuestion,
+    UserQuestion,
+    UserRating,
+)
+from application.search import tokenize
+from benchmarks.load_benchmark import get_percentile
+from benchmarks.redis_round_trips_benchmark import DATA_DIRECTORY, create_connection
+
+USERS_COUNT = 100
+
+
+def initialize_engine(engine_name, redis_url):
+    if engine_name == 'memory':
+        Storage.initialize('memory')
+    else:
+        RedisStorage.connection = create_connection(redis_url)
+        RedisStorage._scripts = dict()
+        Storage.engine = RedisStorage
+    populate_db.run_command(DATA_DIRECTORY, 'KOI8-R')
+
+
+def get_operations():
+    """
+    :return: dict of operation name: function(user_id).
+    """
+    question_id, _ = QuestionDraw.draw_question(0)
+    question = QuizQuestion.get_by_id(question_id)
+    search_query = max(tokenize(question.question), key=len)
+    return {
+        'draw question': QuestionDraw.draw_question,
+        'save user question': lambda user_id: UserQuestion(
+            user_id, question_id
+        ).save_to_db(),
+        'get answer': UserQuestion.get_answer_by_user_id,
+        'get question': lambda user_id: QuizQuestion.get_by_id(question_id),
+        'increase rating': lambda user_id: UserRating(user_id).increase_rating(),
+        'get rating': lambda user_id: UserRating(user_id).get_rating(),
+        'user ranks': Leaderboard.get_user_ranks,
+        'leaderboard top': lambda user_id: Leaderboard().get_top(),
+        'search': lambda user_id: QuizQuestion.search(search_query, 10),
+    }
+
+
+def measure(operation, iterations):
+    """
+    :return: sorted seconds taken by every call.
+    """
+    timings = []
+    for iteration in range(iterations):
+        user_id = iteration % USERS_COUNT + 1
+        started_at = time.perf_counter()
+        operation(user_id)
+        timings.append(time.perf_counter() - started_at)
+    return sorted(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--iterations', type=int, default=2000)
+    parser.add_argument('--redis-url')
+    args = parser.parse_args()
+
+    # Answers cache would hide the storage behind repeated reads.
+    UserQuestion.initialize_cache(0, None)
+    engines = {
+        'redis': args.redis_url or 'fakeredis',
+        'memory': 'memory',
+    }
+    results = {}
+    for engine_name in engines:
+        initialize_engine(engine_name, args.redis_url)
+        for name, operation in get_operations().items():
+            results[name, engine_name] = measure(operation, args.iterations)
+
+    print(
+        'Storages: {}, iterations: {}, latency in us'.format(
+            ', '.join(f'{name} ({storage})' for name, storage in engines.items()),
+            args.iterations,
+        )
+    )
+    header = f'{"operation":<20}'
+    for engine_name in engines:
+        header += f' {f"{engine_name} p50":>12} {f"{engine_name} p99":>12}'
+    print(header)
+    for name in get_operations():
+        line = f'{name:<20}'
+        for engine_name in engines:
+            timings = results[name, engine_name]
+            line += ' {:>12.1f} {:>12.1f}'.format(
+                get_percentile(timings, 50) * 1e6, get_percentile(timings, 99) * 1e6
+            )
+        print(line)
+
+
+if __name__ == '__main__':
+    main()
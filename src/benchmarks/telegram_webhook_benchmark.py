@@ -0,0 +1,287 @@
+"""
+Drive the telegram bot in webhook mode with a fake telegram:
+fake bot API receives the bot's messages, fake users post updates
+to the webhook, so the whole path of an update is measured.
+
+Usage (from src directory):
+    python -m benchmarks.telegram_webhook_benchmark --redis-url redis://host:port/db
+        [--users 50] [--rounds 3] [--workers 4] [--clients 8]
+
+Webhook server is started with manage.py run --platform=telegram --webhook
+in a separate process, its workers share the given redis database,
+which is populated with the bundled questions archive, so use a spare one.
+Every user plays rounds of: new question, wrong answer, give up, score,
+their updates are posted one after another, users are played
+by a pool of client threads. Every update has to get a reply.
+"""
+
+import os
+import sys
+import json
+import time
+import socket
+import argparse
+import itertools
+import subprocess
+import collections
+import threading
+from concurrent import futures
+from urllib import request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from application.common.database import RedisStorage
+from application.commands import populate_db
+from application.models import UserState
+from benchmarks.load_benchmark import PERCENTILES, get_percentile
+from benchmarks.redis_round_trips_benchmark import DATA_DIRECTORY, create_connection
+
+SRC_DIRECTORY = os.path.join(os.path.dirname(__file__), '..')
+TOKEN = '123456:benchmark'
+
+
+class FakeBotApi:
+    """
+    Answers bot API methods the bot calls and keeps messages sent to chats.
+    """
+
+    def __init__(self):
+        self.messages = collections.defaultdict(list)
+        self.webhook_url = None
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), self._create_handler())
+        self._server.daemon_threads = True
+        self.url = 'http://127.0.0.1:{}'.format(self._server.server_address[1])
+
+    def start(self):
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+
+    def stop(self):
+        self._server.shutdown()
+
+    def call(self, method, params):
+        if method == 'getMe':
+            return {
+                'id': 123456,
+                'is_bot': True,
+                'first_name': 'Quiz',
+                'username': 'quiz',
+            }
+        if method == 'setWebhook':
+            self.webhook_url = params['url']
+            return True
+        if method == 'sendMessage':
+            chat_id = int(params['chat_id'])
+            with self._lock:
+                self.messages[chat_id].append(params['text'])
+            return {
+                'message_id': len(self.messages[chat_id]),
+                'date': int(time.time()),
+                'chat': {'id': chat_id, 'type': 'private'},
+                'text': params['text'],
+            }
+        raise ValueError(f'Method {method} is not supported by fake bot API.')
+
+    def _create_handler(self):
+        fake_bot_api = self
+
+        class FakeBotApiRequestHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                self.do_POST()
+
+            def do_POST(self):
+                content_length = int(self.headers.get('Content-Length', 0))
+                params = json.loads(self.rfile.read(content_length).decode() or '{}')
+                method = self.path.rsplit('/', 1)[-1]
+                try:
+                    response = {'ok': True, 'result': fake_bot_api.call(method, params)}
+                except ValueError as e:
+                    response = {'ok': False, 'description': str(e)}
+                payload = json.dumps(response).encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def log_message(self, format, *args):
+                pass
+
+        return FakeBotApiRequestHandler
+
+
+def get_free_port():
+    with socket.socket() as free_socket:
+        free_socket.bind(('127.0.0.1', 0))
+        return free_socket.getsockname()[1]
+
+
+def start_webhook_server(redis_url, port, workers, api_url):
+    environment = dict(
+        os.environ,
+        APPLICATION_ENV='production',
+        QUIZ_QUESTIONS_DIRECTORY=DATA_DIRECTORY,
+        QUIZ_QUESTIONS_FILEPARSING_LIMIT='1',
+        TELEGRAM_BOT_TOKEN=TOKEN,
+        VK_GROUP_TOKEN='benchmark',
+        REDIS_URL=redis_url,
+        STORAGE_ENGINE='redis',
+        TELEGRAM_API_URL=api_url,
+        TELEGRAM_WEBHOOK_URL=f'http://127.0.0.1:{port}',
+        TELEGRAM_WEBHOOK_HOST='127.0.0.1',
+        TELEGRAM_WEBHOOK_PORT=str(port),
+        TELEGRAM_WEBHOOK_WORKERS=str(workers),
+        LOG_LEVEL='WARNING',
+    )
+    return subprocess.Popen(
+        [sys.executable, 'manage.py', 'run', '--platform=telegram', '--webhook'],
+        cwd=SRC_DIRECTORY,
+        env=environment,
+    )
+
+
+def wait_for_webhook(fake_bot_api, process, timeout=30):
+    deadline = time.monotonic() + timeout
+    while fake_bot_api.webhook_url is None:
+        if process.poll() is not None or time.monotonic() > deadline:
+            raise SystemExit('Webhook server has not started.')
+        time.sleep(0.1)
+    # Webhook is set before workers are started.
+    time.sleep(1)
+    return fake_bot_api.webhook_url
+
+
+def telegram_update(update_id, user_id, text):
+    message = {
+        'message_id': update_id,
+        'date': int(time.time()),
+        'chat': {'id': user_id, 'type': 'private'},
+        'from': {'id': user_id, 'is_bot': False, 'first_name': 'User'},
+        'text': text,
+    }
+    if text.startswith('/'):
+        message['entities'] = [
+            {'type': 'bot_command', 'offset': 0, 'length': len(text)}
+        ]
+    return {'update_id': update_id, 'message': message}
+
+
+def post_update(webhook_url, update):
+    http_request = request.Request(
+        webhook_url,
+        data=json.dumps(update).encode(),
+        headers={'Content-Type': 'application/json'},
+    )
+    started_at = time.perf_counter()
+    with request.urlopen(http_request, timeout=30) as http_response:
+        http_response.read()
+    return time.perf_counter() - started_at
+
+
+def play_user(webhook_url, update_ids, user_id, rounds):
+    """
+    :return: list of (interaction, seconds) pairs.
+    """
+    scenario = [('start', '/start')]
+    for _ in range(rounds):
+        scenario.extend(
+            [
+                ('new question', 'Новый вопрос'),
+                ('answer (wrong)', 'Неверный ответ'),
+                ('give up', 'Сдаться'),
+                ('score', 'Мой счет'),
+            ]
+        )
+    return [
+        (
+            name,
+            post_update(webhook_url, telegram_update(next(update_ids), user_id, text)),
+        )
+        for name, text in scenario
+    ]
+
+
+def print_report(measurements, elapsed):
+    by_name = collections.defaultdict(list)
+    for name, seconds in measurements:
+        by_name[name].append(seconds)
+    by_name['all'] = [seconds for _, seconds in measurements]
+
+    header = '{:<16} {:>7} '.format('interaction', 'count')
+    header += ' '.join(f'{f"p{percentile}, ms":>9}' for percentile in PERCENTILES)
+    print(header)
+    for name, timings in by_name.items():
+        timings.sort()
+        line = f'{name:<16} {len(timings):>7} '
+        line += ' '.join(
+            f'{get_percentile(timings, percentile) * 1000:>9.3f}'
+            for percentile in PERCENTILES
+        )
+        print(line)
+    print(
+        'Updates: {}, elapsed: {:.2f} s, throughput: {:.0f} updates/s'.format(
+            len(measurements), elapsed, len(measurements) / elapsed
+        )
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--redis-url', required=True)
+    parser.add_argument('--users', type=int, default=50)
+    parser.add_argument('--rounds', type=int, default=3)
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--clients', type=int, default=8)
+    args = parser.parse_args()
+
+    RedisStorage.connection = create_connection(args.redis_url)
+    populate_db.run_command(DATA_DIRECTORY, 'KOI8-R')
+    # Users start conversations with /start, which works only without a state.
+    for user_id in range(1, args.users + 1):
+        UserState('telegram', user_id).delete_from_db()
+
+    fake_bot_api = FakeBotApi()
+    fake_bot_api.start()
+    process = start_webhook_server(
+        args.redis_url, get_free_port(), args.workers, fake_bot_api.url
+    )
+    try:
+        webhook_url = wait_for_webhook(fake_bot_api, process)
+        update_ids = itertools.count(1)
+        started_at = time.perf_counter()
+        with futures.ThreadPoolExecutor(max_workers=args.clients) as executor:
+            sessions = [
+                executor.submit(
+                    play_user, webhook_url, update_ids, user_id, args.rounds
+                )
+                for user_id in range(1, args.users + 1)
+            ]
+            measurements = [
+                measurement for session in sessions for measurement in session.result()
+            ]
+        elapsed = time.perf_counter() - started_at
+    finally:
+        process.terminate()
+        process.wait()
+        fake_bot_api.stop()
+
+    print(
+        f'Users: {args.users}, webhook workers: {args.workers}, '
+        f'clients: {args.clients}'
+    )
+    print_report(measurements, elapsed)
+    updates_per_user = 1 + 4 * args.rounds
+    unanswered = [
+        user_id
+        for user_id in range(1, args.users + 1)
+        if len(fake_bot_api.messages[user_id]) != updates_per_user
+    ]
+    if unanswered:
+        raise SystemExit(
+            'Users did not get a reply to every update: {}'.format(
+                ', '.join(map(str, unanswered))
+            )
+        )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,167 @@
+"""
+Compare latency of drawing a question on a topic and of searching
+when the whole intersection of word sets is built and when it is
+sampled or scanned only until enough questions are found.
+
+Usage (from src directory):
+    python -m benchmarks.topic_search_benchmark [--questions 20000]
+        [--iterations 500] [--redis-url redis://host:port/db]
+
+Every engine gets a synthetic index: a common word occurs in half of
+questions, a rare word in one of a hundred, both sets also keep ids
+of removed questions. Without --redis-url redis engine uses an in-memory
+fakeredis server, otherwise the given database is populated, so use a spare one.
+"""
+
+import time
+import random
+import argparse
+
+from application.common.database import RedisStorage
+from application.common.memory_storage import MemoryStorage
+from application.common.storage import Storage
+from application.models import QuizQuestion
+from benchmarks.load_benchmark import get_percentile
+from benchmarks.redis_round_trips_benchmark import create_connection
+
+COMMON_WORD = 'история'
+RARE_WORD = 'река'
+REMOVED_QUESTIONS_COUNT = 100
+
+# Drawing a question from the whole intersection, as it was done before sampling.
+FULL_TOPIC_QUESTION_SCRIPT = '''
+    local question_ids = redis.call('SINTER', unpack(KEYS))
+    if #question_ids == 0 then
+        return nil
+    end
+    local question_id = question_ids[math.floor(ARGV[3] * #question_ids) + 1]
+    local question = redis.call('HGET', ARGV[1] .. ':' .. question_id, ARGV[2])
+    return {question_id, question}
+'''
+
+
+def run_full_topic_question_script(call, keys, args):
+    question_ids = call('SINTER', *keys)
+    if not question_ids:
+        return None
+    question_id = question_ids[int(args[2] * len(question_ids))]
+    return [question_id, call('HGET', f'{args[0]}:{question_id.decode()}', args[1])]
+
+
+MemoryStorage.register_script(
+    FULL_TOPIC_QUESTION_SCRIPT, run_full_topic_question_script
+)
+
+
+def initialize_engine(engine_name, redis_url, questions_count):
+    if engine_name == 'memory':
+        Storage.initialize('memory')
+    else:
+        RedisStorage.connection = create_connection(redis_url)
+        RedisStorage._scripts = dict()
+        Storage.engine = RedisStorage
+
+    question_ids = Storage.engine.add_records_to_index(
+        QuizQuestion.COLLECTION,
+        [
+            {QuizQuestion.get_field_name('question'): f'Вопрос {number}'}
+            for number in range(questions_count)
+        ],
+    )
+    removed_ids = range(
+        questions_count + 1, questions_count + REMOVED_QUESTIONS_COUNT + 1
+    )
+    common_key, _ = QuizQuestion.get_search_keys(COMMON_WORD)
+    rare_key, _ = QuizQuestion.get_search_keys(RARE_WORD)
+    Storage.engine.add_members_to_sets(
+        {
+            common_key: [*question_ids[::2], *removed_ids],
+            rare_key: [*question_ids[::100], *removed_ids],
+        }
+    )
+
+
+def draw_from_full_intersection(topic):
+    return Storage.engine.run_script(
+        FULL_TOPIC_QUESTION_SCRIPT,
+        keys=QuizQuestion.get_search_keys(topic),
+        args=[
+            QuizQuestion.COLLECTION,
+            QuizQuestion.get_field_name('question'),
+            random.random(),
+        ],
+        read_only=True,
+    )
+
+
+def get_operations():
+    """
+    :return: dict of operation name: function().
+    """
+    both_words = f'{COMMON_WORD} {RARE_WORD}'
+    return {
+        'topic, full': lambda: draw_from_full_intersection(COMMON_WORD),
+        'topic, sampled': lambda: QuizQuestion.get_random_question_text_on_topic(
+            COMMON_WORD
+        ),
+        'two words, full': lambda: draw_from_full_intersection(both_words),
+        'two words, sampled': lambda: QuizQuestion.get_random_question_text_on_topic(
+            both_words
+        ),
+        'search, full': lambda: QuizQuestion.search(COMMON_WORD)[:10],
+        'search, 10 found': lambda: QuizQuestion.search(COMMON_WORD, 10),
+    }
+
+
+def measure(operation, iterations):
+    """
+    :return: sorted seconds taken by every call.
+    """
+    timings = []
+    for _ in range(iterations):
+        started_at = time.perf_counter()
+        operation()
+        timings.append(time.perf_counter() - started_at)
+    return sorted(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--questions', type=int, default=20000)
+    parser.add_argument('--iterations', type=int, default=500)
+    parser.add_argument('--redis-url')
+    args = parser.parse_args()
+
+    engines = {
+        'redis': args.redis_url or 'fakeredis',
+        'memory': 'memory',
+    }
+    results = {}
+    for engine_name in engines:
+        initialize_engine(engine_name, args.redis_url, args.questions)
+        for name, operation in get_operations().items():
+            results[name, engine_name] = measure(operation, args.iterations)
+
+    print(
+        'Storages: {}, questions: {}, iterations: {}, latency in us'.format(
+            ', '.join(f'{name} ({storage})' for name, storage in engines.items()),
+            args.questions,
+            args.iterations,
+        )
+    )
+    header = f'{"operation":<20}'
+    for engine_name in engines:
+        header += f' {f"{engine_name} p50":>12} {f"{engine_name} p99":>12}'
+    print(header)
+    for name in get_operations():
+        line = f'{name:<20}'
+        for engine_name in engines:
+            timings = results[name, engine_name]
+            line += ' {:>12.1f} {:>12.1f}'.format(
+                get_percentile(timings, 50) * 1e6, get_percentile(timings, 99) * 1e6
+            )
+        print(line)
+
+
+if __name__ == '__main__':
+    main()
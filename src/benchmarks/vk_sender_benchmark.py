@@ -0,0 +1,94 @@
+"""
+Run VkMessageSender against a local fake VK API endpoint
+and print its metrics.
+
+Usage (from src directory):
+    python -m benchmarks.vk_sender_benchmark [--messages 1000] [--error-rate 0.1]
+"""
+
+import re
+import json
+import time
+import random
+import argparse
+import threading
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from application.bot.vk_sender import VkMessageSender
+
+
+class FakeVkApiHandler(BaseHTTPRequestHandler):
+    """
+    Accepts 'execute' requests with messages.send calls.
+    Fails with 'too many requests per second' error with the given probability
+    and answers after the given latency.
+    """
+
+    error_rate = 0
+    latency = 0
+    received_messages = 0
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length'])).decode()
+        code = urllib.parse.parse_qs(body)['code'][0]
+        time.sleep(FakeVkApiHandler.latency)
+
+        if random.random() < FakeVkApiHandler.error_rate:
+            response = {
+                'error': {'error_code': 6, 'error_msg': 'Too many requests per second'}
+            }
+        else:
+            calls_count = len(re.findall(r'API\.messages\.send\(', code))
+            FakeVkApiHandler.received_messages += calls_count
+            response = {'response': list(range(1, calls_count + 1))}
+
+        payload = json.dumps(response).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--messages', type=int, default=1000)
+    parser.add_argument('--error-rate', type=float, default=0.1)
+    parser.add_argument('--latency', type=float, default=0.02)
+    parser.add_argument('--requests-per-second', type=int, default=20)
+    args = parser.parse_args()
+
+    FakeVkApiHandler.error_rate = args.error_rate
+    FakeVkApiHandler.latency = args.latency
+    server = ThreadingHTTPServer(('127.0.0.1', 0), FakeVkApiHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    sender = VkMessageSender(
+        'token',
+        api_url=f'http://127.0.0.1:{server.server_port}',
+        requests_per_second=args.requests_per_second,
+    )
+    sender.start()
+
+    started_at = time.perf_counter()
+    for message_number in range(args.messages):
+        sender.send(message_number, f'Message {message_number}')
+    sender.stop()
+    elapsed = time.perf_counter() - started_at
+    server.shutdown()
+
+    metrics = sender.get_metrics()
+    print(f'Messages: {args.messages}, elapsed: {elapsed:.2f}s')
+    print(f'Received by fake API: {FakeVkApiHandler.received_messages}')
+    for name, value in metrics.items():
+        print(
+            f'{name}: {value:.3f}' if isinstance(value, float) else f'{name}: {value}'
+        )
+
+
+if __name__ == '__main__':
+    main()
@@ -1,6 +1,17 @@
 import os
+import queue
+import atexit
+import random
 import logging
 import logging.config
+import logging.handlers
+
+LOG_FORMAT = '%(asctime)s — %(name)s — %(levelname)s — %(message)s'
+
+_queue_listener = None
+# Queue handler of the root logger, console handler which replaces it
+# in forked processes and sample rate, set by setup_logging.
+_forked_handlers = None
 
 
 def convert_value_to_int(value):
@@ -10,19 +21,79 @@ def convert_value_to_int(value):
         return 0
 
 
+def convert_value_to_list(value):
+    """
+    :return: list of comma separated values of a string, empty list for None.
+    """
+    return [item.strip() for item in (value or '').split(',') if item.strip()]
+
+
+def convert_value_to_float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return 0.0
+
+
 class ConfigError(Exception):
     pass
 
 
 class Config:
     DEBUG = True
+    LOG_LEVEL = os.getenv('LOG_LEVEL', 'DEBUG').upper()
+    LOG_SAMPLE_RATE = convert_value_to_float(os.getenv('LOG_SAMPLE_RATE', 1))
     QUIZ_QUESTIONS_DIRECTORY = os.getenv('QUIZ_QUESTIONS_DIRECTORY')
     DEFAULT_ENCODING = 'KOI8-R'
     QUIZ_QUESTIONS_FILEPARSING_LIMIT = convert_value_to_int(
         os.getenv('QUIZ_QUESTIONS_FILEPARSING_LIMIT')
     )
+    QUIZ_QUESTIONS_DRAW_MODE = os.getenv('QUIZ_QUESTIONS_DRAW_MODE', 'random')
+    QUIZ_QUESTIONS_DRAW_MODES = ('random', 'deck')
+    QUIZ_QUESTIONS_PREFETCH_SIZE = convert_value_to_int(
+        os.getenv('QUIZ_QUESTIONS_PREFETCH_SIZE', 1000)
+    )
+    QUIZ_QUESTIONS_PREFETCH_BATCH_SIZE = convert_value_to_int(
+        os.getenv('QUIZ_QUESTIONS_PREFETCH_BATCH_SIZE', 100)
+    )
+    QUIZ_QUESTIONS_CORPUS_PATH = os.getenv('QUIZ_QUESTIONS_CORPUS_PATH')
+    QUIZ_QUESTIONS_SERIALIZER = os.getenv('QUIZ_QUESTIONS_SERIALIZER', 'plain')
+    QUIZ_QUESTIONS_SERIALIZERS = ('plain', 'compact')
+    ANSWERS_CACHE_SIZE = convert_value_to_int(os.getenv('ANSWERS_CACHE_SIZE', 10000))
+    ANSWERS_CACHE_TTL = convert_value_to_int(os.getenv('ANSWERS_CACHE_TTL', 300))
     TELEGRAM_BOT_TOKEN = os.getenv('TELEGRAM_BOT_TOKEN')
+    TELEGRAM_ASYNC_CONCURRENCY_LIMIT = convert_value_to_int(
+        os.getenv('TELEGRAM_ASYNC_CONCURRENCY_LIMIT', 100)
+    )
+    TELEGRAM_API_URL = os.getenv('TELEGRAM_API_URL', 'https://api.telegram.org')
+    TELEGRAM_WEBHOOK_URL = os.getenv('TELEGRAM_WEBHOOK_URL')
+    TELEGRAM_WEBHOOK_HOST = os.getenv('TELEGRAM_WEBHOOK_HOST', '0.0.0.0')
+    # Heroku passes the port to listen on in PORT.
+    TELEGRAM_WEBHOOK_PORT = convert_value_to_int(
+        os.getenv('TELEGRAM_WEBHOOK_PORT', os.getenv('PORT', 8443))
+    )
+    TELEGRAM_WEBHOOK_WORKERS = convert_value_to_int(
+        os.getenv('TELEGRAM_WEBHOOK_WORKERS', 4)
+    )
+    # Conversation states are written behind in batches, 0 writes them at once.
+    TELEGRAM_CONVERSATIONS_FLUSH_MS = convert_value_to_int(
+        os.getenv('TELEGRAM_CONVERSATIONS_FLUSH_MS', 100)
+    )
+    TELEGRAM_CONVERSATIONS_FLUSH_SIZE = convert_value_to_int(
+        os.getenv('TELEGRAM_CONVERSATIONS_FLUSH_SIZE', 100)
+    )
     VK_GROUP_TOKEN = os.getenv('VK_GROUP_TOKEN')
+    VK_WORKERS = convert_value_to_int(os.getenv('VK_WORKERS', 4))
+    VK_API_URL = os.getenv('VK_API_URL', 'https://api.vk.com')
+    METRICS_PORT = convert_value_to_int(os.getenv('METRICS_PORT'))
+    STORAGE_ENGINE = os.getenv('STORAGE_ENGINE', 'redis')
+    STORAGE_ENGINES = ('redis', 'memory')
+    MEMORY_STORAGE_SETTINGS = {
+        'snapshot_path': os.getenv('STORAGE_SNAPSHOT_PATH'),
+        'snapshot_interval': convert_value_to_int(
+            os.getenv('STORAGE_SNAPSHOT_INTERVAL', 60)
+        ),
+    }
 
     required = [
         'QUIZ_QUESTIONS_DIRECTORY',
@@ -33,18 +104,38 @@ class Config:
         'REDIS_SETTINGS',
     ]
 
+    REDIS_POOL_SETTINGS = {
+        'max_connections': convert_value_to_int(os.getenv('REDIS_MAX_CONNECTIONS', 50)),
+        'socket_timeout': convert_value_to_int(os.getenv('REDIS_SOCKET_TIMEOUT', 5)),
+        'socket_connect_timeout': convert_value_to_int(
+            os.getenv('REDIS_SOCKET_CONNECT_TIMEOUT', 5)
+        ),
+        'health_check_interval': convert_value_to_int(
+            os.getenv('REDIS_HEALTH_CHECK_INTERVAL', 30)
+        ),
+        'shard_urls': convert_value_to_list(os.getenv('REDIS_SHARD_URLS')),
+    }
+
 
 class DevelopmentConfig(Config):
     REDIS_SETTINGS = {
         'host': os.getenv('REDIS_HOST'),
         'port': convert_value_to_int(os.getenv('REDIS_PORT')),
         'url': None,
+        **Config.REDIS_POOL_SETTINGS,
     }
 
 
 class ProductionConfig(Config):
     DEBUG = False
-    REDIS_SETTINGS = {'host': None, 'port': None, 'url': os.getenv('REDIS_URL')}
+    LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()
+    LOG_SAMPLE_RATE = convert_value_to_float(os.getenv('LOG_SAMPLE_RATE', 0.01))
+    REDIS_SETTINGS = {
+        'host': None,
+        'port': None,
+        'url': os.getenv('REDIS_URL'),
+        **Config.REDIS_POOL_SETTINGS,
+    }
 
 
 def validate_config(config):
@@ -54,24 +145,133 @@ def validate_config(config):
             errors.append(
                 f'Environment variable {key} has not been configured properly.'
             )
+    if config.QUIZ_QUESTIONS_DRAW_MODE not in config.QUIZ_QUESTIONS_DRAW_MODES:
+        errors.append(
+            'Environment variable QUIZ_QUESTIONS_DRAW_MODE should be one of: {}.'.format(
+                ', '.join(config.QUIZ_QUESTIONS_DRAW_MODES)
+            )
+        )
+    if config.QUIZ_QUESTIONS_SERIALIZER not in config.QUIZ_QUESTIONS_SERIALIZERS:
+        errors.append(
+            'Environment variable QUIZ_QUESTIONS_SERIALIZER should be one of: {}.'.format(
+                ', '.join(config.QUIZ_QUESTIONS_SERIALIZERS)
+            )
+        )
+    if config.STORAGE_ENGINE not in config.STORAGE_ENGINES:
+        errors.append(
+            'Environment variable STORAGE_ENGINE should be one of: {}.'.format(
+                ', '.join(config.STORAGE_ENGINES)
+            )
+        )
+    if not isinstance(logging.getLevelName(config.LOG_LEVEL), int):
+        errors.append(
+            'Environment variable LOG_LEVEL should be one of: '
+            'DEBUG, INFO, WARNING, ERROR, CRITICAL.'
+        )
+    if config.VK_WORKERS < 1:
+        errors.append('Environment variable VK_WORKERS should be at least 1.')
+    if config.TELEGRAM_ASYNC_CONCURRENCY_LIMIT < 1:
+        errors.append(
+            'Environment variable TELEGRAM_ASYNC_CONCURRENCY_LIMIT should be at least 1.'
+        )
+    if config.TELEGRAM_WEBHOOK_WORKERS < 1:
+        errors.append(
+            'Environment variable TELEGRAM_WEBHOOK_WORKERS should be at least 1.'
+        )
+    if not 0 < config.TELEGRAM_WEBHOOK_PORT < 65536:
+        errors.append(
+            'Environment variable TELEGRAM_WEBHOOK_PORT should be between 1 and 65535.'
+        )
+    if not 0 <= config.LOG_SAMPLE_RATE <= 1:
+        errors.append('Environment variable LOG_SAMPLE_RATE should be between 0 and 1.')
     if errors:
         error_message = '\n'.join(errors)
         raise ConfigError(error_message)
 
 
-def setup_logging():
+class SamplingFilter(logging.Filter):
+    """
+    Passes only the given share of records of per-record loggers,
+    whose names end with '.records', e.g. a log line for every parsed question.
+    Other records always pass.
+    """
+
+    def __init__(self, rate=1.0, suffix='.records'):
+        super().__init__()
+        self.rate = rate
+        self.suffix = suffix
+
+    def filter(self, record):
+        if not record.name.endswith(self.suffix):
+            return True
+        return self.rate >= 1 or random.random() < self.rate
+
+
+def setup_logging(level='DEBUG', sample_rate=1.0, stream=None):
+    """
+    Records are put into a queue by the logging thread and written
+    by a listener thread, so logging does not block on output.
+    Forked processes, e.g. workers of populate_db, write directly,
+    as the listener thread is not copied into them.
+    Listener is stopped at exit, writing all queued records.
+    """
+    global _queue_listener, _forked_handlers
+    stop_logging()
+
+    log_queue = queue.Queue()
     logging_config = {
         'version': 1,
         'disable_existing_loggers': False,
-        'formatters': {
-            'standard': {
-                'format': '%(asctime)s — %(name)s — %(levelname)s — %(message)s'
-            }
-        },
+        'filters': {'sampling': {'()': SamplingFilter, 'rate': sample_rate}},
         'handlers': {
-            'console': {'class': 'logging.StreamHandler', 'formatter': 'standard'}
+            'queue': {
+                'class': 'logging.handlers.QueueHandler',
+                'queue': log_queue,
+                'filters': ['sampling'],
+            }
         },
-        'loggers': {'': {'handlers': ['console'], 'level': 'DEBUG', 'propagate': True}},
+        'loggers': {'': {'handlers': ['queue'], 'level': level, 'propagate': True}},
     }
-
     logging.config.dictConfig(logging_config)
+
+    console_handler = logging.StreamHandler(stream)
+    console_handler.setFormatter(logging.Formatter(LOG_FORMAT))
+    _queue_listener = logging.handlers.QueueListener(log_queue, console_handler)
+    _queue_listener.start()
+
+    _forked_handlers = logging.getLogger().handlers[0], console_handler, sample_rate
+
+
+def _log_directly_after_fork():
+    """
+    Registered once, replaces the queue handler of the latest setup_logging
+    in a forked process.
+    """
+    if _forked_handlers is None:
+        return None
+    root_logger = logging.getLogger()
+    queue_handler, console_handler, sample_rate = _forked_handlers
+    if queue_handler not in root_logger.handlers:
+        return None
+    root_logger.removeHandler(queue_handler)
+    console_handler.addFilter(SamplingFilter(sample_rate))
+    root_logger.addHandler(console_handler)
+
+
+os.register_at_fork(after_in_child=_log_directly_after_fork)
+
+
+@atexit.register
+def stop_logging():
+    """
+    Stop the listener thread of setup_logging after it writes queued records.
+    """
+    global _queue_listener
+    if _queue_listener is not None:
+        _queue_listener.stop()
+        _queue_listener = None
+
+
+# Queue handler of the root logger, console handler which replaces it
+# in forked processes and sample rate, set by setup_logging.
+_forked_handlers = None
@@ -3,7 +3,9 @@ import argparse
 import logging
 import os
 
-from application.common.database import RedisStorage
+from application.common.storage import Storage
+from application.common.metrics import start_metrics_server
+from application.models import QuestionDraw, QuizQuestion, UserCategory, UserQuestion
 from config import (
     ProductionConfig,
     DevelopmentConfig,
@@ -12,8 +14,6 @@ from config import (
     ConfigError,
 )
 
-from application.commands import populate_db, run_vk_bot, run_telegram_bot
-
 logger = logging.getLogger(__name__)
 
 
@@ -24,13 +24,102 @@ def create_parser():
 
     subparsers = parser.add_subparsers(dest='command')
 
-    subparsers.add_parser('populate_db', help=populate_db.run_command.__doc__)
+    # Commands are imported when they are run, so every process loads
+    # only the libraries of its own command, help is not taken from them.
+    populate_db_parser = subparsers.add_parser(
+        'populate_db', help='Populate redis database with quiz questions from files.'
+    )
+
+    populate_db_parser.add_argument(
+        '--workers',
+        type=int,
+        default=1,
+        help='Parse files in a pool of processes of the given size.',
+    )
+    populate_db_parser.add_argument(
+        '--batch-size',
+        type=int,
+        default=500,
+        help='How many questions are written into database per round trip.',
+    )
+    populate_db_parser.add_argument(
+        '--incremental',
+        action='store_true',
+        help='Parse only added or changed files, remove questions of deleted files.',
+    )
+    populate_db_parser.add_argument(
+        '--reindex',
+        action='store_true',
+        help='Parse all files as --incremental does for changed ones, '
+        'rebuilding questions and their indexes.',
+    )
+
+    migrate_ratings_parser = subparsers.add_parser(
+        'migrate_ratings',
+        help="Copy existing users' ratings into the all-time leaderboard.",
+    )
+
+    migrate_ratings_parser.add_argument(
+        '--batch-size',
+        type=int,
+        default=1000,
+        help='How many ratings are read from database per round trip.',
+    )
+
+    search_parser = subparsers.add_parser(
+        'search', help='Search questions which contain all words of the query.'
+    )
+
+    search_parser.add_argument('query', type=str, help='Words to search for.')
+    search_parser.add_argument(
+        '--count', type=int, default=10, help='How many questions to show.'
+    )
+
+    export_corpus_parser = subparsers.add_parser(
+        'export_corpus',
+        help='Export questions from database into a memory-mapped corpus file.',
+    )
+
+    export_corpus_parser.add_argument(
+        '--path',
+        type=str,
+        help='Path of the corpus file, QUIZ_QUESTIONS_CORPUS_PATH by default.',
+    )
+    export_corpus_parser.add_argument(
+        '--batch-size',
+        type=int,
+        default=1000,
+        help='How many questions are read from database per round trip.',
+    )
+
+    sync_replicas_parser = subparsers.add_parser(
+        'sync_replicas',
+        help='Copy questions from the first redis node to other nodes.',
+    )
+
+    sync_replicas_parser.add_argument(
+        '--batch-size',
+        type=int,
+        default=1000,
+        help='How many keys are copied per round trip.',
+    )
 
     run_parser = subparsers.add_parser('run')
 
     run_parser.add_argument(
         '--platform', type=str, help='Run bot on telegram or vk platform.'
     )
+    run_parser.add_argument(
+        '--async',
+        dest='use_async',
+        action='store_true',
+        help='Run telegram bot on asyncio runtime.',
+    )
+    run_parser.add_argument(
+        '--webhook',
+        action='store_true',
+        help='Serve telegram updates posted to webhook in several processes.',
+    )
 
     return parser
 
@@ -55,24 +144,146 @@ def main():
         sys.stdout.write(str(e))
         sys.exit(1)
 
-    setup_logging()
+    setup_logging(application_config.LOG_LEVEL, application_config.LOG_SAMPLE_RATE)
 
-    RedisStorage.initialize(**application_config.REDIS_SETTINGS)
+    if application_config.STORAGE_ENGINE == 'memory':
+        Storage.initialize('memory', **application_config.MEMORY_STORAGE_SETTINGS)
+    else:
+        # Questions are read by every user, so with several redis nodes
+        # they are kept on each of them, user keys are spread across nodes.
+        Storage.initialize(
+            'redis',
+            **application_config.REDIS_SETTINGS,
+            replicated_prefixes=(f'{QuizQuestion.COLLECTION}:',),
+        )
+    QuizQuestion.initialize_serializer(application_config.QUIZ_QUESTIONS_SERIALIZER)
+    UserQuestion.initialize_cache(
+        application_config.ANSWERS_CACHE_SIZE, application_config.ANSWERS_CACHE_TTL
+    )
+    UserCategory.initialize_cache(
+        application_config.ANSWERS_CACHE_SIZE, application_config.ANSWERS_CACHE_TTL
+    )
 
     arg_parser = create_parser()
     args = arg_parser.parse_args()
 
+    # Ids of questions are allocated on the first node and followed by others,
+    # so nodes with different last ids, e.g. a new empty one, have to be synced.
+    diverged_keys = Storage.engine.get_diverged_keys(
+        [f'{QuizQuestion.COLLECTION}:last-id']
+    )
+    if diverged_keys and args.command != 'sync_replicas':
+        sys.stdout.write(
+            'Redis nodes have different {}, run sync_replicas command.'.format(
+                ', '.join(diverged_keys)
+            )
+        )
+        sys.exit(1)
+
+    # Bots read questions from corpus, other commands work with storage.
+    if args.command == 'run' and application_config.QUIZ_QUESTIONS_CORPUS_PATH:
+        try:
+            QuizQuestion.initialize_corpus(
+                application_config.QUIZ_QUESTIONS_CORPUS_PATH
+            )
+        except (OSError, ValueError) as e:
+            sys.stdout.write(f'Corpus file can not be opened: {str(e)}')
+            sys.exit(1)
+    QuestionDraw.initialize(
+        application_config.QUIZ_QUESTIONS_DRAW_MODE,
+        application_config.QUIZ_QUESTIONS_PREFETCH_SIZE,
+        application_config.QUIZ_QUESTIONS_PREFETCH_BATCH_SIZE,
+    )
+
+    # Webhook workers serve metrics themselves, as they are forked processes.
+    webhook = args.command == 'run' and args.webhook
+    if application_config.METRICS_PORT and not webhook:
+        start_metrics_server(application_config.METRICS_PORT)
+
     if args.command == 'populate_db':
+        from application.commands import populate_db
+
         populate_db.run_command(
             application_config.QUIZ_QUESTIONS_DIRECTORY,
             application_config.DEFAULT_ENCODING,
             application_config.QUIZ_QUESTIONS_FILEPARSING_LIMIT,
+            args.workers,
+            args.batch_size,
+            args.incremental,
+            args.reindex,
         )
+    elif args.command == 'migrate_ratings':
+        from application.commands import migrate_ratings
+
+        migrate_ratings.run_command(args.batch_size)
+    elif args.command == 'sync_replicas':
+        from application.commands import sync_replicas
+
+        sync_replicas.run_command(args.batch_size)
+    elif args.command == 'search':
+        from application.commands import search
+
+        search.run_command(args.query, args.count)
+    elif args.command == 'export_corpus':
+        corpus_path = args.path or application_config.QUIZ_QUESTIONS_CORPUS_PATH
+        if not corpus_path:
+            sys.stdout.write(
+                'Corpus path is required: --path or QUIZ_QUESTIONS_CORPUS_PATH.'
+            )
+            sys.exit(1)
+        from application.commands import export_corpus
+
+        export_corpus.run_command(corpus_path, args.batch_size)
     elif args.command == 'run':
-        if args.platform == 'telegram':
-            run_telegram_bot.run_command(application_config.TELEGRAM_BOT_TOKEN)
+        if args.platform == 'telegram' and args.use_async:
+            if application_config.STORAGE_ENGINE != 'redis':
+                sys.stdout.write('Async telegram bot supports redis storage only.')
+                sys.exit(1)
+            from application.commands import run_telegram_async_bot
+
+            run_telegram_async_bot.run_command(
+                application_config.TELEGRAM_BOT_TOKEN,
+                application_config.REDIS_SETTINGS,
+                application_config.TELEGRAM_ASYNC_CONCURRENCY_LIMIT,
+                application_config.TELEGRAM_API_URL,
+            )
+        elif args.platform == 'telegram' and args.webhook:
+            if not application_config.TELEGRAM_WEBHOOK_URL:
+                sys.stdout.write('Webhook requires TELEGRAM_WEBHOOK_URL to be set.')
+                sys.exit(1)
+            if application_config.STORAGE_ENGINE != 'redis':
+                sys.stdout.write('Webhook workers share redis storage only.')
+                sys.exit(1)
+            from application.commands import run_telegram_bot
+
+            run_telegram_bot.run_webhook_command(
+                application_config.TELEGRAM_BOT_TOKEN,
+                application_config.TELEGRAM_WEBHOOK_URL,
+                application_config.TELEGRAM_WEBHOOK_HOST,
+                application_config.TELEGRAM_WEBHOOK_PORT,
+                application_config.TELEGRAM_WEBHOOK_WORKERS,
+                application_config.TELEGRAM_API_URL,
+                application_config.TELEGRAM_CONVERSATIONS_FLUSH_MS / 1000,
+                application_config.TELEGRAM_CONVERSATIONS_FLUSH_SIZE,
+                application_config.METRICS_PORT,
+            )
+        elif args.platform == 'telegram':
+            from application.commands import run_telegram_bot
+
+            run_telegram_bot.run_command(
+                application_config.TELEGRAM_BOT_TOKEN,
+                application_config.TELEGRAM_API_URL,
+                application_config.TELEGRAM_CONVERSATIONS_FLUSH_MS / 1000,
+                application_config.TELEGRAM_CONVERSATIONS_FLUSH_SIZE,
+            )
         elif args.platform == 'vk':
-            run_vk_bot.run_command(application_config.VK_GROUP_TOKEN)
+            from application.commands import run_vk_bot
+
+            run_vk_bot.run_command(
+                application_config.VK_GROUP_TOKEN,
+                application_config.VK_WORKERS,
+                application_config.VK_API_URL,
+            )
         else:
             sys.stdout.write('Unknown command. Please refer for help.')
             sys.exit(1)